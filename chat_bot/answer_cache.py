@@ -0,0 +1,230 @@
+import os
+import re
+import time
+import json
+import sqlite3
+import hashlib
+import threading
+import unicodedata
+from collections import OrderedDict
+
+import numpy as np
+
+from manifest import hash_file
+
+
+def normalize_question(question):
+    question = unicodedata.normalize("NFKC", question).lower()
+    question = re.sub(r"[^\w\s]", " ", question)
+    return " ".join(question.split())
+
+
+class DataVersion():
+    # data 파일이 바뀌었는지 확인한다. 매번 hash 하지 않도록 (mtime, size) 가 바뀐 경우에만 다시 hash
+    # data dir 을 훑는 것도 check_interval 초에 한 번만 한다 (적재 직후에는 refresh 로 바로 다시 확인)
+    def __init__(self, data_dir, check_interval=10.0):
+        self.data_dir = data_dir
+        self.check_interval = check_interval
+        # (signature, version, checked_at) 을 한 번에 바꿔서 lock 없이 여러 thread 가 불러도 짝이 맞게 한다
+        self.state = (None, None, 0.0)
+
+    def get_signature(self):
+        signature = []
+        for root, dirs, files in os.walk(self.data_dir):
+            for file in files:
+                if file.endswith(".txt"):
+                    stat = os.stat(os.path.join(root, file))
+                    signature.append((os.path.join(root, file), stat.st_mtime_ns, stat.st_size))
+        return sorted(signature)
+
+    def get(self):
+        signature, version, checked_at = self.state
+        if version is not None and time.monotonic() - checked_at < self.check_interval:
+            return version
+        return self.refresh()
+
+    def refresh(self):
+        signature = self.get_signature()
+        version = self.state[1]
+        if signature != self.state[0]:
+            sha = hashlib.sha256()
+            for file_path, _, _ in signature:
+                sha.update(file_path.encode("utf-8"))
+                sha.update(hash_file(file_path).encode("utf-8"))
+            version = sha.hexdigest()[:16]
+        self.state = (signature, version, time.monotonic())
+        return version
+
+
+class AnswerCache():
+    # 1단계: 정규화된 질문 exact match, 2단계: 질문 embedding 의 cosine 유사도가 threshold 이상이면 hit
+    def __init__(self, embedding=None, corpus="default", data_dir="./data", threshold=0.92,
+                 max_size=1024, ttl=3600, persist_path=None, check_interval=10.0):
+        self.embedding = embedding
+        self.corpus = corpus
+        self.data_version = DataVersion(data_dir, check_interval=check_interval)
+        self.threshold = threshold
+        self.max_size = max_size
+        self.ttl = ttl
+        self.persist_path = persist_path
+
+        self.entries = OrderedDict()
+        self.matrix = None
+        self.matrix_keys = []
+        self.scope = None
+        self.lock = threading.RLock()
+        self.conn = None
+        self.stats = {"hits": 0, "near_hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+        self.initialize()
+
+    def initialize(self):
+        if self.persist_path:
+            self.conn = sqlite3.connect(self.persist_path, check_same_thread=False)
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS answer_cache ("
+                "scope TEXT, key TEXT, answer TEXT, embedding TEXT, created REAL, "
+                "PRIMARY KEY (scope, key))"
+            )
+            self.conn.commit()
+        self.check_scope()
+
+    def get_scope(self):
+        return f"{self.corpus}:{self.data_version.get()}"
+
+    def check_scope(self):
+        # data 파일을 훑는 get_scope 는 lock 밖에서 하고, 바뀌었을 때만 lock 을 잡고 비운다
+        scope = self.get_scope()
+        with self.lock:
+            self.apply_scope(scope)
+
+    def refresh_scope(self):
+        # 적재 / index 교체 직후에 부르면 check_interval 을 기다리지 않고 옛 답을 비운다
+        self.data_version.refresh()
+        self.check_scope()
+
+    def apply_scope(self, scope):
+        if scope == self.scope:
+            return
+        if self.scope is not None:
+            self.stats["invalidations"] += 1
+        self.scope = scope
+        self.entries.clear()
+        self.matrix = None
+        if self.conn:
+            corpus = self.corpus.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            self.conn.execute(
+                "DELETE FROM answer_cache WHERE scope LIKE ? ESCAPE '\\' AND scope != ?",
+                (f"{corpus}:%", scope),
+            )
+            self.conn.commit()
+            self.load()
+
+    def load(self):
+        rows = self.conn.execute(
+            "SELECT key, answer, embedding, created FROM answer_cache WHERE scope = ? ORDER BY created",
+            (self.scope,),
+        ).fetchall()
+        for key, answer, embedding, created in rows[-self.max_size:]:
+            self.entries[key] = {
+                "answer": answer,
+                "embedding": np.asarray(json.loads(embedding), dtype=np.float32) if embedding else None,
+                "created": created,
+            }
+
+    def is_expired(self, entry):
+        return self.ttl is not None and time.time() - entry["created"] > self.ttl
+
+    def embed(self, question):
+        vector = np.asarray(self.embedding.embed_query(question), dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def get_matrix(self):
+        if self.matrix is None:
+            self.matrix_keys = [key for key, entry in self.entries.items() if entry["embedding"] is not None]
+            if self.matrix_keys:
+                self.matrix = np.stack([self.entries[key]["embedding"] for key in self.matrix_keys])
+        return self.matrix
+
+    def lookup(self, question):
+        # 반환값: (answer, 질문 embedding). embedding 은 miss 후 put 할 때 재사용한다
+        # embedding 계산 (network 호출) 은 lock 밖에서 해서 동시 요청이 서로 기다리지 않게 한다
+        self.check_scope()
+        key = normalize_question(question)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and not self.is_expired(entry):
+                self.entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return entry["answer"], entry["embedding"]
+            if entry:
+                self.remove(key)
+            if self.embedding is None:
+                self.stats["misses"] += 1
+                return None, None
+
+        vector = self.embed(question)
+        with self.lock:
+            matrix = self.get_matrix()
+            if matrix is not None:
+                scores = matrix @ vector
+                # threshold 를 넘는 후보를 점수 순으로 보고, 만료된 entry 는 건너뛴다
+                candidates = np.flatnonzero(scores >= self.threshold)
+                expired_keys = []
+                hit_key = None
+                for index in candidates[np.argsort(-scores[candidates])]:
+                    candidate_key = self.matrix_keys[index]
+                    if self.is_expired(self.entries[candidate_key]):
+                        expired_keys.append(candidate_key)
+                        continue
+                    hit_key = candidate_key
+                    break
+                for expired_key in expired_keys:
+                    self.remove(expired_key)
+                if hit_key is not None:
+                    self.entries.move_to_end(hit_key)
+                    self.stats["near_hits"] += 1
+                    return self.entries[hit_key]["answer"], vector
+
+            self.stats["misses"] += 1
+            return None, vector
+
+    def get(self, question):
+        return self.lookup(question)[0]
+
+    def put(self, question, answer, vector=None):
+        self.check_scope()
+        key = normalize_question(question)
+        if vector is None and self.embedding is not None:
+            vector = self.embed(question)
+        with self.lock:
+            created = time.time()
+            self.entries[key] = {"answer": answer, "embedding": vector, "created": created}
+            self.entries.move_to_end(key)
+            self.matrix = None
+            if self.conn:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO answer_cache VALUES (?, ?, ?, ?, ?)",
+                    (self.scope, key, answer, json.dumps(vector.tolist()) if vector is not None else None, created),
+                )
+                self.conn.commit()
+
+            while len(self.entries) > self.max_size:
+                oldest_key = next(iter(self.entries))
+                self.remove(oldest_key)
+                self.stats["evictions"] += 1
+
+    def remove(self, key):
+        self.entries.pop(key, None)
+        self.matrix = None
+        if self.conn:
+            self.conn.execute("DELETE FROM answer_cache WHERE scope = ? AND key = ?", (self.scope, key))
+            self.conn.commit()
+
+    def get_stats(self):
+        with self.lock:
+            total = self.stats["hits"] + self.stats["near_hits"] + self.stats["misses"]
+            stats = dict(self.stats, size=len(self.entries), scope=self.scope)
+            stats["hit_rate"] = (self.stats["hits"] + self.stats["near_hits"]) / total if total else 0.0
+            return stats
@@ -0,0 +1,253 @@
+import os
+import csv
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+
+from llm_client import CircuitOpenError, is_retryable_error
+from token_counter import count_tokens
+
+
+def read_questions(file_path, field="question"):
+    # JSONL / CSV 를 한 줄씩 읽는다 (수천 건이어도 전부 메모리에 올리지 않는다)
+    with open(file_path, "r", newline="") as f:
+        if file_path.endswith(".csv"):
+            rows = csv.DictReader(f)
+        else:
+            rows = (json.loads(line) for line in f if line.strip())
+        for line_number, row in enumerate(rows, start=1):
+            question = row.get(field) or row.get("text")
+            if question:
+                yield str(row.get("id") or line_number), question, row
+
+
+def load_checkpoint(output_path, retry_failed=False):
+    # 출력 JSONL 이 곧 checkpoint: 이미 답한 id 는 다시 돌리지 않는다
+    # retry_failed 면 실패한 기록을 지운 파일로 다시 써서, 다시 돌린 결과가 id 하나에 한 줄만 남게 한다
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    records = []
+    with open(output_path, "r") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # 중간에 끊긴 마지막 줄
+                continue
+            if record["id"] in done or (retry_failed and record.get("error")):
+                continue
+            done.add(record["id"])
+            records.append(line if line.endswith("\n") else line + "\n")
+    if retry_failed:
+        tmp_path = f"{output_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            f.writelines(records)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, output_path)
+    return done
+
+
+class TokenBucket():
+    # 분당 rate 만큼 채워지는 bucket. 실제 사용량이 추정보다 크면 charge 로 음수까지 빼서 다음 요청을 늦춘다
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity or rate_per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount=1):
+        amount = min(amount, self.capacity)
+        async with self.lock:
+            while True:
+                self.refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+
+    def charge(self, amount):
+        self.refill()
+        self.tokens -= amount
+
+
+class BatchRunner():
+    # 재시도는 여기서만 한다 (재시도도 rate limit bucket 을 거치도록). langchain 의 llm_client 는 max_retries=0 으로 만든다
+    def __init__(self, langchain, output_path, concurrency=8, requests_per_minute=600, tokens_per_minute=90000,
+                 max_retries=4, base_delay=1.0, max_delay=30.0, estimated_tokens=1500, history_dir=None,
+                 progress_every=50):
+        self.langchain = langchain
+        self.output_path = output_path
+        self.concurrency = concurrency
+        self.request_bucket = TokenBucket(requests_per_minute)
+        self.token_bucket = TokenBucket(tokens_per_minute)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.estimated_tokens = estimated_tokens
+        # 질문마다 새 대화로 돌리므로 history 는 실행이 끝나면 필요 없다 (history_dir 을 주면 남긴다)
+        self.temp_dir = None if history_dir else tempfile.TemporaryDirectory(prefix="batch-qa-")
+        self.history_dir = history_dir or self.temp_dir.name
+        self.progress_every = progress_every
+        self.stats = {"done": 0, "failed": 0, "skipped": 0, "retries": 0, "circuit_waits": 0}
+
+    def backoff(self, attempt):
+        # full jitter: 0 ~ min(max_delay, base * 2^attempt) 사이에서 무작위로 기다린다
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def circuit_wait(self):
+        # circuit 이 열려 있으면 보내 봐야 바로 실패하므로 시험 호출이 허용될 때까지 기다린다
+        return self.langchain.llm_client.breaker.retry_after() + self.backoff(0)
+
+    async def answer(self, item_id, question, record):
+        from langchain_openai import request_stats
+
+        estimate = count_tokens(question) + self.estimated_tokens
+        for attempt in range(self.max_retries + 1):
+            record["attempts"] = attempt + 1
+            await self.request_bucket.acquire()
+            await self.token_bucket.acquire(estimate)
+            chat_history = self.langchain.create_chat_history(f"batch-{item_id}-{attempt}", history_dir=self.history_dir)
+            try:
+                answer = await self.langchain.generate_answer_async(question, chat_history)
+            except CircuitOpenError:
+                # 기다려도 계속 열려 있으면 이 항목은 실패로 남기고, 다음 실행에서 --retry-failed 로 다시 돌린다
+                if attempt == self.max_retries:
+                    raise
+                self.stats["circuit_waits"] += 1
+                await asyncio.sleep(self.circuit_wait())
+                continue
+            except Exception as e:
+                # 요청 자체가 잘못된 오류는 다시 보내도 같으므로 바로 실패로 기록한다
+                if attempt == self.max_retries or not is_retryable_error(e):
+                    raise
+                self.stats["retries"] += 1
+                await asyncio.sleep(self.backoff(attempt))
+                continue
+
+            # 요청 task 의 context 에 남아 있는 실제 prompt token 수로 bucket 을 보정한다
+            stats = request_stats.get() or {}
+            used = stats.get("total_prompt_tokens", 0) + count_tokens(answer)
+            self.token_bucket.charge(used - estimate)
+            return answer, stats.get("total_prompt_tokens", 0)
+
+    async def worker(self, item_queue, output):
+        while True:
+            item = await item_queue.get()
+            if item is None:
+                return
+            item_id, question, row = item
+            record = {"id": item_id, "question": question}
+            start = time.perf_counter()
+            try:
+                answer, prompt_tokens = await self.answer(item_id, question, record)
+                record.update(answer=answer, prompt_tokens=prompt_tokens)
+                self.stats["done"] += 1
+            except Exception as e:
+                record["error"] = f"{type(e).__name__}: {e}"
+                self.stats["failed"] += 1
+            record["latency_ms"] = round((time.perf_counter() - start) * 1000, 1)
+            extra = {key: value for key, value in row.items() if key not in ("id", "question", "text")}
+            if extra:
+                record["meta"] = extra
+            output.write(json.dumps(record, ensure_ascii=False) + "\n")
+            output.flush()
+
+            finished = self.stats["done"] + self.stats["failed"]
+            if finished % self.progress_every == 0:
+                print(f"progress: {self.stats}")
+
+    async def run(self, items, done_ids=()):
+        item_queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        start = time.perf_counter()
+        with open(self.output_path, "a") as output:
+            workers = [asyncio.create_task(self.worker(item_queue, output)) for _ in range(self.concurrency)]
+            try:
+                for item in items:
+                    if item[0] in done_ids:
+                        self.stats["skipped"] += 1
+                        continue
+                    await item_queue.put(item)
+                for _ in workers:
+                    await item_queue.put(None)
+                await asyncio.gather(*workers)
+            except BaseException:
+                for task in workers:
+                    task.cancel()
+                raise
+            finally:
+                output.flush()
+                os.fsync(output.fileno())
+                if self.temp_dir is not None:
+                    self.temp_dir.cleanup()
+        self.stats["seconds"] = round(time.perf_counter() - start, 2)
+        return self.stats
+
+
+def create_langchain(args):
+    from context_compressor import ExtractiveCompressor
+    from database import VectorDB
+    from intent_router import IntentRouter
+    from langchain_openai import LangChain
+    from lexical_index import HybridRetriever
+    from llm_client import LLMClient
+    from reranker import MMRReranker, MMRRetriever
+
+    vectordb = VectorDB(upload=False, backend=args.retriever_backend, embedding_backend=args.embedding_backend)
+    intent_router = IntentRouter(
+        embedding=vectordb.embedding,
+        centroid_cache_path=os.path.join(vectordb.data_dir, "upload/intent_centroids.json"),
+    )
+    llm = None
+    if args.fake_llm:
+        from fake_chat import FakeChatModel
+        llm = FakeChatModel()
+    # 회귀 확인용이므로 answer cache 없이 매번 pipeline 을 끝까지 돌린다
+    return LangChain(
+        db=MMRRetriever(HybridRetriever(vectordb, vectordb.lexical_index), MMRReranker(vectordb.embedding)),
+        intent_router=intent_router,
+        llm=llm,
+        compression_mode=args.compression,
+        compressor=ExtractiveCompressor(embedding=vectordb.embedding),
+        # 재시도는 BatchRunner 가 하므로 llm_client 는 한 번만 보낸다
+        llm_client=LLMClient(max_retries=0),
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="질문 파일(JSONL/CSV)을 답변 pipeline 에 일괄로 돌리고 결과를 JSONL 로 쓴다")
+    parser.add_argument("input", help="질문 JSONL 또는 CSV (question 또는 text 열, 선택적으로 id 열)")
+    parser.add_argument("output", help="결과 JSONL (이미 있으면 이어서 실행)")
+    parser.add_argument("--field", default="question")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--rpm", type=int, default=600, help="분당 요청 수")
+    parser.add_argument("--tpm", type=int, default=90000, help="분당 token 수")
+    parser.add_argument("--max-retries", type=int, default=4)
+    parser.add_argument("--retry-failed", action="store_true", help="이전 실행에서 실패한 항목도 다시 돌린다")
+    parser.add_argument("--retriever-backend", default="chroma", choices=["chroma", "numpy"])
+    parser.add_argument("--embedding-backend", default="openai", choices=["openai", "local"])
+    parser.add_argument("--compression", default="local", choices=["local", "llm"])
+    parser.add_argument("--fake-llm", action="store_true", help="OpenAI 대신 fake chat model 로 돌린다 (dry run)")
+    args = parser.parse_args()
+
+    done_ids = load_checkpoint(args.output, retry_failed=args.retry_failed)
+    runner = BatchRunner(
+        create_langchain(args),
+        args.output,
+        concurrency=args.concurrency,
+        requests_per_minute=args.rpm,
+        tokens_per_minute=args.tpm,
+        max_retries=args.max_retries,
+    )
+    stats = asyncio.run(runner.run(read_questions(args.input, args.field), done_ids))
+    print(f"batch finished: {stats}")
@@ -0,0 +1,317 @@
+import os
+import sys
+import json
+import time
+import shutil
+import subprocess
+import argparse
+import platform
+import resource
+import tempfile
+import tracemalloc
+from datetime import datetime
+
+import numpy as np
+
+from chunker import get_text_splitter
+from embeddings import LocalHashEmbeddings
+from ingest_pipeline import IngestPipeline, MemoryCollection
+from lexical_index import HybridRetriever, build_manual_index
+from manual import find_text_files
+from numpy_index import NumpyVectorIndex, build_index_from_collection
+from reranker import MMRReranker, MMRRetriever
+
+HEAVY_MODULES = ("langchain", "openai", "chromadb", "tiktoken", "numpy")
+# 새 process 에서 import 부터 첫 답변까지를 잰다 (이미 import 된 module 이 결과에 섞이지 않도록)
+STARTUP_SCRIPT = """
+import sys, json, time
+start = time.perf_counter()
+import langchain_openai
+report = {"import_seconds": time.perf_counter() - start}
+report["heavy_modules_on_import"] = sorted(m for m in sys.argv[1].split(",") if m in sys.modules)
+if sys.argv[2] == "1":
+    from fake_chat import FakeChatModel
+    from lexical_index import HybridRetriever, build_manual_index
+    from manual import find_text_files
+
+    start = time.perf_counter()
+    retriever = HybridRetriever(None, build_manual_index(find_text_files(sys.argv[3]), data_dir=sys.argv[3]), mode="lexical")
+    lc = langchain_openai.LangChain(db=retriever, llm=FakeChatModel(latency=0.0, token_latency=0.0))
+    report["construct_seconds"] = time.perf_counter() - start
+    chat_history = lc.create_chat_history("startup", history_dir=sys.argv[4])
+    for key in ("first_answer_seconds", "second_answer_seconds"):
+        start = time.perf_counter()
+        lc.generate_answer("카카오싱크 설정 방법 알려줘", chat_history)
+        report[key] = time.perf_counter() - start
+print(json.dumps(report))
+"""
+
+
+def load_questions(questions_path, intent_examples_path=None, greetings=3):
+    # 매뉴얼에서 뽑은 고정 질문 + 인사 몇 개 (greeting 경로도 같이 재기 위해)
+    with open(questions_path, "r") as f:
+        questions = [json.loads(line)["question"] for line in f if line.strip()]
+    if intent_examples_path and os.path.exists(intent_examples_path):
+        with open(intent_examples_path, "r") as f:
+            examples = [json.loads(line) for line in f if line.strip()]
+        questions.extend([e["text"] for e in examples if e["intent"] == "greeting"][:greetings])
+    return questions
+
+
+def summarize(samples):
+    if not samples:
+        return {"count": 0}
+    values = np.asarray(samples, dtype=np.float64) * 1000
+    return {
+        "count": len(samples),
+        "mean_ms": round(float(values.mean()), 3),
+        "p50_ms": round(float(np.percentile(values, 50)), 3),
+        "p95_ms": round(float(np.percentile(values, 95)), 3),
+        "p99_ms": round(float(np.percentile(values, 99)), 3),
+    }
+
+
+def measure_memory(run):
+    tracemalloc.start()
+    try:
+        result = run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, peak / (1024 * 1024)
+
+
+def bench_ingest(data_dir, embedding, batch_size, max_workers, splitter):
+    collection = MemoryCollection()
+    pipeline = IngestPipeline(
+        collection=collection,
+        embedding=embedding,
+        data_dir=data_dir,
+        batch_size=batch_size,
+        max_workers=max_workers,
+        text_splitter=get_text_splitter(splitter),
+    )
+    stats, peak_mb = measure_memory(pipeline.run)
+    report = {
+        "files": stats["files"],
+        "chunks": stats["chunks"],
+        "batches": stats["batches"],
+        "seconds": round(stats["seconds"], 4),
+        "chunks_per_sec": round(stats["chunks_per_sec"], 1),
+        "tokens_per_sec": round(stats["tokens_per_sec"], 1),
+        "peak_memory_mb": round(peak_mb, 2),
+    }
+    return collection, report
+
+
+def bench_retrieval(retrievers, questions, repeat):
+    report = {}
+    for name, retriever in retrievers.items():
+        samples = []
+        for _ in range(repeat):
+            for question in questions:
+                start = time.perf_counter()
+                retriever.query_db(question)
+                samples.append(time.perf_counter() - start)
+        report[name] = summarize(samples)
+    return report
+
+
+def bench_answer(retriever, questions, repeat, llm_kwargs, use_async=False, history_dir=None, compression_mode="local"):
+    import asyncio
+    from fake_chat import FakeChatModel
+    from langchain_openai import LangChain
+
+    llm = FakeChatModel(**llm_kwargs)
+    lc = LangChain(db=retriever, llm=llm, compression_mode=compression_mode)
+    stage_samples = {}
+    total_samples = []
+    histories = []
+    # 답변 하나가 직접 부른 (foreground) LLM 호출만 request stats 에서 센다.
+    # history 요약은 요청 밖 thread 에서 돌기 때문에 전체 호출 수와의 차이로 따로 보고한다
+    calls, prompt_tokens, completion_tokens = [], [], []
+    errors = 0
+
+    def run():
+        nonlocal errors
+        for round_index in range(repeat):
+            # 매 round 새 대화로 시작해서 history 길이가 결과에 섞이지 않게 한다
+            chat_history = lc.create_chat_history(f"bench-{round_index}", history_dir=history_dir)
+            histories.append(chat_history)
+            for question in questions:
+                start = time.perf_counter()
+                try:
+                    if use_async:
+                        asyncio.run(lc.generate_answer_async(question, chat_history))
+                    else:
+                        lc.generate_answer(question, chat_history)
+                except Exception:
+                    errors += 1
+                    calls.append(lc.last_request_stats["llm_calls"])
+                    continue
+                total_samples.append(time.perf_counter() - start)
+                stats = lc.last_request_stats
+                for stage, seconds in stats["seconds"].items():
+                    stage_samples.setdefault(stage, []).append(seconds)
+                calls.append(stats["llm_calls"])
+                prompt_tokens.append(stats["total_prompt_tokens"])
+                completion_tokens.append(stats["completion_tokens"])
+        wait_for_summaries(histories)
+
+    calls_before = llm.stats["calls"]
+    _, peak_mb = measure_memory(run)
+    summary_calls = llm.stats["calls"] - calls_before - sum(calls)
+    answered = len(total_samples) or 1
+    return {
+        "mode": "async" if use_async else "sync",
+        "compression_mode": compression_mode,
+        "answers": len(total_samples),
+        "errors": errors,
+        "total": summarize(total_samples),
+        "stages": {stage: summarize(samples) for stage, samples in sorted(stage_samples.items())},
+        "llm_calls_per_answer": round(sum(calls) / answered, 2),
+        "summary_calls_per_answer": round(summary_calls / answered, 2),
+        "prompt_tokens_per_answer": round(sum(prompt_tokens) / answered, 1),
+        "completion_tokens_per_answer": round(sum(completion_tokens) / answered, 1),
+        "peak_memory_mb": round(peak_mb, 2),
+    }
+
+
+def wait_for_summaries(histories, timeout=30.0):
+    # background 요약이 끝나야 전체 LLM 호출 수가 확정된다
+    deadline = time.monotonic() + timeout
+    while any(chat_history.summarizing for chat_history in histories) and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+def slowest_imports(stderr, top=10):
+    # python -X importtime 출력에서 누적 시간이 긴 top-level module
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = [part.strip() for part in line[len("import time:"):].split("|")]
+        if cumulative.isdigit() and not name.startswith(" ") and "." not in name:
+            modules.append((int(cumulative), name))
+    return [{"module": name, "cumulative_ms": round(us / 1000, 2)} for us, name in sorted(modules, reverse=True)[:top]]
+
+
+def bench_startup(data_dir, work_dir, run_answer=True):
+    history_dir = os.path.join(work_dir, "startup-histories")
+    command = [sys.executable, "-X", "importtime", "-c", STARTUP_SCRIPT,
+               ",".join(HEAVY_MODULES), "1" if run_answer else "0", data_dir, history_dir]
+    start = time.perf_counter()
+    completed = subprocess.run(command, capture_output=True, text=True)
+    wall_seconds = time.perf_counter() - start
+    if completed.returncode != 0:
+        return {"error": completed.stderr.strip().splitlines()[-1] if completed.stderr.strip() else "failed"}
+
+    report = json.loads(completed.stdout.strip().splitlines()[-1])
+    report = {key: round(value, 4) if isinstance(value, float) else value for key, value in report.items()}
+    report["process_seconds"] = round(wall_seconds, 4)
+    report["slowest_imports"] = slowest_imports(completed.stderr)
+    return report
+
+
+def compare_results(baseline, current, metric="p95_ms"):
+    # 이전 결과 파일과 비교해서 latency 지표가 얼마나 변했는지 (+ 는 느려짐)
+    changes = {}
+
+    def walk(prefix, old, new):
+        if not isinstance(old, dict) or not isinstance(new, dict):
+            return
+        if metric in old and metric in new:
+            changes[prefix] = {"baseline": old[metric], "current": new[metric],
+                               "change_pct": round((new[metric] - old[metric]) / old[metric] * 100, 1) if old[metric] else None}
+            return
+        for key in new:
+            if key in old:
+                walk(f"{prefix}.{key}" if prefix else key, old[key], new[key])
+
+    walk("", baseline.get("results", {}), current.get("results", {}))
+    return changes
+
+
+def run_benchmark(args):
+    embedding = LocalHashEmbeddings(latency=args.embedding_latency, failure_rate=args.embedding_failure_rate, seed=args.seed)
+    questions = load_questions(args.questions, args.intent_examples)
+    work_dir = tempfile.mkdtemp(prefix="chatbot-bench-")
+    results = {}
+    try:
+        collection, results["ingest"] = bench_ingest(args.data_dir, embedding, args.batch_size, args.workers, args.splitter)
+
+        index_dir = os.path.join(work_dir, "numpy-index")
+        build_index_from_collection(index_dir, collection)
+        vector_index = NumpyVectorIndex(index_dir, embedding=embedding)
+        lexical_index = build_manual_index(find_text_files(args.data_dir), data_dir=args.data_dir)
+        retrievers = {
+            "vector": vector_index,
+            "lexical": HybridRetriever(vector_index, lexical_index, mode="lexical"),
+            "hybrid": HybridRetriever(vector_index, lexical_index),
+        }
+        reranker = MMRReranker(embedding)
+        retrievers["hybrid_mmr"] = MMRRetriever(retrievers["hybrid"], reranker)
+        results["retrieval"] = bench_retrieval(retrievers, questions, args.repeat)
+        results["retrieval"]["mmr_tokens"] = reranker.get_stats()
+        results["startup"] = bench_startup(args.data_dir, work_dir, run_answer=not args.skip_answer)
+
+        if not args.skip_answer:
+            llm_kwargs = {
+                "latency": args.llm_latency,
+                "token_latency": args.llm_token_latency,
+                "response_tokens": args.response_tokens,
+                "failure_rate": args.llm_failure_rate,
+                "seed": args.seed,
+            }
+            results["answer"] = bench_answer(
+                retrievers[args.retriever], questions, args.repeat, llm_kwargs,
+                use_async=args.use_async, history_dir=os.path.join(work_dir, "histories"),
+                compression_mode=args.compression,
+            )
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return {
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "baseline")},
+        "questions": len(questions),
+        "results": results,
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="OpenAI 없이 fake backend 로 ingestion / 검색 / 답변 pipeline 성능을 잰다")
+    parser.add_argument("--data-dir", default="./data")
+    parser.add_argument("--questions", default="./eval/retrieval_questions.jsonl")
+    parser.add_argument("--intent-examples", default="./eval/intent_examples.jsonl")
+    parser.add_argument("--skip-answer", action="store_true", help="ingestion / 검색만 잰다 (langchain 불필요)")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--splitter", default="section", choices=["section", "character"])
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--embedding-latency", type=float, default=0.05, help="embedding batch 당 지연(초)")
+    parser.add_argument("--embedding-failure-rate", type=float, default=0.0)
+    parser.add_argument("--llm-latency", type=float, default=0.3, help="LLM 호출 당 첫 token 까지 지연(초)")
+    parser.add_argument("--llm-token-latency", type=float, default=0.005, help="생성 token 당 지연(초)")
+    parser.add_argument("--response-tokens", type=int, default=80)
+    parser.add_argument("--llm-failure-rate", type=float, default=0.0)
+    parser.add_argument("--retriever", default="hybrid_mmr", choices=["vector", "lexical", "hybrid", "hybrid_mmr"])
+    parser.add_argument("--async", dest="use_async", action="store_true")
+    parser.add_argument("--compression", default="local", choices=["local", "llm"], help="검색 결과 관련성 판단 / 요약 방식")
+    parser.add_argument("--output", help="결과 JSON 을 저장할 경로")
+    parser.add_argument("--baseline", help="비교할 이전 결과 JSON")
+    args = parser.parse_args()
+
+    report = run_benchmark(args)
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            report["comparison"] = compare_results(json.load(f), report)
+
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    print(output)
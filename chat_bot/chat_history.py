@@ -1,15 +1,38 @@
 import os
 import json
-import openai
-from langchain.memory import FileChatMessageHistory
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+from history_journal import ConversationJournal, journal_path, parse_lines, split_summary
+from token_counter import count_tokens
+
+logger = logging.getLogger(__name__)
+
+# 요약은 요청 경로 밖에서 처리한다
+summary_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="history-summary")
 
 class ChatHistory():
-    def __init__(self, max_history=10, history_dir = "./chat_histories", conversation_id = "test"):
+    def __init__(self, max_history=10, history_dir = "./chat_histories", conversation_id = "test",
+                 max_history_tokens=1000, summarizer=None, store=None):
         self.conversation_id = conversation_id
         self.history_dir = history_dir
+        # store (SQLiteHistoryStore) 가 있으면 대화별 JSONL 파일 대신 store 에 기록한다
+        self.store = store
         self.history = None
         self.conversation = []
+        self.conversation_tokens = []
+        self.max_history_tokens = max_history_tokens
+        self.summarizer = summarizer
+        self.summary = ""
+        self.folded_messages = []
+        self.summarizing = False
+        self.lock = threading.Lock()
+        # 기록 append 와 summary 의 watermark 계산 순서를 맞춘다
+        self.write_lock = threading.Lock()
         self.role_dict = {"Human": "user", "ai": "assistant"}
+        self.legacy_type_dict = {"human": "Human", "ai": "ai"}
         self.max_history = max_history
         self.initialize()
 
@@ -18,41 +41,143 @@ class ChatHistory():
         self.init_conversation()
         
     def init_history(self):
-        os.makedirs(self.history_dir, exist_ok=True)
-        history_filepath = os.path.join(self.history_dir, f"{self.conversation_id}.json")
-        self.history = FileChatMessageHistory(history_filepath)
+        if self.store is not None:
+            self.history = self.store.journal(self.conversation_id)
+        else:
+            os.makedirs(self.history_dir, exist_ok=True)
+            self.history = ConversationJournal(self.history_dir, self.conversation_id)
+        if not self.history.exists():
+            self.import_legacy_history()
 
-    def init_conversation(self):
-        filepath = os.path.join(self.history_dir, self.conversation_id)
+    def import_legacy_history(self):
+        # store 를 쓰는데 예전 JSONL journal 이 있으면 store 로 한 번만 옮긴다
+        if self.store is not None:
+            file_path = journal_path(self.history_dir, self.conversation_id)
+            if os.path.exists(file_path):
+                with open(file_path, "rb") as f:
+                    self.history.append_many(parse_lines(f.read().splitlines()))
+                return
+        # 예전 FileChatMessageHistory 형식(<id>.json)이 있으면 journal 로 한 번만 옮긴다
+        filepath = os.path.join(self.history_dir, f"{self.conversation_id}.json")
         if not os.path.exists(filepath):
-            conversation_list = []
-        else:
-            with open(filepath, "r") as f:
-                conversation_list = json.load(f)
+            return
+        with open(filepath, "r") as f:
+            conversation_list = json.load(f)
+        self.history.append_many(
+            {"role": self.legacy_type_dict[conv["type"]], "content": conv["data"]["content"]}
+            for conv in conversation_list
+            if conv["type"] in self.legacy_type_dict
+        )
+
+    def init_conversation(self):
+        # 전체 파일이 아니라 끝부분만 읽는다. 가장 최근 요약과 그 요약에 아직 접히지 않은 대화만 불러오고,
+        # 요약이 밀려서 max_history 를 넘는 대화는 다음 turn 에 요약한다
+        summary, turns = split_summary(self.history.read_tail(self.max_history * 2 + 1))
+        if summary is not None:
+            self.summary = summary["content"]
+        for record in turns:
+            self.add_conversation(record["role"], record["content"], summarize=False)
 
-        for conv in conversation_list:
-            self.add_conversation(conv["type"], conv["data"]["content"])
-    
     def add_history(self, role, content):
-        if role=="Human":
-            self.history.add_user_message(content)
-        if role=="ai":
-            self.history.add_ai_message(content)
-
-    def add_conversation(self, role, content):
-        self.conversation.append(
-                {
-                    "role": self.role_dict[role],
-                    "content": content
-                }
-            )
-        self.conversation = self.conversation[-self.max_history:]
+        self.history.append({"role": role, "content": content})
+
+    def truncate_content(self, content, tokens):
+        # 메시지 하나가 budget 보다 크면 앞부분만 남긴다 (글자 수 비율로 근사)
+        keep_chars = max(int(len(content) * self.max_history_tokens / tokens) - 3, 0)
+        return content[:keep_chars] + "..."
+
+    def add_conversation(self, role, content, summarize=True):
+        tokens = count_tokens(content)
+        if self.max_history_tokens and tokens > self.max_history_tokens:
+            content = self.truncate_content(content, tokens)
+            tokens = count_tokens(content)
+
+        with self.lock:
+            self.conversation.append(
+                    {
+                        "role": self.role_dict[role],
+                        "content": content
+                    }
+                )
+            self.conversation_tokens.append(tokens)
+
+            # 개수 또는 token budget 을 넘는 오래된 메시지는 요약 대상으로 넘긴다
+            while len(self.conversation) > 1 and (
+                len(self.conversation) > self.max_history
+                or (self.max_history_tokens and sum(self.conversation_tokens) > self.max_history_tokens)
+            ):
+                self.folded_messages.append(self.conversation.pop(0))
+                self.conversation_tokens.pop(0)
+
+        if not self.summarizer:
+            self.folded_messages = []
+        elif summarize:
+            self.schedule_summary()
+
+    def schedule_summary(self):
+        with self.lock:
+            if not self.summarizer or not self.folded_messages or self.summarizing:
+                return
+            self.summarizing = True
+        summary_executor.submit(self.update_summary)
+
+    def update_summary(self):
+        try:
+            while True:
+                with self.lock:
+                    messages, self.folded_messages = self.folded_messages, []
+                if not messages:
+                    return
+                new_messages = "\n".join(f"{message['role']}: {message['content']}" for message in messages)
+                try:
+                    summary = self.summarizer(self.summary, new_messages)
+                except Exception:
+                    # 실패한 메시지는 다음 turn 에 다시 요약한다
+                    with self.lock:
+                        self.folded_messages = messages + self.folded_messages
+                    raise
+                with self.write_lock:
+                    with self.lock:
+                        self.summary = summary
+                        # 이 기록보다 앞에 쓰였지만 요약에 들어가지 않은 대화 수
+                        kept = len(self.conversation) + len(self.folded_messages)
+                    self.history.append({"role": "summary", "content": summary, "kept": kept})
+        except Exception as e:
+            logger.warning("history summary failed (%s)", e)
+        finally:
+            with self.lock:
+                self.summarizing = False
+
+    def get_prompt_history(self):
+        with self.lock:
+            conversation = list(self.conversation)
+            summary = self.summary
+        if summary:
+            return [{"role": "system", "content": f"summary of earlier conversation: {summary}"}] + conversation
+        return conversation
+
+    def last_user_message(self):
+        with self.lock:
+            for message in reversed(self.conversation):
+                if message["role"] == "user":
+                    return message["content"]
+        return None
+
+    def has_turns(self):
+        with self.lock:
+            return bool(self.conversation or self.summary)
+
+    def count_history_tokens(self):
+        return sum(self.conversation_tokens) + count_tokens(self.summary)
 
     def update_history(self, role="Human", content=""):
-        self.add_history(role, content)
-        self.add_conversation(role, content)
+        with self.write_lock:
+            self.add_history(role, content)
+            self.add_conversation(role, content)
 
     def send_message(self, msg, gpt_model="gpt-3.5-turbo", temperature=0.1):
+        import openai
+
         response = openai.ChatCompletion.create(
             model=gpt_model,
             messages=msg,
@@ -10,12 +10,12 @@ class ChatBotCMD():
     def run(self):
         while True:
             user_input = input("user: ")
-            self.langchain.add_message_log({"role": "user", "content": user_input})
-            
-            response = self.langchain.run()
-            self.langchain.add_message_log({"role": "assistant", "content": response})
-            
-            print("AI: ", response)
+
+            # 답변 token 이 도착하는 대로 바로 출력한다
+            print("AI: ", end="", flush=True)
+            for token in self.langchain.stream_answer(user_input):
+                print(token, end="", flush=True)
+            print()
     
 if __name__ == "__main__":
     db = ChromaDB(data_name="카카오싱크")
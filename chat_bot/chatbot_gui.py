@@ -1,16 +1,90 @@
 import os
+import queue
+import threading
+import contextlib
 import tkinter as tk
 from tkinter import scrolledtext
 
 from database import ChromaDB
 from langchain_openai import LangChain
 
+POLL_INTERVAL_MS = 50
+
+
+class ChatRequest():
+    def __init__(self, user_input):
+        self.user_input = user_input
+        self.cancelled = threading.Event()
+
+
+class ChatWorker(threading.Thread):
+    # Tk main thread 를 막지 않도록 LLM 호출은 worker thread 에서 처리하고, 결과는 ui_queue 로 돌려준다
+    def __init__(self, langchain, ui_queue):
+        super().__init__(daemon=True)
+        self.langchain = langchain
+        self.ui_queue = ui_queue
+        self.request_queue = queue.Queue()
+        self.current = None
+
+    def submit(self, request):
+        self.request_queue.put(request)
+
+    def pending_count(self):
+        return self.request_queue.qsize()
+
+    def cancel(self):
+        # 처리 중인 요청과 대기 중인 요청을 모두 취소한다
+        if self.current is not None:
+            self.current.cancelled.set()
+        while True:
+            try:
+                request = self.request_queue.get_nowait()
+            except queue.Empty:
+                break
+            request.cancelled.set()
+            self.ui_queue.put(("cancelled", request, None))
+
+    def stop(self):
+        self.cancel()
+        self.request_queue.put(None)
+
+    def run(self):
+        while True:
+            request = self.request_queue.get()
+            if request is None:
+                return
+            if request.cancelled.is_set():
+                continue
+
+            self.current = request
+            self.ui_queue.put(("start", request, None))
+            try:
+                # 취소는 token 사이뿐 아니라 intent / 검색 / 압축 단계 사이에서도 확인하고,
+                # 중간에 그만두면 generator 를 바로 닫아서 request stats 를 마무리한다
+                stream = self.langchain.stream_answer(request.user_input, cancelled=request.cancelled)
+                with contextlib.closing(stream):
+                    for token in stream:
+                        if request.cancelled.is_set():
+                            break
+                        self.ui_queue.put(("token", request, token))
+                self.ui_queue.put(("cancelled" if request.cancelled.is_set() else "done", request, None))
+            except Exception as e:
+                self.ui_queue.put(("error", request, str(e)))
+            finally:
+                self.current = None
+
+
 class GUI():
     def __init__(self, langchain):
         self.langchain = langchain
         self.user_entry = None
         self.window = None
         self.conversation = None
+        self.status_label = None
+        self.ui_queue = queue.Queue()
+        self.worker = ChatWorker(langchain, self.ui_queue)
+        self.active_request = None
+        self.answer_started = False
 
     def run(self):
         self.window = tk.Tk()
@@ -24,8 +98,10 @@ class GUI():
         # 태그별로 다르게 배경색 지정하기(3)
         self.conversation.tag_configure("assistant", background="#e4e4e4")
         # 태그별로 다르게 배경색 지정하기(3)
+        self.conversation.tag_configure("system", foreground="#888888")
         self.conversation.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
         # 창의 폭에 맞추어 크기 조정하기(4)
+        self.conversation.config(state=tk.DISABLED)
 
         input_frame = tk.Frame(self.window)  # user_entry와 send_button을 담는 frame(5)
         input_frame.pack(fill=tk.X, padx=10, pady=10)  # 창의 크기에 맞추어 조절하기(5)
@@ -33,72 +109,97 @@ class GUI():
         self.user_entry = tk.Entry(input_frame)
         self.user_entry.pack(fill=tk.X, side=tk.LEFT, expand=True)
 
+        cancel_button = tk.Button(input_frame, text="Cancel", command=self.on_cancel)
+        cancel_button.pack(side=tk.RIGHT)
+
         send_button = tk.Button(input_frame, text="Send", command=self.on_send)
         send_button.pack(side=tk.RIGHT)
 
-        self.window.bind('<Return>', lambda event: self.on_send())
-        self.window.mainloop()
+        # 처리 상태는 팝업 대신 상태 표시줄에 보여주기
+        self.status_label = tk.Label(self.window, text="", anchor=tk.W, font=font)
+        self.status_label.pack(fill=tk.X, padx=10)
 
-        
-    def show_popup_message(self, message):
-        popup = tk.Toplevel(self.window)
-        popup.title("")
-
-        # 팝업 창의 내용
-        label = tk.Label(popup, text=message, font=("맑은 고딕", 12))
-        label.pack(expand=True, fill=tk.BOTH)
-
-        # 팝업 창의 크기 조절하기
-        self.window.update_idletasks()
-        popup_width = label.winfo_reqwidth() + 20
-        popup_height = label.winfo_reqheight() + 20
-        popup.geometry(f"{popup_width}x{popup_height}")
-
-        # 팝업 창의 중앙에 위치하기
-        window_x = self.window.winfo_x()
-        window_y = self.window.winfo_y()
-        window_width = self.window.winfo_width()
-        window_height = self.window.winfo_height()
+        self.window.bind('<Return>', lambda event: self.on_send())
+        self.window.bind('<Escape>', lambda event: self.on_cancel())
+        self.window.protocol("WM_DELETE_WINDOW", self.on_close)
 
-        popup_x = window_x + window_width // 2 - popup_width // 2
-        popup_y = window_y + window_height // 2 - popup_height // 2
-        popup.geometry(f"+{popup_x}+{popup_y}")
+        self.worker.start()
+        self.window.after(POLL_INTERVAL_MS, self.poll_ui_queue)
+        self.window.mainloop()
 
-        popup.transient(self.window)
-        popup.attributes('-topmost', True)
+    def append_text(self, text, tag):
+        self.conversation.config(state=tk.NORMAL)
+        self.conversation.insert(tk.END, text, tag)
+        self.conversation.config(state=tk.DISABLED)
+        # conversation을 수정하지 못하게 설정하기
+        self.conversation.see(tk.END)
 
-        popup.update()
-        return popup
+    def update_status(self, text=None):
+        if text is None:
+            pending = self.worker.pending_count()
+            text = f"대기 중인 메시지 {pending}건" if pending else ""
+        self.status_label.config(text=text)
+
+    def poll_ui_queue(self):
+        # worker thread 가 보낸 이벤트는 반드시 Tk main thread 에서 화면에 반영한다
+        try:
+            while True:
+                event, request, payload = self.ui_queue.get_nowait()
+                self.handle_event(event, request, payload)
+        except queue.Empty:
+            pass
+        self.window.after(POLL_INTERVAL_MS, self.poll_ui_queue)
+
+    def handle_event(self, event, request, payload):
+        if event == "start":
+            self.active_request = request
+            self.answer_started = False
+            self.update_status("처리중...")
+        elif event == "token":
+            if not self.answer_started:
+                self.answer_started = True
+                self.append_text("gpt assistant: ", "assistant")
+            self.append_text(payload, "assistant")
+        elif event == "done":
+            self.append_text("\n", "assistant")
+            self.update_status()
+        elif event == "cancelled":
+            if request is self.active_request and self.answer_started:
+                self.append_text("\n", "assistant")
+                self.answer_started = False
+            self.append_text(f"(취소됨: {request.user_input})\n", "system")
+            self.update_status()
+        elif event == "error":
+            if self.answer_started:
+                self.append_text("\n", "assistant")
+            self.append_text(f"(오류: {payload})\n", "system")
+            self.update_status()
 
     def on_send(self):
         user_input = self.user_entry.get()
         self.user_entry.delete(0, tk.END)
+        if not user_input.strip():
+            return
 
         if user_input.lower() == "quit":
-            self.window.destroy()
+            self.on_close()
             return
 
-        self.langchain.add_message_log({"role": "user", "content": user_input})
-        self.conversation.config(state=tk.NORMAL)  # 이동
-        self.conversation.insert(tk.END, f"You: {user_input}\n", "user")  # 이동
-        thinking_popup = self.show_popup_message("처리중...")
-        self.window.update_idletasks()
-        # '생각 중...' 팝업 창이 반드시 화면에 나타나도록 강제로 설정하기
-        response = self.langchain.run()
-        thinking_popup.destroy()
+        self.append_text(f"You: {user_input}\n", "user")
+        self.worker.submit(ChatRequest(user_input))
+        if self.worker.current is not None:
+            self.update_status()
 
-        self.langchain.add_message_log({"role": "assistant", "content": response})
+    def on_cancel(self):
+        self.worker.cancel()
 
-        # 태그를 추가한 부분(1)
-        self.conversation.insert(tk.END, f"gpt assistant: {response}\n", "assistant")
-        self.conversation.config(state=tk.DISABLED)
-        # conversation을 수정하지 못하게 설정하기
-        self.conversation.see(tk.END)
+    def on_close(self):
+        self.worker.stop()
+        self.window.destroy()
 
-        
 
 if __name__ == "__main__":
     db = ChromaDB(data_name="카카오싱크")
     lc = LangChain(api_key=os.environ["openai_api_key"], db=db)
     gui = GUI(lc)
-    gui.run()
\ No newline at end of file
+    gui.run()
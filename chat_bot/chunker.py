@@ -0,0 +1,198 @@
+import os
+import re
+import json
+import time
+import argparse
+
+import numpy as np
+
+from manual import find_text_files
+from token_counter import count_tokens
+
+STEP_PATTERN = re.compile(r"^\s*\d+\s*[.)]")
+SENTENCE_PATTERN = re.compile(r"(?<=[.!?다요])\s+")
+
+
+class SectionChunker():
+    # "#" 제목, "|" 표, "1." 단계 구조를 따라 자르고, section 안에서만 token 목표치까지 묶는다
+    def __init__(self, target_tokens=200, max_tokens=400, include_heading=True):
+        self.target_tokens = target_tokens
+        self.max_tokens = max_tokens
+        self.include_heading = include_heading
+
+    def parse_sections(self, text):
+        title = ""
+        sections = []
+        for line in text.splitlines():
+            if not line.strip():
+                continue
+            if line.startswith("#"):
+                sections.append((line.replace("#", "").strip(), []))
+            elif sections:
+                sections[-1][1].append(line.strip())
+            elif not title:
+                title = line.strip().rstrip(":")
+        return title, sections
+
+    def parse_blocks(self, lines):
+        # 연속된 표 행은 하나의 표 block, 번호 단계는 다음 단계 전까지 하나의 block, 나머지는 줄 단위 block
+        blocks = []
+        for line in lines:
+            if "|" in line:
+                if blocks and blocks[-1]["kind"] == "table":
+                    blocks[-1]["lines"].append(line)
+                else:
+                    blocks.append({"kind": "table", "lines": [line]})
+            elif STEP_PATTERN.match(line):
+                blocks.append({"kind": "step", "lines": [line]})
+            elif blocks and blocks[-1]["kind"] == "step":
+                blocks[-1]["lines"].append(line)
+            else:
+                blocks.append({"kind": "text", "lines": [line]})
+        return blocks
+
+    def split_block(self, block):
+        text = "\n".join(block["lines"])
+        if count_tokens(text) <= self.max_tokens:
+            return [text]
+
+        if block["kind"] == "table":
+            # 큰 표는 행 단위로 나누고 조각마다 머리행을 다시 붙인다
+            header, rows = block["lines"][0], block["lines"][1:]
+            units = [f"{header}\n{row}" for row in rows]
+        else:
+            units = SENTENCE_PATTERN.split(text)
+        return self.pack(units, self.max_tokens)
+
+    def pack(self, units, limit):
+        packed = []
+        current, current_tokens = [], 0
+        for unit in units:
+            tokens = count_tokens(unit)
+            if current and current_tokens + tokens > limit:
+                packed.append("\n".join(current))
+                current, current_tokens = [], 0
+            current.append(unit)
+            current_tokens += tokens
+        if current:
+            packed.append("\n".join(current))
+        return packed
+
+    def chunk(self, text):
+        title, sections = self.parse_sections(text)
+        chunks = []
+        for section, lines in sections:
+            heading_path = " > ".join(part for part in (title, section) if part)
+            units = []
+            for block in self.parse_blocks(lines):
+                units.extend(self.split_block(block))
+            for index, body in enumerate(self.pack(units, self.target_tokens)):
+                chunk_text = f"[{heading_path}]\n{body}" if self.include_heading else body
+                chunks.append({
+                    "text": chunk_text,
+                    "metadata": {"heading_path": heading_path, "section": section, "chunk_index": index},
+                })
+        return chunks
+
+    def split_text(self, text):
+        return [chunk["text"] for chunk in self.chunk(text)]
+
+
+def get_text_splitter(name="section", **kwargs):
+    if name == "section":
+        return SectionChunker(**kwargs)
+    if name == "character":
+        from langchain.text_splitter import CharacterTextSplitter
+        return CharacterTextSplitter(chunk_size=kwargs.get("chunk_size", 100), chunk_overlap=kwargs.get("chunk_overlap", 20))
+    raise ValueError(f"unknown text splitter: {name}")
+
+
+def split_with_metadata(text_splitter, text):
+    if hasattr(text_splitter, "chunk"):
+        return [(chunk["text"], chunk["metadata"]) for chunk in text_splitter.chunk(text)]
+    # metadata 가 없는 splitter 는 원문 위치로 section 을 찾고, 이웃 chunk 를 합칠 수 있도록 순서를 남긴다
+    chunks = []
+    cursor = 0
+    for index, chunk in enumerate(text_splitter.split_text(text)):
+        section, cursor = locate_section(text, chunk, cursor)
+        metadata = {"chunk_index": index}
+        if section:
+            metadata["section"] = section
+        chunks.append((chunk, metadata))
+    return chunks
+
+
+def locate_section(text, chunk, cursor):
+    # metadata 가 없는 splitter 의 chunk 는 원문 위치로 어느 section 에 속하는지 찾는다
+    position = text.find(chunk, cursor)
+    if position < 0:
+        position = text.find(chunk)
+    heading_start = text.rfind("\n#", 0, max(position, 0) + 1)
+    if position < 0 or heading_start < 0:
+        return None, cursor
+    heading = text[heading_start + 1:text.find("\n", heading_start + 1)]
+    return heading.replace("#", "").strip(), position
+
+
+def compare_chunkers(data_dir, questions_path, embedding, splitter_names=("character", "section"), k=3, batch_size=64):
+    with open(questions_path, "r") as f:
+        questions = [json.loads(line) for line in f if line.strip()]
+    question_vectors = np.asarray(embedding.embed_documents([q["question"] for q in questions]), dtype=np.float32)
+    question_vectors /= np.linalg.norm(question_vectors, axis=1, keepdims=True)
+
+    report = {}
+    for name in splitter_names:
+        text_splitter = get_text_splitter(name)
+        chunks = []
+        for file_path in find_text_files(data_dir):
+            with open(file_path, "r") as f:
+                text = f.read()
+            source = os.path.relpath(file_path, data_dir)
+            cursor = 0
+            for chunk_text, metadata in split_with_metadata(text_splitter, text):
+                section = metadata.get("section")
+                if section is None:
+                    section, cursor = locate_section(text, chunk_text, cursor)
+                chunks.append({"text": chunk_text, "source": source, "section": section})
+
+        start = time.perf_counter()
+        vectors = []
+        for i in range(0, len(chunks), batch_size):
+            vectors.extend(embedding.embed_documents([chunk["text"] for chunk in chunks[i:i + batch_size]]))
+        ingest_seconds = time.perf_counter() - start
+
+        matrix = np.asarray(vectors, dtype=np.float32)
+        matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+        top = np.argsort(-(question_vectors @ matrix.T), axis=1)[:, :k]
+
+        hits = 0
+        prompt_tokens = 0
+        for question, indexes in zip(questions, top):
+            retrieved = [chunks[i] for i in indexes]
+            hits += any(c["source"] == question["source"] and c["section"] == question["section"] for c in retrieved)
+            prompt_tokens += count_tokens("\n".join(c["text"] for c in retrieved))
+
+        report[name] = {
+            "chunks": len(chunks),
+            "chunk_tokens": sum(count_tokens(chunk["text"]) for chunk in chunks),
+            "ingest_seconds": round(ingest_seconds, 3),
+            f"hit_rate@{k}": hits / len(questions),
+            "avg_prompt_tokens": prompt_tokens / len(questions),
+        }
+    return report
+
+
+if __name__ == "__main__":
+    from embeddings import get_embedding_backend
+
+    parser = argparse.ArgumentParser(description="character splitter 와 section chunker 비교")
+    parser.add_argument("--data-dir", default="./data")
+    parser.add_argument("--questions", default="./eval/retrieval_questions.jsonl")
+    parser.add_argument("--backend", default="local", choices=["local", "openai"])
+    parser.add_argument("--latency", type=float, default=0.2, help="local backend 의 batch 당 지연(초)")
+    parser.add_argument("--k", type=int, default=3)
+    args = parser.parse_args()
+
+    backend_kwargs = {"latency": args.latency} if args.backend == "local" else {}
+    embedding = get_embedding_backend(args.backend, **backend_kwargs)
+    print(json.dumps(compare_chunkers(args.data_dir, args.questions, embedding, k=args.k), indent=2, ensure_ascii=False))
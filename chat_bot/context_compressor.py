@@ -0,0 +1,144 @@
+import re
+import json
+import argparse
+
+import numpy as np
+
+from chunker import SENTENCE_PATTERN
+from lexical_index import tokenize
+from token_counter import count_tokens
+
+HEADING_PATTERN = re.compile(r"^\[(.+)\]$")
+
+
+class ExtractiveCompressor():
+    # 검색 결과를 문장 / 표 행 단위로 잘라 질문과의 embedding 유사도 + 글자 n-gram 겹침으로 점수를 매기고,
+    # 점수가 높은 span 만 token 예산 안에서 원래 순서대로 남긴다. LLM 의 관련성 확인 / 요약 chain 을 대신한다
+    def __init__(self, embedding=None, max_tokens=300, min_score=0.15, relevance_threshold=0.3, lexical_weight=0.5):
+        self.embedding = embedding
+        self.max_tokens = max_tokens
+        self.min_score = min_score
+        self.relevance_threshold = relevance_threshold
+        self.lexical_weight = lexical_weight if embedding is not None else 1.0
+
+    def split_spans(self, query_results):
+        spans = []
+        seen = set()
+        heading = None
+        for line in query_results.splitlines():
+            line = line.strip()
+            if not line:
+                continue
+            match = HEADING_PATTERN.match(line)
+            if match:
+                heading = match.group(1)
+                continue
+            # 표 행은 한 행이 한 span, 나머지는 문장 단위
+            parts = [line] if "|" in line else SENTENCE_PATTERN.split(line)
+            for part in parts:
+                part = part.strip()
+                if part and part not in seen:
+                    seen.add(part)
+                    spans.append({"text": part, "heading": heading, "position": len(spans)})
+        return spans
+
+    def lexical_scores(self, query, spans):
+        query_terms = set(tokenize(query))
+        if not query_terms:
+            return np.zeros(len(spans), dtype=np.float32)
+        return np.asarray(
+            [len(query_terms & set(tokenize(span["text"]))) / len(query_terms) for span in spans],
+            dtype=np.float32,
+        )
+
+    def embedding_scores(self, query, spans):
+        vectors = np.asarray(self.embedding.embed_documents([span["text"] for span in spans]), dtype=np.float32)
+        query_vector = np.asarray(self.embedding.embed_query(query), dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1) * (np.linalg.norm(query_vector) or 1.0)
+        norms[norms == 0] = 1.0
+        return np.clip(vectors @ query_vector / norms, 0.0, 1.0)
+
+    def score(self, query, spans):
+        scores = self.lexical_weight * self.lexical_scores(query, spans)
+        if self.lexical_weight < 1.0:
+            scores += (1.0 - self.lexical_weight) * self.embedding_scores(query, spans)
+        return scores
+
+    def compress(self, query, query_results):
+        # 반환값: (has_value, 압축된 text, 상세 정보)
+        spans = self.split_spans(query_results)
+        details = {"spans": len(spans), "selected": 0, "input_tokens": count_tokens(query_results), "output_tokens": 0, "best_score": 0.0}
+        if not spans:
+            return False, "", details
+
+        scores = self.score(query, spans)
+        details["best_score"] = round(float(scores.max()), 4)
+        if details["best_score"] < self.relevance_threshold:
+            return False, "", details
+
+        selected = []
+        budget = self.max_tokens
+        for index in np.argsort(-scores):
+            if scores[index] < self.min_score:
+                break
+            tokens = count_tokens(spans[index]["text"])
+            if tokens > budget:
+                continue
+            selected.append(spans[index])
+            budget -= tokens
+
+        lines = []
+        heading = None
+        for span in sorted(selected, key=lambda span: span["position"]):
+            if span["heading"] and span["heading"] != heading:
+                heading = span["heading"]
+                lines.append(f"[{heading}]")
+            lines.append(span["text"])
+        text = "\n".join(lines)
+        details["selected"] = len(selected)
+        details["output_tokens"] = count_tokens(text)
+        return True, text, details
+
+
+def evaluate(compressor, retriever, questions, negatives):
+    # 관련 질문은 Y, 상관없는 질문은 N 이 나와야 한다
+    report = {"positive_y": 0, "negative_n": 0, "input_tokens": 0, "output_tokens": 0}
+    for question in questions:
+        has_value, _, details = compressor.compress(question, retriever.query_db(question))
+        report["positive_y"] += has_value
+        report["input_tokens"] += details["input_tokens"]
+        report["output_tokens"] += details["output_tokens"]
+    for index, question in enumerate(negatives):
+        # 검색 결과가 비면 판단할 것이 없으므로, 다른 질문의 검색 결과를 대신 넣어 본다
+        context = retriever.query_db(question) or retriever.query_db(questions[index % len(questions)])
+        has_value, _, _ = compressor.compress(question, context)
+        report["negative_n"] += not has_value
+    report["positive_y_rate"] = report["positive_y"] / len(questions) if questions else 0.0
+    report["negative_n_rate"] = report["negative_n"] / len(negatives) if negatives else 0.0
+    report["token_reduction"] = 1 - report["output_tokens"] / report["input_tokens"] if report["input_tokens"] else 0.0
+    return report
+
+
+if __name__ == "__main__":
+    from embeddings import get_embedding_backend
+    from lexical_index import HybridRetriever, build_manual_index
+    from manual import find_text_files
+
+    parser = argparse.ArgumentParser(description="local 추출 압축의 Y/N 판단과 token 감소량 확인")
+    parser.add_argument("--data-dir", default="./data")
+    parser.add_argument("--questions", default="./eval/retrieval_questions.jsonl")
+    parser.add_argument("--backend", default="local", choices=["local", "openai"])
+    parser.add_argument("--max-tokens", type=int, default=300)
+    parser.add_argument("--threshold", type=float, default=0.3)
+    args = parser.parse_args()
+
+    with open(args.questions, "r") as f:
+        questions = [json.loads(line)["question"] for line in f if line.strip()]
+    negatives = ["오늘 점심 메뉴 추천해줘", "주식 시장 전망이 어때?", "파이썬 리스트 정렬하는 법", "날씨 어때"]
+
+    embedding = get_embedding_backend(args.backend)
+    lexical_index = build_manual_index(find_text_files(args.data_dir), data_dir=args.data_dir)
+    retriever = HybridRetriever(None, lexical_index, mode="lexical")
+    for name, compressor_embedding in (("lexical", None), ("lexical+embedding", embedding)):
+        compressor = ExtractiveCompressor(compressor_embedding, max_tokens=args.max_tokens, relevance_threshold=args.threshold)
+        print(name, json.dumps(evaluate(compressor, retriever, questions, negatives), ensure_ascii=False))
@@ -1,23 +1,55 @@
 import os
 import json
-import chromadb
-from collections import defaultdict
 
-from langchain.document_loaders import TextLoader
-from langchain.embeddings.openai import OpenAIEmbeddings
-from langchain.text_splitter import CharacterTextSplitter
-from langchain.vectorstores import Chroma
+from chunker import get_text_splitter
+from embeddings import ChromaEmbeddingFunction, get_embedding_backend
+from ingest_pipeline import IngestPipeline
+from lexical_index import build_manual_index
+from manifest import IngestManifest, WriterLock, hash_file
+from manual import get_manual_dict, find_text_files
+from numpy_index import NumpyVectorIndex, build_index_from_collection
+from product_router import ProductRouter, PartitionStats, product_from_file
+from tracing import log
 
 class ChromaDB():
-    def __init__(self, data_name):
-        self.client = chromadb.PersistentClient()
+    # 모든 제품 매뉴얼을 하나의 collection 에 product / section metadata 와 함께 넣고, 검색은 제품 partition 별로 한다
+    def __init__(self, data_name=None, persist_dir="./chroma", max_distance=0.6, embedding=None, reranker=None):
+        import chromadb
+
+        self.client = chromadb.PersistentClient(path=persist_dir)
+        collection_kwargs = {"embedding_function": ChromaEmbeddingFunction(embedding)} if embedding else {}
         self.collection = self.client.get_or_create_collection(
             name="data",
-            metadata={"hnsw:space": "cosine"}
+            metadata={"hnsw:space": "cosine"},
+            **collection_kwargs,
         )
+        self.manifest = IngestManifest(f"{persist_dir}-manifest.json")
         self.data_dir = "./data"
         self.n_results = 3
-        self.initialize(data_name)
+        # reranker 가 있으면 n_results 대신 reranker.fetch_k 개를 가져와서 MMR 로 고른다
+        self.reranker = reranker
+        self.default_product = data_name
+        self.max_distance = max_distance
+        self.product_router = ProductRouter()
+        self.partition_stats = PartitionStats()
+
+        file_paths = find_text_files(self.data_dir)
+        self.products = [product_from_file(file_path) for file_path in file_paths]
+        # 여러 process 가 같은 persist dir 을 열어도 적재는 lock 을 잡은 하나만 한다
+        with WriterLock(f"{persist_dir}.lock"):
+            # lock 을 기다리는 동안 다른 process 가 적재했을 수 있으므로 manifest 를 다시 읽는다
+            self.manifest.load()
+            if self.collection.count() == 0:
+                # store 가 비어 있으면 manifest 를 믿을 수 없으므로 전체 재적재
+                self.manifest.files = {}
+            for product in self.products:
+                self.initialize(product)
+        self.update_partition_sizes()
+        self.lexical_index = build_manual_index(
+            file_paths,
+            index_path=f"{persist_dir}-lexical.pkl",
+            data_dir=self.data_dir,
+        )
 
     def read_data(self, filename):
         filepath = os.path.join(self.data_dir, filename)
@@ -28,113 +60,236 @@ class ChromaDB():
     def initialize(self, data_name):
         print(f"db initialize - {data_name}")
         filename = f"project_data_{data_name}.txt"
+        file_hash = hash_file(os.path.join(self.data_dir, filename))
+        if self.manifest.is_unchanged(filename, file_hash):
+            print(f"db initialize skipped - {data_name} unchanged")
+            return
+
         lines = self.read_data(filename)
         manual_dict = self.get_manual_dict(lines)
-        self.add_data_to_db(manual_dict)
+        self.add_data_to_db(manual_dict, filename, file_hash, data_name)
+
+    def update_partition_sizes(self):
+        for product in self.products:
+            size = len(self.collection.get(where={"product": product}, include=[])["ids"])
+            self.partition_stats.set_size(product, size)
+        self.partition_stats.set_size("*", self.collection.count())
 
     def get_manual_dict(self, lines):
-        manual_dict = defaultdict(list)
-        manual_key = ""
-        for line in lines:
-            line = line.replace("\n", "")
-            if not line:
-                continue
-
-            if line[0] == "#":
-                manual_key = line.replace("#", "")
-            elif manual_key:
-                manual_dict[manual_key].append(line)
-            else:
-                continue
-
-        for key in manual_dict:
-            manual_dict[key] = "\n".join(manual_dict[key])
-
-        return manual_dict
-
-    def add_data_to_db(self, manual_data):
-        ids = []
-        doc_meta = []
-        docs = []
+        return get_manual_dict(lines)
+
+    def add_data_to_db(self, manual_data, file_key, file_hash, product):
+        sections = {}
         for key, val in manual_data.items():
-            ids.append(key)
-            docs.append(val)
+            chunk_id = self.manifest.chunk_id(file_key, f"{key}\n{val}")
+            sections.setdefault(chunk_id, (key, val))
 
-        self.collection.add(
-            documents=docs,
-            ids=ids,
-        )
+        new_ids, removed_ids = self.manifest.diff(file_key, sections)
+        if removed_ids:
+            self.collection.delete(ids=removed_ids)
+        if new_ids:
+            self.collection.upsert(
+                documents=[sections[chunk_id][1] for chunk_id in new_ids],
+                metadatas=[
+                    {"section": sections[chunk_id][0], "source": file_key, "product": product}
+                    for chunk_id in new_ids
+                ],
+                ids=new_ids,
+            )
+        print(f"db sections added: {len(new_ids)}, removed: {len(removed_ids)}, unchanged: {len(sections) - len(new_ids)}")
+
+        self.manifest.update(file_key, file_hash, sections)
+        self.manifest.save()
 
-    def get_data_from_db(self, query):
-        results = self.collection.query(
+    def search_partition(self, query, k, product=None):
+        include = ["documents", "metadatas", "distances"] + (["embeddings"] if self.reranker else [])
+        results = self.partition_stats.timed(product or "*", lambda: self.collection.query(
             query_texts=[query],
-            n_results=self.n_results,
-        )
-        print(f"db query result: {results}")
+            n_results=k,
+            where={"product": product} if product else None,
+            include=include,
+        ))
+        embeddings = results["embeddings"][0] if self.reranker else None
+        return results["documents"][0], results["metadatas"][0], results["distances"][0], embeddings
+
+    def search(self, query, k=None, product=None):
+        # 제품이 정해지면 그 partition 만 검색하고, 점수가 낮으면 전체 제품으로 다시 검색한다
+        k = k or (self.reranker.fetch_k if self.reranker else self.n_results)
+        product = product or self.product_router.detect(query) or self.default_product
+        results = None
+        if product:
+            results = self.search_partition(query, k, product)
+            if not results[0] or results[2][0] > self.max_distance:
+                self.partition_stats.fallbacks += 1
+                results = None
+        if results is None:
+            results = self.search_partition(query, k)
+        documents, metadatas, _, embeddings = results
+        if self.reranker is None:
+            return documents, metadatas
+
+        candidates = [
+            {"text": document, "metadata": metadata, "vector": embeddings[i]}
+            for i, (document, metadata) in enumerate(zip(documents, metadatas))
+        ]
+        reranked = self.reranker.rerank(query, candidates)
+        return [entry["text"] for entry in reranked], [entry["metadata"] for entry in reranked]
+
+    def search_documents(self, query, k=None, product=None):
+        return self.search(query, k, product)[0]
 
-        ids = results["ids"][0]
-        documents = results["documents"][0]
+    def query_db(self, query, product=None):
+        return "\n".join(self.search_documents(query, product=product))
+
+    def get_data_from_db(self, query, product=None):
+        documents, metadatas = self.search(query, product=product)
+        log(f"db query result: {documents}")
 
         ans_data = {}
-        for i in range(len(ids)):
-            ans_data[ids[i]] = documents[i]
+        for i in range(len(documents)):
+            ans_data[f"{metadatas[i]['product']} - {metadatas[i]['section']}"] = documents[i]
 
-        print("answer dict")
+        log("answer dict")
         for key, val in ans_data.items():
-            print(f"{key}: {val}")
+            log(f"{key}: {val}")
 
         return json.dumps(ans_data)
 
 class VectorDB():
-    def __init__(self, data_dir="./data", upload=True):
+    def __init__(self, data_dir="./data", upload=True, embedding_backend="openai", batch_size=64, max_workers=4,
+                 backend="chroma", text_splitter="section", embedding_cache=True, numpy_index_dir=None, max_distance=0.6):
         self.data_dir = data_dir
+        self.backend = backend
+        self.text_splitter = get_text_splitter(text_splitter)
+        # query / ingestion 모두 같은 embedding cache 를 거친다 (collection 이 달라도 같은 text 는 재사용)
+        self.embedding_cache_path = os.path.join(data_dir, "upload/embedding_cache.sqlite") if embedding_cache else None
+        self.embedding = get_embedding_backend(embedding_backend, cache_path=self.embedding_cache_path)
+        self.batch_size = batch_size
+        self.max_workers = max_workers
         self.chroma_persist_dir = os.path.join(data_dir, "upload/chroma-persist")
         self.chroma_collection_name = "dosu-bot"
+        self.numpy_index_dir = numpy_index_dir or os.path.join(data_dir, "upload/numpy-index")
+        self.manifest = IngestManifest(f"{self.chroma_persist_dir}-manifest.json")
+        self.writer_lock = WriterLock(os.path.join(data_dir, "upload/ingest.lock"))
         self.db = None
+        self.index = None
+        self.lexical_index = None
+        self.product_router = ProductRouter()
+        self.partition_stats = PartitionStats()
+        # 제품 partition 의 가장 가까운 결과가 이 cosine distance 보다 멀면 전체 제품에서 다시 찾는다
+        self.max_distance = max_distance
         self.initialize(upload)
 
     def initialize(self, upload):
+        if self.backend == "numpy":
+            # chroma client 없이 memmap index 만 연다 (index 는 export_numpy_index 로 미리 만들어 둔다)
+            if upload:
+                print("numpy backend is read-only, upload skipped")
+            self.index = NumpyVectorIndex(self.numpy_index_dir, embedding=self.embedding)
+        else:
+            self.initialize_chroma(upload)
+        self.update_partition_sizes()
+        self.lexical_index = build_manual_index(
+            find_text_files(self.data_dir),
+            index_path=f"{self.chroma_persist_dir}-lexical.pkl",
+            data_dir=self.data_dir,
+        )
+
+    def initialize_chroma(self, upload):
+        from langchain.vectorstores import Chroma
+
         self.db = Chroma(
             persist_directory=self.chroma_persist_dir,
-            embedding_function=OpenAIEmbeddings(),
+            embedding_function=self.embedding,
             collection_name=self.chroma_collection_name,
         )
-        if upload:
-            self.upload_embeddings_from_dir()
-
-    def upload_embedding_from_file(self, file_path):
-        loader = TextLoader
-        documents = loader(file_path).load()
+        if not upload:
+            return
+        # worker 여러 개가 같은 persist dir 에 동시에 적재하지 않도록, lock 을 못 잡으면 적재는 건너뛴다
+        if not self.writer_lock.acquire(blocking=False):
+            print("db upload skipped - another process is ingesting")
+            return
+        try:
+            # lock 을 기다리는 동안 다른 process 가 적재했을 수 있으므로 manifest 를 다시 읽는다
+            self.manifest.load()
+            if self.db._collection.count() == 0:
+                self.manifest.files = {}
+            self.bulk_upload_from_dir()
+        finally:
+            self.writer_lock.release()
 
-        text_splitter = CharacterTextSplitter(chunk_size=100, chunk_overlap=20)
-        docs = text_splitter.split_documents(documents)
+    def update_partition_sizes(self):
+        if self.index is not None:
+            for product, rows in self.index.partitions.items():
+                if product is not None:
+                    self.partition_stats.set_size(product, len(rows))
+            self.partition_stats.set_size("*", len(self.index))
+            return
+        collection = self.db._collection
+        for product in set(product_from_file(file_path) for file_path in find_text_files(self.data_dir)):
+            self.partition_stats.set_size(product, len(collection.get(where={"product": product}, include=[])["ids"]))
+        self.partition_stats.set_size("*", collection.count())
 
-        Chroma.from_documents(
-            docs,
-            OpenAIEmbeddings(),
-            collection_name=self.chroma_persist_dir,
-            persist_directory=self.chroma_collection_name,
+    def bulk_upload_from_dir(self):
+        pipeline = IngestPipeline(
+            collection=self.db._collection,
+            embedding=self.embedding,
+            manifest=self.manifest,
+            data_dir=self.data_dir,
+            batch_size=self.batch_size,
+            max_workers=self.max_workers,
+            text_splitter=self.text_splitter,
         )
-        print('db upload success')
-
-    def upload_embeddings_from_dir(self):
-        failed_upload_files = []
-
-        for root, dirs, files in os.walk(self.data_dir):
-            for file in files:
-                if file.endswith(".txt"):
-                    file_path = os.path.join(root, file)
-
-                    try:
-                        self.upload_embedding_from_file(file_path)
-                        print("SUCCESS: ", file_path)
-                    except Exception as e:
-                        print("FAILED: ", file_path + f"by({e})")
-                        failed_upload_files.append(file_path)
-
-    def query_db(self, query, use_retriever=False):
-        docs = self.db.similarity_search(query) if use_retriever else self.db.as_retriever().get_relevant_documents(query)
-        str_docs = "\n".join([doc.page_content for doc in docs])
+        stats = pipeline.run()
+        print(f"db bulk upload - chunks: {stats['chunks']}, {stats['chunks_per_sec']:.1f} chunks/s, {stats['tokens_per_sec']:.1f} tokens/s")
+        for file_key, error in stats["failed_files"].items():
+            print("FAILED: ", file_key + f" by({error})")
+        return stats
+
+    def refresh_index(self):
+        # 다른 process 가 numpy index 를 교체했으면 새 버전을 열어 통째로 바꾼다 (검색 중인 요청은 옛 index 로 끝난다)
+        if self.index is None or not self.index.is_stale():
+            return False
+        self.index = NumpyVectorIndex(self.numpy_index_dir, embedding=self.embedding)
+        self.update_partition_sizes()
+        print(f"numpy index swapped - {self.index.version}")
+        return True
+
+    def export_numpy_index(self, dtype="float32"):
+        return build_index_from_collection(self.numpy_index_dir, self.db._collection, dtype=dtype)
+
+    def search_partition(self, query, k, product=None):
+        # 후보마다 cosine distance 를 붙여서 돌려준다
+        if self.index is not None:
+            search = lambda: [
+                dict(candidate, distance=1.0 - candidate["score"])
+                for candidate in self.index.search_candidates(query, k, product=product)
+            ]
+        else:
+            # langchain Chroma collection 은 l2 (제곱) 거리를 쓰고, 단위 vector 끼리는 l2 제곱 = 2 * cosine distance
+            search = lambda: [
+                {"text": doc.page_content, "metadata": doc.metadata, "distance": distance / 2}
+                for doc, distance in self.db.similarity_search_with_score(
+                    query, k=k, filter={"product": product} if product else None,
+                )
+            ]
+        return self.partition_stats.timed(product or "*", search)
+
+    def search_candidates(self, query, k=4, product=None):
+        # 제품이 정해지면 그 partition 만 찾고, 가장 가까운 결과도 멀면 전체에서 다시 찾는다
+        product = product or self.product_router.detect(query)
+        if product:
+            candidates = self.search_partition(query, k, product)
+            if candidates and candidates[0]["distance"] <= self.max_distance:
+                return candidates
+            self.partition_stats.fallbacks += 1
+        return self.search_partition(query, k)
+
+    def search_documents(self, query, k=4, product=None):
+        return [candidate["text"] for candidate in self.search_candidates(query, k, product)]
+
+    def query_db(self, query, product=None):
+        str_docs = "\n".join(self.search_documents(query, product=product))
 
         return str_docs
     
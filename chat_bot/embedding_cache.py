@@ -0,0 +1,120 @@
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from manifest import hash_text
+
+
+def embedding_model_name(backend):
+    return getattr(backend, "model", None) or type(backend).__name__
+
+
+class CachedEmbeddings():
+    # embedding backend 를 감싸서 (model, text hash) 가 같으면 다시 계산하지 않는다
+    # 1단계: process 안의 LRU, 2단계: SQLite 에 float32 blob 으로 저장 (다른 collection / 재시작 후에도 재사용)
+    def __init__(self, backend, cache_path=None, model=None, max_size=20000, batch_size=500):
+        self.backend = backend
+        self.model = model or embedding_model_name(backend)
+        self.cache_path = cache_path
+        self.max_size = max_size
+        self.batch_size = batch_size
+
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.conn = None
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0}
+
+        self.initialize()
+
+    def initialize(self):
+        if self.cache_path:
+            self.conn = sqlite3.connect(self.cache_path, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB)")
+            self.conn.commit()
+
+    def key(self, text):
+        return hash_text(f"{self.model}\0{text}")
+
+    def remember(self, key, vector):
+        self.entries[key] = vector
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def lookup_many(self, keys):
+        # 반환값: {key: vector}. memory 에 없는 key 는 SQLite 에서 batch 로 찾는다
+        found = {}
+        with self.lock:
+            for key in keys:
+                vector = self.entries.get(key)
+                if vector is not None:
+                    self.entries.move_to_end(key)
+                    found[key] = vector
+            self.stats["memory_hits"] += len(found)
+
+            missing = [key for key in dict.fromkeys(keys) if key not in found]
+            if self.conn and missing:
+                for i in range(0, len(missing), self.batch_size):
+                    batch = missing[i:i + self.batch_size]
+                    rows = self.conn.execute(
+                        f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(batch))})", batch,
+                    ).fetchall()
+                    for key, blob in rows:
+                        vector = np.frombuffer(blob, dtype=np.float32).tolist()
+                        self.remember(key, vector)
+                        found[key] = vector
+                        self.stats["disk_hits"] += 1
+        return found
+
+    def fill_many(self, vectors_by_key):
+        with self.lock:
+            for key, vector in vectors_by_key.items():
+                self.remember(key, vector)
+            if self.conn and vectors_by_key:
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO embeddings VALUES (?, ?)",
+                    [(key, np.asarray(vector, dtype=np.float32).tobytes()) for key, vector in vectors_by_key.items()],
+                )
+                self.conn.commit()
+
+    def embed_documents(self, texts):
+        keys = [self.key(text) for text in texts]
+        found = self.lookup_many(keys)
+
+        # 같은 batch 안의 중복 text 는 한 번만 계산한다
+        missing = {key: text for key, text in zip(keys, texts) if key not in found}
+        if missing:
+            with self.lock:
+                self.stats["misses"] += len(missing)
+            # backend 호출은 lock 밖에서 한다 (ingest worker 들이 동시에 embedding 할 수 있도록)
+            vectors = self.backend.embed_documents(list(missing.values()))
+            computed = dict(zip(missing, vectors))
+            self.fill_many(computed)
+            found.update(computed)
+        return [found[key] for key in keys]
+
+    def embed_query(self, text):
+        key = self.key(text)
+        found = self.lookup_many([key])
+        if key in found:
+            return found[key]
+        with self.lock:
+            self.stats["misses"] += 1
+        vector = self.backend.embed_query(text)
+        self.fill_many({key: vector})
+        return vector
+
+    def get_stats(self):
+        with self.lock:
+            hits = self.stats["memory_hits"] + self.stats["disk_hits"]
+            total = hits + self.stats["misses"]
+            return dict(self.stats, size=len(self.entries), model=self.model, hit_rate=hits / total if total else 0.0)
+
+    def close(self):
+        if self.conn:
+            self.conn.close()
+            self.conn = None
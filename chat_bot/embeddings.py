@@ -0,0 +1,71 @@
+import os
+import math
+import time
+import random
+import hashlib
+
+
+class LocalHashEmbeddings():
+    # 네트워크 없이 benchmark 하기 위한 결정적 embedding (문자 n-gram 을 hashing trick 으로 dim 차원에 투영)
+    def __init__(self, dim=256, ngram=2, latency=0.0, failure_rate=0.0, seed=0):
+        self.dim = dim
+        self.ngram = ngram
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.model = f"local-hash-{dim}-{ngram}"
+        self.random = random.Random(seed)
+        self.calls = 0
+
+    def embed_text(self, text):
+        vector = [0.0] * self.dim
+        text = text.replace(" ", "")
+        for i in range(max(len(text) - self.ngram + 1, 1)):
+            gram = text[i:i + self.ngram]
+            digest = hashlib.md5(gram.encode("utf-8")).digest()
+            bucket = int.from_bytes(digest[:4], "little") % self.dim
+            vector[bucket] += 1.0 if digest[4] & 1 else -1.0
+
+        norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+        return [v / norm for v in vector]
+
+    def embed_documents(self, texts):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if self.failure_rate and self.random.random() < self.failure_rate:
+            raise RuntimeError("simulated embedding failure")
+        return [self.embed_text(text) for text in texts]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+class ChromaEmbeddingFunction():
+    # langchain 형식(embed_documents) backend 를 chromadb collection 의 embedding_function 으로 쓰기 위한 adapter
+    def __init__(self, backend):
+        self.backend = backend
+
+    def __call__(self, input):
+        return self.backend.embed_documents(list(input))
+
+    def embed_query(self, input):
+        return self(input)
+
+    def name(self):
+        return type(self.backend).__name__
+
+
+def get_embedding_backend(name="openai", cache_path=None, **kwargs):
+    if name == "openai":
+        from langchain.embeddings.openai import OpenAIEmbeddings
+        backend = OpenAIEmbeddings(**kwargs)
+    elif name == "local":
+        backend = LocalHashEmbeddings(**kwargs)
+    else:
+        raise ValueError(f"unknown embedding backend: {name}")
+
+    if cache_path:
+        from embedding_cache import CachedEmbeddings
+        os.makedirs(os.path.dirname(cache_path) or ".", exist_ok=True)
+        backend = CachedEmbeddings(backend, cache_path=cache_path)
+    return backend
@@ -0,0 +1,87 @@
+import re
+import time
+import random
+import asyncio
+import threading
+from typing import Any
+
+from langchain.chat_models.base import BaseChatModel
+from langchain.schema import AIMessage, ChatGeneration, ChatResult
+from langchain.schema.messages import AIMessageChunk
+from langchain.schema.output import ChatGenerationChunk
+
+from intent_router import GREETING_PATTERN
+from token_counter import count_tokens
+
+USER_MESSAGE_PATTERN = re.compile(r"User: (.*)\nIntent:")
+WORD_PATTERN = re.compile(r"[0-9A-Za-z가-힣]+")
+
+
+class FakeChatModel(BaseChatModel):
+    # OpenAI 없이 pipeline 을 돌리기 위한 결정적 chat model. prompt 종류를 보고 각 chain 이 기대하는 형식으로 답한다
+    latency: float = 0.3
+    token_latency: float = 0.005
+    response_tokens: int = 80
+    failure_rate: float = 0.0
+    seed: int = 0
+    random: Any = None
+    lock: Any = None
+    stats: dict = {}
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.random = random.Random(self.seed)
+        self.lock = threading.Lock()
+        self.stats = {"calls": 0, "failures": 0, "prompt_tokens": 0, "completion_tokens": 0}
+
+    @property
+    def _llm_type(self):
+        return "fake-chat"
+
+    def respond(self, messages):
+        prompt = "\n".join(message.content for message in messages)
+        with self.lock:
+            self.stats["calls"] += 1
+            self.stats["prompt_tokens"] += count_tokens(prompt)
+            failed = self.failure_rate and self.random.random() < self.failure_rate
+            if failed:
+                self.stats["failures"] += 1
+        if failed:
+            raise RuntimeError("simulated chat model failure")
+
+        if prompt.rstrip().endswith("Intent:"):
+            match = USER_MESSAGE_PATTERN.search(prompt)
+            text = "greeting" if match and GREETING_PATTERN.search(match.group(1)) else "question"
+        elif "<functions>" in prompt:
+            text = "get_data_from_db"
+        elif "You must answer Y or N" in prompt:
+            text = "Y"
+        else:
+            words = WORD_PATTERN.findall(prompt) or ["answer"]
+            text = " ".join(words[i % len(words)] for i in range(self.response_tokens))
+
+        with self.lock:
+            self.stats["completion_tokens"] += count_tokens(text)
+        return text
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        text = self.respond(messages)
+        time.sleep(self.latency + self.token_latency * count_tokens(text))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text))])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        text = self.respond(messages)
+        await asyncio.sleep(self.latency + self.token_latency * count_tokens(text))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text))])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        time.sleep(self.latency)
+        for word in self.respond(messages).split(" "):
+            time.sleep(self.token_latency)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=word + " "))
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        await asyncio.sleep(self.latency)
+        for word in self.respond(messages).split(" "):
+            await asyncio.sleep(self.token_latency)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=word + " "))
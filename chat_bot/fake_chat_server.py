@@ -0,0 +1,98 @@
+import os
+import re
+import json
+import time
+import random
+import asyncio
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+# OpenAI /v1/chat/completions 와 같은 모양으로 답하는 local server (openai.api_base 를 여기로 돌려서 쓴다)
+# 기본 지연 / 실패율은 환경 변수로, 요청별 동작은 마지막 message 안의 지시어로 정한다
+#   latency=1.5   이 요청은 1.5초 뒤에 답한다
+#   fail=2        같은 message 의 처음 2번은 500 으로 실패한다 (fail=100 이면 계속 실패)
+#   hedge=first   같은 message 의 첫 요청만 latency 만큼 늦고, 그 뒤 요청은 바로 답한다
+# tools 가 있고 마지막 message 가 user 이면, message 를 "|" 로 나눈 조각마다 첫 번째 tool 의 호출을 요청한다
+DEFAULT_LATENCY = float(os.environ.get("FAKE_CHAT_LATENCY", "0.2"))
+FAILURE_RATE = float(os.environ.get("FAKE_CHAT_FAILURE_RATE", "0.0"))
+DIRECTIVE_PATTERN = re.compile(r"\b(latency|fail|hedge)=(\S+)")
+
+app = FastAPI()
+app.state.seen = {}
+app.state.stats = {"requests": 0, "failed": 0, "in_flight": 0, "max_in_flight": 0}
+
+
+def parse_directives(message):
+    return dict(DIRECTIVE_PATTERN.findall(message))
+
+
+def completion(model, content, tool_calls=None):
+    message = {"role": "assistant", "content": content}
+    if tool_calls:
+        message["tool_calls"] = tool_calls
+    return {
+        "id": f"chatcmpl-fake-{time.time_ns()}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "message": message, "finish_reason": "tool_calls" if tool_calls else "stop"}],
+        "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+    }
+
+
+def request_tool_calls(body, message):
+    tool_name = body["tools"][0]["function"]["name"]
+    parts = [DIRECTIVE_PATTERN.sub("", part).strip() for part in message.split("|")]
+    return [
+        {"id": f"call_{i}", "type": "function", "function": {"name": tool_name, "arguments": json.dumps({"query": part}, ensure_ascii=False)}}
+        for i, part in enumerate(parts) if part
+    ]
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    message = body["messages"][-1].get("content") or ""
+    directives = parse_directives(message)
+    stats = app.state.stats
+    seen = app.state.seen[message] = app.state.seen.get(message, 0) + 1
+
+    stats["requests"] += 1
+    stats["in_flight"] += 1
+    stats["max_in_flight"] = max(stats["max_in_flight"], stats["in_flight"])
+    try:
+        latency = float(directives.get("latency", DEFAULT_LATENCY))
+        if directives.get("hedge") == "first" and seen > 1:
+            latency = 0.0
+        await asyncio.sleep(latency)
+
+        if seen <= int(directives.get("fail", 0)) or random.random() < FAILURE_RATE:
+            stats["failed"] += 1
+            return JSONResponse(status_code=500, content={"error": {"message": "fake upstream error", "type": "server_error"}})
+        if body.get("tools") and body["messages"][-1]["role"] == "user":
+            return completion(body.get("model", "gpt-3.5-turbo"), None, request_tool_calls(body, message))
+        if body["messages"][-1]["role"] in ("tool", "function"):
+            results = [m for m in body["messages"] if m["role"] in ("tool", "function")]
+            message = f"{len(results)} tool results, {sum(len(m['content']) for m in results)} chars"
+        return completion(body.get("model", "gpt-3.5-turbo"), f"fake answer #{seen}: {message[:50]}")
+    finally:
+        stats["in_flight"] -= 1
+
+
+@app.get("/stats")
+def get_stats():
+    return dict(app.state.stats, prompts=len(app.state.seen))
+
+
+@app.post("/reset")
+def reset():
+    app.state.seen.clear()
+    app.state.stats.update(requests=0, failed=0, in_flight=0, max_in_flight=0)
+    return app.state.stats
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(app, host="127.0.0.1", port=int(os.environ.get("FAKE_CHAT_PORT", "8100")))
@@ -0,0 +1,28 @@
+import gc
+import os
+import time
+
+# gunicorn -c gunicorn.conf.py
+# CHATBOT_PREFORK=1 (기본) 이면 master 가 server 를 import 하면서 numpy index / lexical index / prompt registry 를
+# 한 번 열고, worker 들은 fork 로 그것을 copy-on-write (index 행렬은 memmap 이라 page cache) 로 공유한다
+os.environ.setdefault("CHATBOT_PREFORK", "1")
+os.environ.setdefault("CHATBOT_RETRIEVER_BACKEND", "numpy")
+
+wsgi_app = "server:app"
+bind = os.environ.get("CHATBOT_BIND", "0.0.0.0:8000")
+workers = int(os.environ.get("CHATBOT_WORKERS", "4"))
+worker_class = "uvicorn.workers.UvicornWorker"
+preload_app = os.environ["CHATBOT_PREFORK"] == "1"
+timeout = 120
+graceful_timeout = 30
+
+
+def when_ready(server):
+    # preload 된 객체들을 GC 대상에서 빼서, worker 에서 GC 가 돌 때 공유 page 에 쓰지 (복사되지) 않게 한다
+    if preload_app:
+        gc.collect()
+        gc.freeze()
+
+
+def post_fork(server, worker):
+    os.environ["CHATBOT_WORKER_FORKED_AT"] = str(time.time())
@@ -0,0 +1,197 @@
+import os
+import json
+import time
+import atexit
+import hashlib
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+_dirty_journals = weakref.WeakSet()
+_dirty_lock = threading.Lock()
+_flusher = None
+_compactor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="journal-compactor")
+
+
+def journal_path(history_dir, conversation_id):
+    # 대화 파일이 수천 개여도 한 디렉터리가 커지지 않도록 id hash 앞 2글자로 shard 한다
+    # id 는 파일 이름으로 쓰이므로 history_dir 밖을 가리킬 수 있는 id 는 받지 않는다
+    if conversation_id in ("", ".", "..") or os.path.basename(conversation_id) != conversation_id or "\\" in conversation_id:
+        raise ValueError(f"invalid conversation id: {conversation_id!r}")
+    shard = hashlib.sha1(conversation_id.encode("utf-8")).hexdigest()[:2]
+    return os.path.join(history_dir, shard, f"{conversation_id}.jsonl")
+
+
+def read_tail_lines(file_path, n, block_size=8192):
+    # 파일 끝에서부터 block 단위로 거꾸로 읽어 마지막 n 줄만 가져온다
+    with open(file_path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        position = f.tell()
+        data = b""
+        while position > 0 and data.count(b"\n") <= n:
+            read_size = min(block_size, position)
+            position -= read_size
+            f.seek(position)
+            data = f.read(read_size) + data
+    lines = data.splitlines()
+    if position > 0:
+        # 중간부터 읽었으면 첫 줄은 잘린 줄일 수 있다
+        lines = lines[1:]
+    return lines[-n:] if n else []
+
+
+def parse_lines(lines):
+    records = []
+    for line in lines:
+        try:
+            records.append(json.loads(line))
+        except ValueError:
+            # 비정상 종료로 마지막 줄이 잘린 경우는 건너뛴다
+            continue
+    return records
+
+
+def split_summary(records):
+    # 가장 최근 summary 기록과, 그 요약에 아직 접히지 않은 대화 기록을 돌려준다
+    # summary 기록의 "kept" 는 그 기록보다 앞에 쓰였지만 요약에 포함되지 않은 대화 수 (watermark)
+    for i in range(len(records) - 1, -1, -1):
+        if records[i]["role"] != "summary":
+            continue
+        kept = records[i].get("kept")
+        turns = [record for record in records[:i] if record["role"] != "summary"]
+        if kept is not None:
+            turns = turns[len(turns) - kept:] if kept else []
+        turns += [record for record in records[i + 1:] if record["role"] != "summary"]
+        return records[i], turns
+    return None, records
+
+
+def summary_start(records):
+    # compaction 에서 남겨야 하는 첫 기록의 위치. 그 앞은 summary 에 이미 접혀 있어서 지워도 잃는 것이 없다
+    for i in range(len(records) - 1, -1, -1):
+        if records[i]["role"] != "summary":
+            continue
+        kept = records[i].get("kept")
+        if kept is None:
+            return 0
+        start = i
+        while kept and start > 0:
+            start -= 1
+            if records[start]["role"] != "summary":
+                kept -= 1
+        return start
+    return 0
+
+
+def flush_dirty_journals():
+    with _dirty_lock:
+        journals = list(_dirty_journals)
+        _dirty_journals.clear()
+    for journal in journals:
+        journal.sync()
+
+
+def _flush_loop(interval):
+    while True:
+        time.sleep(interval)
+        flush_dirty_journals()
+
+
+def start_flusher(interval):
+    global _flusher
+    with _dirty_lock:
+        if _flusher is None:
+            _flusher = threading.Thread(target=_flush_loop, args=(interval,), daemon=True, name="journal-flusher")
+            _flusher.start()
+
+
+atexit.register(flush_dirty_journals)
+
+
+class ConversationJournal():
+    # 대화 하나를 append-only JSONL 로 저장한다. fsync 는 fsync_every 건마다 또는 fsync_interval 초마다 묶어서 한다
+    # 파일이 max_bytes 를 넘고 지난 compaction 이후 compact_ratio 배로 커지면 summary 에 접힌 기록을 지운다
+    def __init__(self, history_dir, conversation_id, fsync_every=16, fsync_interval=1.0,
+                 max_bytes=256 * 1024, compact_ratio=2.0):
+        self.conversation_id = conversation_id
+        self.file_path = journal_path(history_dir, conversation_id)
+        self.fsync_every = fsync_every
+        self.max_bytes = max_bytes
+        self.compact_ratio = compact_ratio
+        self.lock = threading.Lock()
+        self.unsynced = 0
+        # 지울 것이 없는 (summary 가 없는) 파일을 append 마다 다시 compact 하지 않도록 마지막 결과 크기를 기억한다
+        self.compacted_size = 0
+        self.compacting = False
+
+        os.makedirs(os.path.dirname(self.file_path), exist_ok=True)
+        start_flusher(fsync_interval)
+
+    def exists(self):
+        return os.path.exists(self.file_path)
+
+    def append(self, record):
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self.lock:
+            with open(self.file_path, "a") as f:
+                f.write(line)
+                f.flush()
+                size = f.tell()
+                self.unsynced += 1
+                if self.unsynced >= self.fsync_every:
+                    os.fsync(f.fileno())
+                    self.unsynced = 0
+
+        if self.unsynced:
+            with _dirty_lock:
+                _dirty_journals.add(self)
+        if self.max_bytes and size >= max(self.max_bytes, self.compacted_size * self.compact_ratio):
+            self.schedule_compaction()
+
+    def append_many(self, records):
+        for record in records:
+            self.append(record)
+
+    def sync(self):
+        with self.lock:
+            if not self.unsynced or not self.exists():
+                return
+            fd = os.open(self.file_path, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            self.unsynced = 0
+
+    def read_tail(self, n):
+        if not self.exists():
+            return []
+        return parse_lines(read_tail_lines(self.file_path, n))
+
+    def schedule_compaction(self):
+        with self.lock:
+            if self.compacting:
+                return
+            self.compacting = True
+        _compactor.submit(self.compact)
+
+    def compact(self):
+        # 마지막 summary 의 watermark 앞 기록 (요약에 이미 접힌 대화) 만 지우고, 잘린 줄을 정리해서 원자적으로 교체한다
+        try:
+            with self.lock:
+                if not self.exists():
+                    return
+                with open(self.file_path, "rb") as f:
+                    records = parse_lines(f.read().splitlines())
+                records = records[summary_start(records):]
+                tmp_path = self.file_path + ".compact"
+                with open(tmp_path, "w") as f:
+                    for record in records:
+                        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.file_path)
+                self.unsynced = 0
+                self.compacted_size = os.path.getsize(self.file_path)
+        finally:
+            self.compacting = False
@@ -0,0 +1,252 @@
+import os
+import time
+import queue
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from chunker import get_text_splitter, split_with_metadata
+from embeddings import get_embedding_backend
+from manifest import hash_file
+from manual import find_text_files
+from product_router import product_from_file
+from token_counter import count_tokens
+
+_DONE = object()
+
+
+class MemoryCollection():
+    # chroma collection 과 같은 upsert/delete/count 인터페이스를 가진 in-memory store (benchmark 용)
+    def __init__(self):
+        self.records = {}
+
+    def upsert(self, ids, embeddings=None, documents=None, metadatas=None):
+        for i, chunk_id in enumerate(ids):
+            self.records[chunk_id] = {
+                "embedding": embeddings[i] if embeddings else None,
+                "document": documents[i] if documents else None,
+                "metadata": metadatas[i] if metadatas else None,
+            }
+
+    def delete(self, ids):
+        for chunk_id in ids:
+            self.records.pop(chunk_id, None)
+
+    def count(self):
+        return len(self.records)
+
+    def get(self, include=None):
+        ids = list(self.records)
+        return {
+            "ids": ids,
+            "embeddings": [self.records[chunk_id]["embedding"] for chunk_id in ids],
+            "documents": [self.records[chunk_id]["document"] for chunk_id in ids],
+            "metadatas": [self.records[chunk_id]["metadata"] for chunk_id in ids],
+        }
+
+
+class IngestPipeline():
+    # producer(chunk 생성) -> embedding worker pool(batch) -> writer(upsert) 가 겹쳐서 동작하는 bulk 적재 pipeline
+    # 파일 하나가 실패해도 나머지는 계속 적재하고, manifest 는 upsert 된 batch 마다 기록한다
+    # (중간에 멈춰도 다음 실행은 이미 올라간 chunk 를 다시 embedding 하지 않는다)
+    def __init__(self, collection, embedding=None, manifest=None, data_dir="./data",
+                 batch_size=64, max_workers=4, max_pending=8, text_splitter=None):
+        self.collection = collection
+        self.embedding = embedding or get_embedding_backend("openai")
+        self.manifest = manifest
+        self.data_dir = data_dir
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.text_splitter = text_splitter or get_text_splitter("section")
+
+        # file_key -> {"hash", "chunks", "pending", "removed", "failed"}: 아직 다 올라가지 않은 파일
+        self.files = {}
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    def split_file(self, file_path):
+        with open(file_path, "r") as f:
+            text = f.read()
+        return split_with_metadata(self.text_splitter, text)
+
+    def read_file(self, file_path, file_key):
+        file_hash = hash_file(file_path)
+        if self.manifest and self.manifest.is_unchanged(file_key, file_hash):
+            return None, None
+        chunks = {}
+        for text, metadata in self.split_file(file_path):
+            chunk_id = self.manifest.chunk_id(file_key, text) if self.manifest else f"{file_key}:{len(chunks)}"
+            chunks.setdefault(chunk_id, (text, dict(metadata, source=file_key, product=product_from_file(file_key))))
+        return file_hash, chunks
+
+    def iter_chunks(self, file_paths):
+        for file_path in file_paths:
+            file_key = os.path.relpath(file_path, self.data_dir)
+            try:
+                file_hash, chunks = self.read_file(file_path, file_key)
+            except Exception as e:
+                self.record_failure(file_key, e)
+                continue
+            if chunks is None:
+                continue
+
+            if self.manifest:
+                new_ids, removed_ids = self.manifest.diff(file_key, chunks)
+                with self.lock:
+                    self.files[file_key] = {"hash": file_hash, "chunks": list(chunks), "pending": set(new_ids),
+                                            "removed": removed_ids, "failed": False}
+                    if not new_ids:
+                        self.finish_file(file_key)
+                        self.manifest.save()
+            else:
+                new_ids = list(chunks)
+
+            for chunk_id in new_ids:
+                yield (chunk_id,) + chunks[chunk_id]
+
+    def record_failure(self, file_key, error):
+        print(f"ingest failed - {file_key} ({type(error).__name__}: {error})")
+        with self.lock:
+            self.stats["failed_files"][file_key] = f"{type(error).__name__}: {error}"
+            # 실패한 파일은 hash 를 기록하지 않아서 다음 실행에 다시 시도한다 (이미 올라간 chunk 는 계속 기록한다)
+            if file_key in self.files:
+                self.files[file_key]["failed"] = True
+
+    def finish_file(self, file_key):
+        # 파일의 새 chunk 가 모두 올라갔으면 없어진 chunk 를 지우고 file hash 까지 기록한다 (self.lock 안에서 부른다)
+        state = self.files.pop(file_key)
+        if state["removed"]:
+            self.collection.delete(ids=state["removed"])
+        self.manifest.update(file_key, state["hash"], state["chunks"])
+
+    def commit_batch(self, batch):
+        if not self.manifest:
+            return
+        with self.lock:
+            committed = {}
+            for chunk_id, _, metadata in batch:
+                committed.setdefault(metadata["source"], []).append(chunk_id)
+            for file_key, chunk_ids in committed.items():
+                state = self.files.get(file_key)
+                if state is None:
+                    continue
+                state["pending"].difference_update(chunk_ids)
+                if not state["pending"] and not state["failed"]:
+                    self.finish_file(file_key)
+                else:
+                    # 일부만 올라간 파일: hash 없이 올라간 chunk 만 기록해 둔다
+                    entry = self.manifest.files.get(file_key, {})
+                    self.manifest.update(file_key, None, list(dict.fromkeys(entry.get("chunks", []) + chunk_ids)))
+            self.manifest.save()
+
+    def produce(self, file_paths, batch_queue):
+        try:
+            batch = []
+            for chunk in self.iter_chunks(file_paths):
+                batch.append(chunk)
+                if len(batch) >= self.batch_size:
+                    batch_queue.put(batch)
+                    batch = []
+            if batch:
+                batch_queue.put(batch)
+        finally:
+            batch_queue.put(_DONE)
+
+    def embed_batch(self, batch):
+        return self.embedding.embed_documents([text for _, text, _ in batch])
+
+    def write(self, write_queue):
+        while True:
+            item = write_queue.get()
+            if item is _DONE:
+                return
+            batch, future = item
+            try:
+                embeddings = future.result()
+                self.collection.upsert(
+                    ids=[chunk_id for chunk_id, _, _ in batch],
+                    embeddings=embeddings,
+                    documents=[text for _, text, _ in batch],
+                    metadatas=[metadata for _, _, metadata in batch],
+                )
+            except Exception as e:
+                # 이 batch 에 chunk 가 있는 파일만 실패로 남기고 다른 batch 는 계속 쓴다
+                for file_key in dict.fromkeys(metadata["source"] for _, _, metadata in batch):
+                    self.record_failure(file_key, e)
+                continue
+            self.commit_batch(batch)
+            self.stats["chunks"] += len(batch)
+            self.stats["tokens"] += sum(count_tokens(text) for _, text, _ in batch)
+            self.stats["batches"] += 1
+
+    def run(self, file_paths=None):
+        file_paths = find_text_files(self.data_dir) if file_paths is None else file_paths
+        self.files = {}
+        self.stats = {"files": len(file_paths), "chunks": 0, "tokens": 0, "batches": 0, "failed_files": {}}
+
+        batch_queue = queue.Queue(maxsize=self.max_pending)
+        write_queue = queue.Queue(maxsize=self.max_pending)
+        producer = threading.Thread(target=self.produce, args=(file_paths, batch_queue), daemon=True)
+        writer = threading.Thread(target=self.write, args=(write_queue,), daemon=True)
+
+        start = time.perf_counter()
+        producer.start()
+        writer.start()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while True:
+                batch = batch_queue.get()
+                if batch is _DONE:
+                    break
+                # write_queue 가 가득 차면 여기서 막히므로 동시에 embedding 중인 batch 수가 제한된다
+                write_queue.put((batch, executor.submit(self.embed_batch, batch)))
+            write_queue.put(_DONE)
+        writer.join()
+        producer.join()
+        self.remove_stale_files(file_paths)
+
+        elapsed = time.perf_counter() - start
+        self.stats["seconds"] = elapsed
+        self.stats["chunks_per_sec"] = self.stats["chunks"] / elapsed if elapsed else 0.0
+        self.stats["tokens_per_sec"] = self.stats["tokens"] / elapsed if elapsed else 0.0
+        return self.stats
+
+    def remove_stale_files(self, file_paths):
+        # data dir 에서 없어진 파일의 chunk 를 지운다
+        if not self.manifest:
+            return
+        present_keys = set(os.path.relpath(file_path, self.data_dir) for file_path in file_paths)
+        stale_files = self.manifest.stale_files(present_keys)
+        for file_key in stale_files:
+            removed_ids = self.manifest.remove(file_key)
+            if removed_ids:
+                self.collection.delete(ids=removed_ids)
+        if stale_files:
+            self.manifest.save()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="bulk embedding ingestion benchmark")
+    parser.add_argument("--data-dir", default="./data")
+    parser.add_argument("--backend", default="local", choices=["local", "openai"])
+    parser.add_argument("--latency", type=float, default=0.0, help="local backend 의 batch 당 지연(초)")
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--splitter", default="section", choices=["section", "character"])
+    parser.add_argument("--embedding-cache", help="embedding cache SQLite 경로 (두 번째 실행부터 재사용)")
+    args = parser.parse_args()
+
+    backend_kwargs = {"latency": args.latency} if args.backend == "local" else {}
+    pipeline = IngestPipeline(
+        collection=MemoryCollection(),
+        embedding=get_embedding_backend(args.backend, cache_path=args.embedding_cache, **backend_kwargs),
+        data_dir=args.data_dir,
+        batch_size=args.batch_size,
+        max_workers=args.workers,
+        text_splitter=get_text_splitter(args.splitter),
+    )
+    stats = pipeline.run()
+    print(f"files: {stats['files']}, chunks: {stats['chunks']}, batches: {stats['batches']}, failed: {len(stats['failed_files'])}")
+    print(f"{stats['seconds']:.2f}s, {stats['chunks_per_sec']:.1f} chunks/s, {stats['tokens_per_sec']:.1f} tokens/s")
+    if hasattr(pipeline.embedding, "get_stats"):
+        print(f"embedding cache: {pipeline.embedding.get_stats()}")
@@ -0,0 +1,200 @@
+import os
+import re
+import sys
+import json
+import time
+import hashlib
+from collections import namedtuple
+
+import numpy as np
+
+from embedding_cache import embedding_model_name
+
+RouteDecision = namedtuple("RouteDecision", ["label", "confidence", "source"])
+
+GREETING_PATTERN = re.compile(
+    r"^\W*(안녕|하이|헬로|hello|hi|hey|반갑|반가워|좋은\s*(아침|하루|저녁)|감사|고마워|고맙|수고|잘\s*지내)",
+    re.IGNORECASE,
+)
+QUESTION_PATTERN = re.compile(
+    r"(\?|어떻게|어떤|방법|뭐야|뭔가|무엇|알려|궁금|설명|가능|있어|있나|하나요|되나요|인가요|how|what|why|where)",
+    re.IGNORECASE,
+)
+PRODUCT_PATTERN = re.compile(
+    r"(카카오\s*싱크|카카오\s*소셜|카카오\s*톡\s*채널|톡\s*채널|채널|싱크|동의\s*항목|약관|로그인|REST\s*API|관리자\s*센터|비즈\s*앱|kakao)",
+    re.IGNORECASE,
+)
+
+# 직전 답변을 다시 다루거나 매뉴얼과 상관없는 잡담이라 문서 검색이 필요 없는 요청
+OFF_TOPIC_PATTERN = re.compile(
+    r"(요약|번역|영어로|다시\s*(말|설명)|짧게|쉽게|방금|날씨|너는\s*누구|넌\s*누구|이름이\s*뭐|농담|심심)",
+    re.IGNORECASE,
+)
+# "그럼 그건?" 처럼 앞 질문을 가리키는 짧은 후속 질문
+FOLLOW_UP_PATTERN = re.compile(r"^\W*(그럼|그러면|그건|그거|그것|그게|이건|이거|저건|거기|그\s*다음|그리고|또)")
+
+
+def load_examples(file_path):
+    with open(file_path, "r") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+class IntentRouter():
+    # 뻔한 경우는 규칙 + 예시 embedding 의 nearest centroid 로 바로 결정하고, 애매할 때만 LLM chain 을 쓴다
+    def __init__(self, embedding=None, examples_path="./eval/intent_examples.jsonl",
+                 centroid_cache_path=None, min_confidence=0.8, greeting_max_length=20, follow_up_max_length=12):
+        self.embedding = embedding
+        self.examples_path = examples_path
+        self.centroid_cache_path = centroid_cache_path
+        self.min_confidence = min_confidence
+        self.greeting_max_length = greeting_max_length
+        self.follow_up_max_length = follow_up_max_length
+        self.centroids = None
+        self.stats = {"local": 0, "fallback": 0}
+
+    def rule_intent(self, text):
+        if PRODUCT_PATTERN.search(text) or QUESTION_PATTERN.search(text):
+            if not GREETING_PATTERN.search(text) or len(text) > self.greeting_max_length:
+                return RouteDecision("question", 0.95, "rule")
+        elif GREETING_PATTERN.search(text) and len(text) <= self.greeting_max_length:
+            return RouteDecision("greeting", 0.95, "rule")
+        return None
+
+    def rule_function(self, text):
+        if PRODUCT_PATTERN.search(text):
+            return RouteDecision("get_data_from_db", 0.95, "rule")
+        if OFF_TOPIC_PATTERN.search(text):
+            return RouteDecision("N", 0.9, "rule")
+        return None
+
+    def is_follow_up(self, text):
+        if GREETING_PATTERN.search(text):
+            return False
+        return bool(FOLLOW_UP_PATTERN.search(text)) or len(text.strip()) <= self.follow_up_max_length
+
+    def embed(self, texts):
+        vectors = np.asarray(self.embedding.embed_documents(texts), dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+    def load_centroids(self, dim):
+        # 예시 파일, embedding model, vector 차원이 모두 같을 때만 저장된 centroid 를 쓴다
+        # (local hash <-> OpenAI 로 backend 를 바꾸면 차원이 달라서 다시 만든다)
+        if self.centroids is not None:
+            return self.centroids
+
+        with open(self.examples_path, "rb") as f:
+            examples_hash = hashlib.sha256(f.read()).hexdigest()
+        cache_key = {"examples_hash": examples_hash, "model": embedding_model_name(self.embedding), "dim": dim}
+
+        if self.centroid_cache_path and os.path.exists(self.centroid_cache_path):
+            with open(self.centroid_cache_path, "r") as f:
+                cached = json.load(f)
+            if all(cached.get(key) == value for key, value in cache_key.items()):
+                self.centroids = {
+                    task: {label: np.asarray(vector, dtype=np.float32) for label, vector in labels.items()}
+                    for task, labels in cached["centroids"].items()
+                }
+                return self.centroids
+
+        examples = load_examples(self.examples_path)
+        vectors = self.embed([example["text"] for example in examples])
+        self.centroids = {}
+        for task in ("intent", "function"):
+            labels = sorted(set(example[task] for example in examples))
+            self.centroids[task] = {}
+            for label in labels:
+                rows = [i for i, example in enumerate(examples) if example[task] == label]
+                centroid = vectors[rows].mean(axis=0)
+                self.centroids[task][label] = centroid / (np.linalg.norm(centroid) or 1.0)
+
+        if self.centroid_cache_path:
+            with open(self.centroid_cache_path, "w") as f:
+                json.dump(dict(cache_key, centroids={
+                    task: {label: vector.tolist() for label, vector in labels.items()}
+                    for task, labels in self.centroids.items()
+                }), f)
+        return self.centroids
+
+    def centroid_decision(self, task, text):
+        if self.embedding is None:
+            return None
+        vector = self.embed([text])[0]
+        centroids = self.load_centroids(len(vector))[task]
+        labels = list(centroids)
+        scores = np.stack([centroids[label] for label in labels]) @ vector
+        order = np.argsort(scores)[::-1]
+        best = order[0]
+        # 1등과 2등 점수 차이를 confidence 로 사용한다 (softmax, temperature 0.05)
+        margin = scores[best] - scores[order[1]] if len(order) > 1 else 1.0
+        confidence = float(1.0 / (1.0 + np.exp(-margin / 0.05)))
+        return RouteDecision(labels[best], confidence, "centroid")
+
+    def decide(self, task, text, last_turn=None):
+        rule = self.rule_intent if task == "intent" else self.rule_function
+        decision = rule(text)
+        if decision is None and last_turn and self.is_follow_up(text):
+            # 짧은 후속 질문은 그 자체로는 판단할 단서가 없어서 직전 사용자 질문과 이어서 본다
+            text = f"{last_turn}\n{text}"
+            decision = rule(text)
+        decision = decision or self.centroid_decision(task, text)
+        if decision is None or decision.confidence < self.min_confidence:
+            self.stats["fallback"] += 1
+            return None
+        self.stats["local"] += 1
+        return decision
+
+    def classify_intent(self, text, last_turn=None):
+        return self.decide("intent", text, last_turn)
+
+    def classify_function(self, text, last_turn=None):
+        return self.decide("function", text, last_turn)
+
+
+def calibrate(router, langchain, examples):
+    # LLM router 와 local router 의 일치율을 labelled 질문 set 에서 비교한다
+    report = {"total": len(examples)}
+    for task, chain, context_key in (
+        ("intent", langchain.intent_chain, "intent_list"),
+        ("function", langchain.function_use_check_chain, None),
+    ):
+        covered = agree = local_correct = llm_correct = 0
+        local_seconds = 0.0
+        for example in examples:
+            context = {"user_message": example["text"], "chat_history": [], "intent_list": langchain.intent_list}
+            llm_label = chain.run(context).strip()
+
+            start = time.perf_counter()
+            decision = router.decide(task, example["text"])
+            local_seconds += time.perf_counter() - start
+
+            llm_correct += llm_label == example[task]
+            if decision is None:
+                continue
+            covered += 1
+            agree += decision.label == llm_label
+            local_correct += decision.label == example[task]
+
+        report[task] = {
+            "coverage": covered / len(examples),
+            "agreement_with_llm": agree / covered if covered else 0.0,
+            "local_accuracy": local_correct / covered if covered else 0.0,
+            "llm_accuracy": llm_correct / len(examples),
+            "local_avg_ms": local_seconds / len(examples) * 1000,
+        }
+    return report
+
+
+if __name__ == "__main__":
+    from database import VectorDB
+    from langchain_openai import LangChain
+
+    vectordb = VectorDB(upload=False)
+    router = IntentRouter(
+        embedding=vectordb.embedding,
+        centroid_cache_path=os.path.join(vectordb.data_dir, "upload/intent_centroids.json"),
+    )
+    lc = LangChain(db=vectordb)
+    examples_path = sys.argv[1] if len(sys.argv) > 1 else router.examples_path
+    print(json.dumps(calibrate(router, lc, load_examples(examples_path)), indent=2, ensure_ascii=False))
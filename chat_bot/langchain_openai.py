@@ -1,122 +1,549 @@
 import os
-import json
-import openai
+import sys
+import time
+import asyncio
+import threading
+import contextvars
 
 from datetime import datetime
 
-from database import VectorDB, ChromaDB
-from langchain.chains import LLMChain
-from langchain.prompts.chat import ChatPromptTemplate
-from langchain.prompts.chat import HumanMessagePromptTemplate
-from langchain.schema import SystemMessage
-from langchain.chat_models import ChatOpenAI
-
+# langchain / openai / chromadb 는 import 가 느려서 처음 쓰는 곳에서 import 한다
 from chat_history import ChatHistory
+from llm_client import LLMClient
+from manifest import hash_text
+from prompt_registry import PROMPT_DIR, get_prompt_registry
+from token_counter import count_tokens
+from tracing import VERBOSE, log, tracer
 
-prompt_dir = "./prompt_template"
-prompt_template = {
-    "intent_list": os.path.join(prompt_dir, "intent_list.txt"),
-    "parse_intent": os.path.join(prompt_dir, "parse_intent.txt"),
-    "default_response": os.path.join(prompt_dir, "default_response.txt"),
-    "question_response": os.path.join(prompt_dir, "question_response.txt"),
-    "qyery_result_check": os.path.join(prompt_dir, "query_result_check.txt"),
-    "query_result_compression": os.path.join(prompt_dir, "query_result_compression.txt"),
-    "function_use_check": os.path.join(prompt_dir, "function_use_check.txt"),
+# chain 이름 -> (template 이름, output key)
+CHAIN_SPECS = {
+    "intent": ("parse_intent", "intent"),
+    "default": ("default_response", "output"),
+    "question": ("question_response", "output"),
+    "query_result_check": ("query_result_check", "output"),
+    "query_result_compression": ("query_result_compression", "output"),
+    "function_use_check": ("function_use_check", "output"),
+    "summary": ("summarize_history", "output"),
 }
-def read_prompt_template(file_path: str) -> str:
-    with open(file_path, "r") as f:
-        prompt_template = f.read()
+# 요청 하나 동안 stage 별 prompt token 수를 모으는 dict (async task / thread 로도 전달된다)
+request_stats = contextvars.ContextVar("request_stats", default=None)
+
+class RequestCancelled(Exception):
+    # 사용자가 취소한 요청을 단계 사이에서 멈출 때 쓴다
+    pass
+
+
+def check_cancelled(cancelled):
+    if cancelled is not None and cancelled.is_set():
+        raise RequestCancelled()
+
+
+def cancel_tasks(*tasks):
+    for task in tasks:
+        if task is not None and not task.done():
+            task.cancel()
+            # 취소된 task 의 예외가 "never retrieved" 경고로 남지 않도록 한다
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
 
-    return prompt_template
 
 class LangChain():
-    def __init__(self, db=None, api_key = os.environ["OPENAI_API_KEY"]):
+    def __init__(self, db=None, api_key=None, answer_cache=None, speculative_compression=True, intent_router=None, llm=None,
+                 prompt_dir=PROMPT_DIR, preload_chains=False, compression_mode="local", compressor=None, llm_client=None,
+                 history_store=None):
         self.db = db
-        self.openai = openai
-        self.openai.api_key = api_key
-        self.llm = ChatOpenAI(temperature=0.1, model="gpt-3.5-turbo")
+        self.intent_router = intent_router
+        self.answer_cache = answer_cache
+        self.speculative_compression = speculative_compression
+        # "local": 추출 압축으로 관련성 판단 + 요약 (LLM 호출 없음), "llm": 기존 check / compression chain
+        self.compression_mode = compression_mode
+        if compressor is None and compression_mode == "local":
+            from context_compressor import ExtractiveCompressor
+            # 검색에 쓰는 embedding 으로 문장 관련도를 같이 본다 (db 에 embedding 이 없으면 lexical 점수만 쓴다)
+            compressor = ExtractiveCompressor(embedding=getattr(db, "embedding", None))
+        self.compressor = compressor
+        self.api_key = api_key or os.environ.get("OPENAI_API_KEY")
+        self.chat_model = llm
+        # chain 호출은 모두 llm_client 를 거친다 (같은 prompt 합치기, deadline, 재시도, circuit breaker)
+        self.llm_client = llm_client or LLMClient()
+        self.prompts = get_prompt_registry(prompt_dir)
+        self.chains = {}
+        self.chain_lock = threading.Lock()
         self.chain = None
+        self.last_request_stats = None
+        # 대화 기록을 저장할 SQLiteHistoryStore (없으면 대화별 JSONL journal)
+        self.history_store = history_store
+        self.default_chat_history = None
 
-        self.initialize()
-    
-    def initialize(self):
-        self.set_chains()
-        self.set_chat_history()
-    
-    def set_chains(self):
-        self.intent_chain = self.create_chain_from_template(prompt_template["parse_intent"], "intent")
-        self.default_chain = self.create_chain_from_template(prompt_template["default_response"], "output")
-        self.question_chain = self.create_chain_from_template(prompt_template["question_response"], "output")
-        self.query_result_check_chain = self.create_chain_from_template(prompt_template["qyery_result_check"], "output")
-        self.query_result_compression_chain = self.create_chain_from_template(prompt_template["query_result_compression"], "output")
-        self.function_use_check_chain = self.create_chain_from_template(prompt_template["function_use_check"], "output")
+        self.initialize(preload_chains)
+
+    def initialize(self, preload_chains=False):
+        self.set_chains(preload_chains)
+
+    def set_chains(self, preload_chains=False):
+        # template 은 registry 에서 이미 검증되었고, chain 은 처음 쓸 때 만든다 (preload_chains 면 지금 전부 만든다)
+        self.intent_list = self.prompts["intent_list"]
+        if preload_chains:
+            for name in CHAIN_SPECS:
+                self.get_chain(name)
+
+    @property
+    def llm(self):
+        if self.chat_model is None:
+            import openai
+            from langchain.chat_models import ChatOpenAI
+
+            openai.api_key = self.api_key
+            # 재시도 / timeout 은 llm_client 가 맡으므로 ChatOpenAI 자체 재시도는 끈다
+            self.chat_model = ChatOpenAI(temperature=0.1, model="gpt-3.5-turbo", openai_api_key=self.api_key,
+                                         request_timeout=self.llm_client.timeout, max_retries=0)
+        return self.chat_model
+
+    def get_chain(self, name):
+        chain = self.chains.get(name)
+        if chain is None:
+            with self.chain_lock:
+                chain = self.chains.get(name)
+                if chain is None:
+                    template_name, output_key = CHAIN_SPECS[name]
+                    chain = self.chains[name] = self.create_chain(template_name, output_key)
+        return chain
+
+    @property
+    def intent_chain(self):
+        return self.get_chain("intent")
+
+    @property
+    def default_chain(self):
+        return self.get_chain("default")
+
+    @property
+    def question_chain(self):
+        return self.get_chain("question")
+
+    @property
+    def query_result_check_chain(self):
+        return self.get_chain("query_result_check")
 
-        self.intent_list = read_prompt_template(prompt_template["intent_list"])
+    @property
+    def query_result_compression_chain(self):
+        return self.get_chain("query_result_compression")
+
+    @property
+    def function_use_check_chain(self):
+        return self.get_chain("function_use_check")
+
+    @property
+    def summary_chain(self):
+        return self.get_chain("summary")
+
+    @property
+    def chat_history(self):
+        # chat_history 를 넘기지 않았을 때 (CLI 처럼 대화가 하나뿐일 때) 쓰는 기본 대화. 처음 쓸 때 만든다
+        if self.default_chat_history is None:
+            self.set_chat_history()
+        return self.default_chat_history
 
     def set_chat_history(self):
         now = datetime.now()
         date_string = now.strftime("%Y%m%d_%H%M%S")
-        self.chat_history = ChatHistory(conversation_id=date_string)
+        self.default_chat_history = self.create_chat_history(conversation_id=date_string)
+
+    def create_chat_history(self, conversation_id, history_dir="./chat_histories"):
+        return ChatHistory(history_dir=history_dir, conversation_id=conversation_id, summarizer=self.summarize_history,
+                           store=self.history_store)
+
+    def summarize_history(self, summary, new_messages):
+        return self.run_chain("summary", self.summary_chain, {"summary": summary, "new_messages": new_messages})
+
+    def start_request_stats(self, name="answer"):
+        stats = {"prompt_tokens": {}, "completion_tokens": 0, "seconds": {}, "llm_calls": 0}
+        stats["trace"] = tracer.start_trace(name)
+        request_stats.set(stats)
+        return stats
+
+    def finish_request_stats(self, stats):
+        stats["total_prompt_tokens"] = sum(stats["prompt_tokens"].values())
+        tracer.finish_trace(stats.pop("trace"), llm_calls=stats["llm_calls"], total_prompt_tokens=stats["total_prompt_tokens"])
+        self.last_request_stats = stats
+        log(f"prompt tokens: {stats['total_prompt_tokens']} {stats['prompt_tokens']}")
+
+    def format_prompt(self, chain, context):
+        return chain.prompt.format(**{key: context.get(key, "") for key in chain.prompt.input_variables})
+
+    def count_prompt_tokens(self, stage, prompt):
+        stats = request_stats.get()
+        if stats is None:
+            return
+        tokens = count_tokens(prompt)
+        stats["prompt_tokens"][stage] = stats["prompt_tokens"].get(stage, 0) + tokens
+        return tokens
+
+    def count_completion_tokens(self, text):
+        tokens = count_tokens(text)
+        stats = request_stats.get()
+        if stats is not None:
+            stats["completion_tokens"] += tokens
+        return tokens
+
+    def record_stage_time(self, stage, start):
+        stats = request_stats.get()
+        if stats is None:
+            return
+        stats["seconds"][stage] = stats["seconds"].get(stage, 0.0) + time.perf_counter() - start
+
+    def record_chain_time(self, stage, start):
+        # history 요약처럼 요청 밖 (summary_executor) 에서 도는 chain 은 request stats 에 잡히지 않는다
+        stats = request_stats.get()
+        if stats is None:
+            return
+        stats["llm_calls"] += 1
+        self.record_stage_time(stage, start)
+
+    def run_chain(self, stage, chain, context):
+        with tracer.span("chain", stage=stage) as span:
+            prompt = self.format_prompt(chain, context)
+            span.set(prompt_tokens=self.count_prompt_tokens(stage, prompt))
+            start = time.perf_counter()
+            try:
+                result = self.llm_client.call(hash_text(prompt), lambda: chain.run(context))
+            finally:
+                self.record_chain_time(stage, start)
+            span.set(completion_tokens=self.count_completion_tokens(result))
+            return result
+
+    async def arun_chain(self, stage, chain, context):
+        with tracer.span("chain", stage=stage) as span:
+            prompt = self.format_prompt(chain, context)
+            span.set(prompt_tokens=self.count_prompt_tokens(stage, prompt))
+            start = time.perf_counter()
+            try:
+                result = await self.llm_client.acall(hash_text(prompt), lambda: chain.arun(context))
+            finally:
+                self.record_chain_time(stage, start)
+            span.set(completion_tokens=self.count_completion_tokens(result))
+            return result
+
+    def query_db(self, user_message):
+        with tracer.span("retrieval") as span:
+            start = time.perf_counter()
+            query_results = self.db.query_db(user_message)
+            self.record_stage_time("retrieval", start)
+            span.set(result_chars=len(query_results))
+            return query_results
+
+    def is_cacheable(self, chat_history):
+        # 답변 cache 는 질문만으로 찾으므로, 앞선 대화가 있어서 답이 문맥에 따라 달라지는 경우는 쓰지 않는다
+        return self.answer_cache is not None and not chat_history.has_turns()
+
+    def lookup_answer(self, user_message, chat_history):
+        if not self.is_cacheable(chat_history):
+            return None, None
+        with tracer.span("answer_cache") as span:
+            answer, question_vector = self.answer_cache.lookup(user_message)
+            span.set(cache="miss" if answer is None else "hit")
+            return answer, question_vector
+
+    def get_prompt_history(self, chat_history):
+        with tracer.span("history_read") as span:
+            prompt_history = chat_history.get_prompt_history()
+            span.set(messages=len(prompt_history))
+            return prompt_history
+
+    def create_chain(self, template_name, output_key):
+        from langchain.chains import LLMChain
+        from langchain.prompts.chat import ChatPromptTemplate
 
-    def create_chain_from_template(self, template_path, output_key):
         chain = LLMChain(
             llm=self.llm,
             prompt=ChatPromptTemplate.from_template(
-                template=read_prompt_template(template_path)
+                template=self.prompts[template_name]
             ),
             output_key=output_key,
-            verbose=True,
+            verbose=VERBOSE,
         )
         return chain
     
-    def get_data_from_db(self, user_message):
+    def route_locally(self, task, user_message, last_turn=None):
+        if not self.intent_router:
+            return None
+        decision = self.intent_router.decide(task, user_message, last_turn)
+        if decision is None:
+            return None
+        log(f"local {task} route: {decision.label} ({decision.source}, {decision.confidence:.2f})")
+        return decision.label
+
+    async def route_async(self, task, user_message, chain, context, last_turn=None):
+        label = await asyncio.to_thread(self.route_locally, task, user_message, last_turn)
+        return label or await self.arun_chain(task, chain, context)
+
+    def compress_locally(self, user_message, query_results):
+        with tracer.span("compression", stage="local_compression") as span:
+            start = time.perf_counter()
+            has_value, compressed, details = self.compressor.compress(user_message, query_results)
+            self.record_stage_time("local_compression", start)
+            span.set(has_value=has_value, input_tokens=details["input_tokens"], output_tokens=details["output_tokens"],
+                     best_score=details["best_score"])
+            log("value: ", "Y" if has_value else "N", details)
+            return compressed
+
+    def get_data_from_db(self, user_message, cancelled=None):
         context = {"user_message": user_message}
-        context["query_results"] = self.db.query_db(user_message)
-        has_value = self.query_result_check_chain.run(context)
-        print("value: ", has_value)
+        context["query_results"] = self.query_db(user_message)
+        check_cancelled(cancelled)
+        if self.compression_mode == "local":
+            return self.compress_locally(user_message, context["query_results"])
+        has_value = self.run_chain("query_result_check", self.query_result_check_chain, context)
+        log("value: ", has_value)
         if has_value == "Y":
-            return self.query_result_compression_chain.run(context)
+            return self.run_chain("query_result_compression", self.query_result_compression_chain, context)
         else:
             return ""
 
-    def generate_answer(self, user_message):
+    def generate_answer(self, user_message, chat_history=None):
+        if chat_history is None:
+            chat_history = self.chat_history
+        stats = self.start_request_stats()
+        try:
+            answer, question_vector = self.lookup_answer(user_message, chat_history)
+
+            if answer is None:
+                chain, context = self.prepare_answer(user_message, chat_history)
+                answer = self.run_chain("answer", chain, context)
+                self.cache_answer(user_message, answer, question_vector, chat_history, chain)
+
+            self.record_turn(chat_history, user_message, answer)
+        finally:
+            self.finish_request_stats(stats)
+        return answer
+
+    def cache_answer(self, user_message, answer, question_vector, chat_history, chain):
+        # 인사 (default chain) 답변은 저장하지 않는다. record_turn 전에 불러야 is_cacheable 이 맞게 나온다
+        if self.is_cacheable(chat_history) and chain is self.question_chain:
+            self.answer_cache.put(user_message, answer, question_vector)
+
+    def record_turn(self, chat_history, user_message, answer):
+        with tracer.span("history_write"):
+            chat_history.update_history(role="Human", content=user_message)
+            chat_history.update_history(role="ai", content=answer)
+
+    def prepare_answer(self, user_message, chat_history, cancelled=None):
+        # 마지막 답변 chain 직전까지 실행하고, 답변 chain 과 context 를 돌려준다
+        # cancelled (threading.Event) 가 켜지면 다음 단계로 넘어가기 전에 RequestCancelled 로 멈춘다
         context = dict(user_message=user_message)
-        context["chat_history"] = self.chat_history.conversation
+        context["chat_history"] = self.get_prompt_history(chat_history)
         context["user_message"] = user_message
 
         context["intent_list"] = self.intent_list
-        intent = self.intent_chain.run(context)
+        last_turn = chat_history.last_user_message()
+        intent = self.route_locally("intent", user_message, last_turn) or self.run_chain("intent", self.intent_chain, context)
 
+        check_cancelled(cancelled)
         if intent == "greeting":
-            answer = self.default_chain.run(context)
+            return self.default_chain, context
         else:
-            function_name = self.function_use_check_chain.run(context)
-            print("function name: ", function_name)
+            function_name = (self.route_locally("function", user_message, last_turn)
+                             or self.run_chain("function", self.function_use_check_chain, context))
+            log("function name: ", function_name)
+            check_cancelled(cancelled)
             if function_name == "get_data_from_db":
-                related_documents = self.get_data_from_db(user_message)
+                related_documents = self.get_data_from_db(user_message, cancelled)
             else:
                 related_documents = ""
+            check_cancelled(cancelled)
 
             context["related_documents"] = related_documents
-            print("related documents")
-            print(context["related_documents"])
-            answer = self.question_chain.run(context)
+            log("related documents")
+            log(context["related_documents"])
+            return self.question_chain, context
+
+    async def get_data_from_db_async(self, user_message, query_results):
+        if self.compression_mode == "local":
+            return await asyncio.to_thread(self.compress_locally, user_message, query_results)
+        context = {"user_message": user_message, "query_results": query_results}
+        check_task = asyncio.create_task(self.arun_chain("query_result_check", self.query_result_check_chain, context))
+        compression_task = None
+        if self.speculative_compression:
+            # 관련성 확인과 요약을 동시에 시작하고, N 이면 요약 결과는 버린다
+            compression_task = asyncio.create_task(self.arun_chain("query_result_compression", self.query_result_compression_chain, context))
+
+        has_value = await check_task
+        log("value: ", has_value)
+        if has_value != "Y":
+            cancel_tasks(compression_task)
+            return ""
+        if compression_task is None:
+            return await self.arun_chain("query_result_compression", self.query_result_compression_chain, context)
+        return await compression_task
+
+    async def prepare_answer_async(self, user_message, chat_history):
+        context = dict(user_message=user_message)
+        context["chat_history"] = self.get_prompt_history(chat_history)
+        context["intent_list"] = self.intent_list
+        last_turn = chat_history.last_user_message()
+
+        # intent 분류, function 사용 여부 확인, vector 검색을 동시에 시작한다
+        intent_task = asyncio.create_task(self.route_async("intent", user_message, self.intent_chain, context, last_turn))
+        function_task = asyncio.create_task(
+            self.route_async("function", user_message, self.function_use_check_chain, context, last_turn)
+        )
+        query_task = asyncio.create_task(asyncio.to_thread(self.query_db, user_message))
 
-        self.chat_history.update_history(role="Human", content=user_message)
-        self.chat_history.update_history(role="ai", content=answer)
+        try:
+            intent = await intent_task
+            if intent == "greeting":
+                cancel_tasks(function_task, query_task)
+                return self.default_chain, context
 
+            function_name = await function_task
+            log("function name: ", function_name)
+            if function_name == "get_data_from_db":
+                query_results = await query_task
+                related_documents = await self.get_data_from_db_async(user_message, query_results)
+            else:
+                cancel_tasks(query_task)
+                related_documents = ""
+        except BaseException:
+            cancel_tasks(intent_task, function_task, query_task)
+            raise
+
+        context["related_documents"] = related_documents
+        log("related documents")
+        log(context["related_documents"])
+        return self.question_chain, context
+
+    async def generate_answer_async(self, user_message, chat_history=None):
+        if chat_history is None:
+            chat_history = self.chat_history
+        stats = self.start_request_stats()
+        try:
+            answer, question_vector = await asyncio.to_thread(self.lookup_answer, user_message, chat_history)
+
+            if answer is None:
+                chain, context = await self.prepare_answer_async(user_message, chat_history)
+                answer = await self.arun_chain("answer", chain, context)
+                self.cache_answer(user_message, answer, question_vector, chat_history, chain)
+
+            self.record_turn(chat_history, user_message, answer)
+        finally:
+            self.finish_request_stats(stats)
         return answer
 
-    def TEST(self):
+    def stream_answer(self, user_message, chat_history=None, timings=None, cancelled=None):
+        # 앞 단계들은 그대로 실행하고, 마지막 답변 chain 의 token 만 도착하는 대로 yield 한다
+        # cancelled 가 켜지면 단계 사이에서 멈추고, 소비자가 중간에 그만둬도 (close) request stats 는 마무리한다
+        if chat_history is None:
+            chat_history = self.chat_history
+        timings = {} if timings is None else timings
+        start = time.perf_counter()
+        stats = self.start_request_stats("stream")
+        try:
+            answer, question_vector = self.lookup_answer(user_message, chat_history)
+
+            if answer is not None:
+                timings["first_token"] = time.perf_counter() - start
+                yield answer
+            else:
+                try:
+                    chain, context = self.prepare_answer(user_message, chat_history, cancelled)
+                except RequestCancelled:
+                    return
+                with tracer.span("chain", stage="answer", streaming=True) as span:
+                    span.set(prompt_tokens=self.count_prompt_tokens("answer", self.format_prompt(chain, context)))
+                    tokens = []
+                    messages = chain.prompt.format_messages(**context)
+                    chain_start = time.perf_counter()
+                    try:
+                        for chunk in self.llm_client.stream(lambda: self.llm.stream(messages)):
+                            if not tokens:
+                                timings["first_token"] = time.perf_counter() - start
+                            tokens.append(chunk.content)
+                            yield chunk.content
+                    finally:
+                        self.record_chain_time("answer", chain_start)
+                    answer = "".join(tokens)
+                    span.set(completion_tokens=self.count_completion_tokens(answer))
+                self.cache_answer(user_message, answer, question_vector, chat_history, chain)
+
+            timings["total"] = time.perf_counter() - start
+            log(f"time to first token: {timings.get('first_token', 0.0):.2f}s, total: {timings['total']:.2f}s")
+            self.record_turn(chat_history, user_message, answer)
+        finally:
+            self.finish_request_stats(stats)
+
+    async def astream_answer(self, user_message, chat_history=None, timings=None):
+        if chat_history is None:
+            chat_history = self.chat_history
+        timings = {} if timings is None else timings
+        start = time.perf_counter()
+        stats = self.start_request_stats("stream")
+        try:
+            answer, question_vector = await asyncio.to_thread(self.lookup_answer, user_message, chat_history)
+
+            if answer is not None:
+                timings["first_token"] = time.perf_counter() - start
+                yield answer
+            else:
+                chain, context = await self.prepare_answer_async(user_message, chat_history)
+                with tracer.span("chain", stage="answer", streaming=True) as span:
+                    span.set(prompt_tokens=self.count_prompt_tokens("answer", self.format_prompt(chain, context)))
+                    tokens = []
+                    messages = chain.prompt.format_messages(**context)
+                    chain_start = time.perf_counter()
+                    try:
+                        async for chunk in self.llm_client.astream(lambda: self.llm.astream(messages)):
+                            if not tokens:
+                                timings["first_token"] = time.perf_counter() - start
+                            tokens.append(chunk.content)
+                            yield chunk.content
+                    finally:
+                        self.record_chain_time("answer", chain_start)
+                    answer = "".join(tokens)
+                    span.set(completion_tokens=self.count_completion_tokens(answer))
+                self.cache_answer(user_message, answer, question_vector, chat_history, chain)
+
+            timings["total"] = time.perf_counter() - start
+            log(f"time to first token: {timings.get('first_token', 0.0):.2f}s, total: {timings['total']:.2f}s")
+            self.record_turn(chat_history, user_message, answer)
+        finally:
+            self.finish_request_stats(stats)
+
+    def TEST(self, use_async=False):
         while True:
             msg = input("user: ")
-            ans = self.generate_answer(msg)
-            print()
-            print("answer")
-            print(ans)
+            if use_async:
+                ans = asyncio.run(self.generate_answer_async(msg))
+                print()
+                print("answer")
+                print(ans)
+            else:
+                print()
+                print("answer")
+                for token in self.stream_answer(msg):
+                    print(token, end="", flush=True)
+                print()
 
 
 if __name__ == "__main__":
+    from answer_cache import AnswerCache
+    from context_compressor import ExtractiveCompressor
+    from database import VectorDB
+    from intent_router import IntentRouter
+    from lexical_index import HybridRetriever
+    from reranker import MMRReranker, MMRRetriever
+
     vectordb = VectorDB(upload=False)
-    lc = LangChain(db=vectordb)
-    lc.TEST()
+    answer_cache = AnswerCache(
+        embedding=vectordb.embedding,
+        corpus=vectordb.chroma_collection_name,
+        data_dir=vectordb.data_dir,
+        persist_path=os.path.join(vectordb.data_dir, "upload/answer_cache.sqlite"),
+    )
+    intent_router = IntentRouter(
+        embedding=vectordb.embedding,
+        centroid_cache_path=os.path.join(vectordb.data_dir, "upload/intent_centroids.json"),
+    )
+    retriever = MMRRetriever(HybridRetriever(vectordb, vectordb.lexical_index), MMRReranker(vectordb.embedding))
+    compressor = ExtractiveCompressor(embedding=vectordb.embedding)
+    lc = LangChain(db=retriever, answer_cache=answer_cache, intent_router=intent_router,
+                   compression_mode="llm" if "--llm-compression" in sys.argv else "local", compressor=compressor)
+    lc.TEST(use_async="--async" in sys.argv)
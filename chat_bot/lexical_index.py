@@ -0,0 +1,210 @@
+import os
+import re
+import math
+import pickle
+import unicodedata
+from array import array
+from collections import Counter, defaultdict
+
+from manifest import hash_file
+from manual import read_manual
+from product_router import ProductRouter, product_from_file
+
+WORD_PATTERN = re.compile(r"[0-9a-z가-힣]+")
+
+
+def tokenize(text, ngram_sizes=(2, 3)):
+    # 한국어는 띄어쓰기/조사가 제각각이라 단어 단위보다 글자 n-gram 이 잘 맞는다
+    text = unicodedata.normalize("NFKC", text).lower()
+    terms = []
+    for word in WORD_PATTERN.findall(text):
+        if len(word) <= min(ngram_sizes):
+            terms.append(word)
+            continue
+        for n in ngram_sizes:
+            terms.extend(word[i:i + n] for i in range(len(word) - n + 1))
+    return terms
+
+
+class LexicalIndex():
+    # 글자 n-gram BM25 inverted index. posting list 는 term 마다 (doc id array, tf array) 로 압축해서 저장한다
+    def __init__(self, ngram_sizes=(2, 3), k1=1.2, b=0.75):
+        self.ngram_sizes = ngram_sizes
+        self.k1 = k1
+        self.b = b
+        self.doc_ids = []
+        self.texts = []
+        self.metadatas = []
+        self.doc_lengths = array("I")
+        self.postings = {}
+        self.idf = {}
+        self.avgdl = 0.0
+        self.source_hashes = {}
+
+    def add(self, doc_id, text, metadata=None):
+        self.doc_ids.append(doc_id)
+        self.texts.append(text)
+        self.metadatas.append(metadata or {})
+
+    def build(self):
+        postings = defaultdict(lambda: (array("I"), array("H")))
+        self.doc_lengths = array("I")
+        for doc_index, text in enumerate(self.texts):
+            terms = Counter(tokenize(text, self.ngram_sizes))
+            self.doc_lengths.append(sum(terms.values()))
+            for term, tf in terms.items():
+                doc_array, tf_array = postings[term]
+                doc_array.append(doc_index)
+                tf_array.append(min(tf, 65535))
+
+        self.postings = dict(postings)
+        n_docs = len(self.texts)
+        self.avgdl = sum(self.doc_lengths) / n_docs if n_docs else 0.0
+        self.idf = {
+            term: math.log(1 + (n_docs - len(doc_array) + 0.5) / (len(doc_array) + 0.5))
+            for term, (doc_array, _) in self.postings.items()
+        }
+
+    def score(self, query):
+        scores = defaultdict(float)
+        query_terms = Counter(tokenize(query, self.ngram_sizes))
+        for term, query_tf in query_terms.items():
+            if term not in self.postings:
+                continue
+            idf = self.idf[term]
+            doc_array, tf_array = self.postings[term]
+            for doc_index, tf in zip(doc_array, tf_array):
+                norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[doc_index] / self.avgdl)
+                scores[doc_index] += query_tf * idf * tf * (self.k1 + 1) / (tf + norm)
+        return scores, query_terms
+
+    def max_score(self, query_terms):
+        # 모든 query term 이 한 문서에 충분히 등장할 때의 점수 상한 (confidence 정규화용)
+        return sum(query_tf * self.idf.get(term, 0.0) * (self.k1 + 1) for term, query_tf in query_terms.items())
+
+    def search(self, query, k=3, product=None):
+        scores, query_terms = self.score(query)
+        if product:
+            scores = {
+                doc_index: score for doc_index, score in scores.items()
+                if product_from_file(self.metadatas[doc_index].get("source", "")) == product
+            }
+        top = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+        max_score = self.max_score(query_terms) or 1.0
+        return [
+            {
+                "id": self.doc_ids[doc_index],
+                "text": self.texts[doc_index],
+                "metadata": self.metadatas[doc_index],
+                "score": score,
+                "normalized_score": score / max_score,
+            }
+            for doc_index, score in top
+        ]
+
+    def is_confident(self, results, min_normalized_score=0.35, min_margin=1.5):
+        # 1등이 충분히 높고 2등과의 차이가 크면 검색 단계에서는 vector 검색 (query embedding) 없이 BM25 결과만 쓴다
+        if not results or results[0]["normalized_score"] < min_normalized_score:
+            return False
+        if len(results) == 1:
+            return True
+        return results[0]["score"] >= results[1]["score"] * min_margin
+
+    def save(self, index_path):
+        tmp_path = f"{index_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(self.__dict__, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, index_path)
+
+    @classmethod
+    def load(cls, index_path):
+        index = cls()
+        with open(index_path, "rb") as f:
+            index.__dict__.update(pickle.load(f))
+        return index
+
+
+def build_manual_index(file_paths, index_path=None, data_dir="./data"):
+    # 매뉴얼 파일들이 바뀌지 않았으면 저장된 index 를 그대로 쓰고, 바뀌었으면 # section 단위로 다시 만든다
+    source_hashes = {os.path.relpath(file_path, data_dir): hash_file(file_path) for file_path in file_paths}
+    if index_path and os.path.exists(index_path):
+        index = LexicalIndex.load(index_path)
+        if index.source_hashes == source_hashes:
+            return index
+
+    index = LexicalIndex()
+    for file_path in file_paths:
+        file_key = os.path.relpath(file_path, data_dir)
+        for section, text in read_manual(file_path).items():
+            index.add(f"{file_key}#{section}", text, {"section": section, "source": file_key})
+    index.build()
+    index.source_hashes = source_hashes
+    if index_path:
+        index.save(index_path)
+    return index
+
+
+class HybridRetriever():
+    # BM25 결과와 vector 검색 결과를 reciprocal rank fusion 으로 합친다
+    # 두 검색의 chunk 경계가 달라도 같은 section 이면 같은 후보로 합치도록 (source, section) 으로 fuse 한다
+    def __init__(self, vector_db, lexical_index, k=3, mode="hybrid", rrf_k=60, product_router=None):
+        self.vector_db = vector_db
+        self.lexical_index = lexical_index
+        self.k = k
+        self.mode = mode
+        self.rrf_k = rrf_k
+        self.product_router = product_router or getattr(vector_db, "product_router", None) or ProductRouter()
+        self.stats = {"lexical_only": 0, "fused": 0, "vector_only": 0, "lexical_fallbacks": 0}
+
+    @property
+    def embedding(self):
+        return getattr(self.vector_db, "embedding", None)
+
+    def search_lexical(self, query, k):
+        # vector 검색과 같이 제품이 정해지면 그 제품 매뉴얼에서만 찾고, 결과가 없으면 전체에서 다시 찾는다
+        product = self.product_router.detect(query)
+        if product:
+            results = self.lexical_index.search(query, k, product=product)
+            if results:
+                return results
+            self.stats["lexical_fallbacks"] += 1
+        return self.lexical_index.search(query, k)
+
+    def fusion_key(self, result):
+        metadata = result.get("metadata") or {}
+        if metadata.get("source") and metadata.get("section"):
+            return (metadata["source"], metadata["section"].strip())
+        return result["text"]
+
+    def search_candidates(self, query, k=None):
+        k = k or self.k
+        lexical_results = self.search_lexical(query, k * 2)
+        if self.mode == "lexical" or (self.mode == "hybrid" and self.lexical_index.is_confident(lexical_results)):
+            self.stats["lexical_only"] += 1
+            return lexical_results[:k]
+
+        vector_results = self.vector_db.search_candidates(query, k * 2)
+        if self.mode == "vector":
+            self.stats["vector_only"] += 1
+            return vector_results[:k]
+
+        self.stats["fused"] += 1
+        fused = defaultdict(float)
+        candidates = {}
+        for ranked_results in (lexical_results, vector_results):
+            seen = set()
+            for result in ranked_results:
+                key = self.fusion_key(result)
+                # 한 section 이 여러 chunk 로 나뉘어 있어도 목록마다 가장 높은 순위 한 번만 센다
+                if key in seen:
+                    continue
+                fused[key] += 1.0 / (self.rrf_k + len(seen) + 1)
+                seen.add(key)
+                candidates.setdefault(key, result)
+        return [candidates[key] for key in sorted(fused, key=fused.get, reverse=True)[:k]]
+
+    def search(self, query):
+        return [candidate["text"] for candidate in self.search_candidates(query, self.k)]
+
+    def query_db(self, query):
+        return "\n".join(self.search(query))
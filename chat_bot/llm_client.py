@@ -0,0 +1,470 @@
+import time
+import queue
+import random
+import asyncio
+import threading
+import contextvars
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+
+from tracing import tracer
+
+# 다시 보내도 결과가 같은 오류 (요청 자체가 잘못된 경우)
+NON_RETRYABLE_ERRORS = {"InvalidRequestError", "AuthenticationError", "PermissionError", "ValueError", "KeyError", "TypeError"}
+
+
+def is_retryable_error(error):
+    # 다시 보내면 될 수 있는 오류인지 (잘못된 요청 / 인증 오류는 같은 결과). circuit 이 열린 것은 upstream 을 부르지도
+    # 않은 것이므로 재시도 대상이 아니라 breaker.retry_after 만큼 기다릴 일이다
+    return not isinstance(error, CircuitOpenError) and type(error).__name__ not in NON_RETRYABLE_ERRORS
+
+
+class LLMTimeoutError(TimeoutError):
+    pass
+
+
+class CircuitOpenError(RuntimeError):
+    pass
+
+
+class CircuitBreaker():
+    # 연속 실패가 failure_threshold 를 넘으면 reset_timeout 동안 바로 실패시키고, 그 뒤 한 번 시험 호출을 허용한다
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def before_call(self):
+        with self.lock:
+            state = self.state
+            if state == "open" or (state == "half_open" and self.probing):
+                raise CircuitOpenError("llm circuit is open")
+            if state == "half_open":
+                self.probing = True
+
+    def retry_after(self):
+        # 다음 시험 호출이 허용될 때까지 남은 시간 (닫혀 있으면 0)
+        with self.lock:
+            if self.opened_at is None:
+                return 0.0
+            return max(0.0, self.reset_timeout - (time.monotonic() - self.opened_at))
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def release(self):
+        # upstream 상태와 상관없는 오류 (잘못된 요청 등): 실패로 세지 않고 half open 시험 호출 자리만 돌려준다
+        with self.lock:
+            self.probing = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.probing = False
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+
+class SingleFlight():
+    # 같은 key 로 진행 중인 호출이 있으면 새로 보내지 않고 그 결과를 같이 기다린다
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.async_calls = {}
+
+    def do(self, key, fn):
+        with self.lock:
+            future = self.calls.get(key)
+            leader = future is None
+            if leader:
+                future = self.calls[key] = Future()
+        if not leader:
+            return False, future.result()
+        try:
+            result = fn()
+            future.set_result(result)
+            return True, result
+        except BaseException as e:
+            future.set_exception(e)
+            # follower 가 없어도 "exception never retrieved" 가 남지 않도록 한 번 읽어 둔다
+            future.exception()
+            raise
+        finally:
+            with self.lock:
+                self.calls.pop(key, None)
+
+    async def ado(self, key, coro_fn):
+        entry = self.async_calls.get(key)
+        leader = entry is None
+        if leader:
+            entry = self.async_calls[key] = {"task": asyncio.ensure_future(coro_fn()), "waiters": 0}
+            entry["task"].add_done_callback(lambda _: self.async_calls.pop(key, None))
+        entry["waiters"] += 1
+        try:
+            # 한 쪽이 취소되어도 공유 중인 호출은 계속되도록 shield 하고, 기다리는 쪽이 모두 취소되면 그때 취소한다
+            return leader, await asyncio.shield(entry["task"])
+        except asyncio.CancelledError:
+            if entry["waiters"] == 1:
+                cancel_pending([entry["task"]])
+            raise
+        finally:
+            entry["waiters"] -= 1
+
+
+def cancel_pending(tasks):
+    for task in tasks:
+        if not task.done():
+            task.cancel()
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+
+class LLMClient():
+    # 모든 LLM 호출이 거치는 층: singleflight -> circuit breaker -> (deadline + hedge) 시도 -> jitter backoff 재시도
+    def __init__(self, timeout=30.0, max_retries=3, base_delay=0.5, max_delay=8.0, hedge_after=None,
+                 breaker=None, max_workers=32, stream_timeout=120.0):
+        self.timeout = timeout
+        # streaming 은 첫 token 을 timeout 초, 전체 답변을 stream_timeout 초 안에 받아야 한다
+        self.stream_timeout = stream_timeout
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        # 첫 시도가 hedge_after 초 안에 안 끝나면 같은 요청을 하나 더 보내고 먼저 끝난 쪽을 쓴다
+        self.hedge_after = hedge_after
+        self.breaker = breaker or CircuitBreaker()
+        self.singleflight = SingleFlight()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="llm-client")
+        self.lock = threading.Lock()
+        self.stats = {"calls": 0, "upstream": 0, "coalesced": 0, "retried": 0, "hedged": 0,
+                      "timed_out": 0, "failed": 0, "rejected": 0}
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.stats[name] += value
+        tracer.metrics.inc(f"chatbot_llm_{name}_total", value)
+
+    def backoff(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def is_retryable(self, error):
+        return is_retryable_error(error)
+
+    def record_error(self, error):
+        # timeout / 연결 오류 / 5xx 처럼 다시 보내면 될 수 있는 오류만 circuit 을 여는 실패로 센다
+        # (잘못된 요청이나 인증 오류는 provider 가 멀쩡해도 나므로 다른 요청까지 막으면 안 된다)
+        if self.is_retryable(error):
+            self.breaker.record_failure()
+        else:
+            self.breaker.release()
+
+    def submit(self, fn):
+        # worker thread 에서도 tracing / request_stats context 가 보이도록 context 를 복사해서 실행한다
+        self.count("upstream")
+        return self.executor.submit(contextvars.copy_context().run, fn)
+
+    def attempt(self, fn):
+        deadline = time.monotonic() + self.timeout
+        futures = [self.submit(fn)]
+        if self.hedge_after and self.hedge_after < self.timeout:
+            done, _ = wait(futures, timeout=self.hedge_after)
+            if not done:
+                self.count("hedged")
+                futures.append(self.submit(fn))
+
+        error = None
+        while futures:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            done, pending = wait(futures, timeout=remaining, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                error = future.exception()
+            futures = list(pending)
+        if futures or error is None:
+            # 끝나지 않은 호출은 thread 에 남지만 결과는 버린다
+            self.count("timed_out")
+            raise LLMTimeoutError(f"llm call exceeded {self.timeout}s")
+        raise error
+
+    def call_with_retries(self, fn):
+        for attempt in range(self.max_retries + 1):
+            try:
+                self.breaker.before_call()
+            except CircuitOpenError:
+                self.count("rejected")
+                raise
+            try:
+                result = self.attempt(fn)
+            except Exception as e:
+                self.record_error(e)
+                if attempt == self.max_retries or not self.is_retryable(e):
+                    self.count("failed")
+                    raise
+                self.count("retried")
+                time.sleep(self.backoff(attempt))
+                continue
+            self.breaker.record_success()
+            return result
+
+    def call(self, key, fn):
+        # key 는 prompt 전체의 hash. 같은 prompt 가 동시에 들어오면 upstream 호출은 한 번만 한다
+        self.count("calls")
+        leader, result = self.singleflight.do(key, lambda: self.call_with_retries(fn))
+        if not leader:
+            self.count("coalesced")
+        return result
+
+    async def aattempt(self, coro_fn):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.timeout
+        self.count("upstream")
+        tasks = [asyncio.ensure_future(coro_fn())]
+        try:
+            if self.hedge_after and self.hedge_after < self.timeout:
+                done, _ = await asyncio.wait(tasks, timeout=self.hedge_after)
+                if not done:
+                    self.count("hedged")
+                    self.count("upstream")
+                    tasks.append(asyncio.ensure_future(coro_fn()))
+
+            error = None
+            while tasks:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                done, pending = await asyncio.wait(tasks, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+                tasks = list(pending)
+            if tasks or error is None:
+                self.count("timed_out")
+                raise LLMTimeoutError(f"llm call exceeded {self.timeout}s")
+            raise error
+        finally:
+            cancel_pending(tasks)
+
+    async def acall_with_retries(self, coro_fn):
+        for attempt in range(self.max_retries + 1):
+            try:
+                self.breaker.before_call()
+            except CircuitOpenError:
+                self.count("rejected")
+                raise
+            try:
+                result = await self.aattempt(coro_fn)
+            except Exception as e:
+                self.record_error(e)
+                if attempt == self.max_retries or not self.is_retryable(e):
+                    self.count("failed")
+                    raise
+                self.count("retried")
+                await asyncio.sleep(self.backoff(attempt))
+                continue
+            self.breaker.record_success()
+            return result
+
+    async def acall(self, key, coro_fn):
+        self.count("calls")
+        leader, result = await self.singleflight.ado(key, lambda: self.acall_with_retries(coro_fn))
+        if not leader:
+            self.count("coalesced")
+        return result
+
+    def stream_attempt(self, iterator_fn):
+        # upstream iterator 는 worker thread 에서 돌리고 queue 로 받아서, 응답이 멈춰 있어도 deadline 에 끊는다
+        chunks = queue.Queue()
+        stop = threading.Event()
+
+        def produce():
+            try:
+                for chunk in iterator_fn():
+                    if stop.is_set():
+                        return
+                    chunks.put((True, chunk))
+                chunks.put((False, None))
+            except BaseException as e:
+                chunks.put((False, e))
+
+        self.submit(produce)
+        start = time.monotonic()
+        received = False
+        try:
+            while True:
+                deadline = start + (self.stream_timeout if received else min(self.timeout, self.stream_timeout))
+                try:
+                    is_chunk, value = chunks.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    self.count("timed_out")
+                    raise LLMTimeoutError(f"llm stream exceeded {'stream_timeout' if received else 'first token'} deadline")
+                if not is_chunk:
+                    if value is not None:
+                        raise value
+                    return
+                received = True
+                yield value
+        finally:
+            stop.set()
+
+    async def astream_attempt(self, iterator_fn):
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        self.count("upstream")
+        iterator = iterator_fn().__aiter__()
+        received = False
+        try:
+            while True:
+                deadline = start + (self.stream_timeout if received else min(self.timeout, self.stream_timeout))
+                try:
+                    chunk = await asyncio.wait_for(iterator.__anext__(), timeout=max(deadline - loop.time(), 0))
+                except StopAsyncIteration:
+                    return
+                except asyncio.TimeoutError:
+                    self.count("timed_out")
+                    raise LLMTimeoutError(f"llm stream exceeded {'stream_timeout' if received else 'first token'} deadline")
+                received = True
+                yield chunk
+        finally:
+            if hasattr(iterator, "aclose"):
+                await iterator.aclose()
+
+    def finish_stream(self, started):
+        # 소비자가 중간에 그만둔 것은 upstream 실패가 아니다
+        if started:
+            self.breaker.record_success()
+        else:
+            self.breaker.release()
+
+    def stream(self, iterator_fn):
+        # 답변 token streaming 입구: circuit breaker 와 첫 token / 전체 deadline 을 적용한다
+        # 이미 내보낸 token 을 되돌릴 수 없으므로 첫 token 전의 실패만 재시도하고, singleflight / hedge 는 하지 않는다
+        self.count("calls")
+        for attempt in range(self.max_retries + 1):
+            try:
+                self.breaker.before_call()
+            except CircuitOpenError:
+                self.count("rejected")
+                raise
+            started = False
+            attempt_chunks = self.stream_attempt(iterator_fn)
+            try:
+                for chunk in attempt_chunks:
+                    started = True
+                    yield chunk
+            except GeneratorExit:
+                attempt_chunks.close()
+                self.finish_stream(started)
+                raise
+            except Exception as e:
+                self.record_error(e)
+                if started or attempt == self.max_retries or not self.is_retryable(e):
+                    self.count("failed")
+                    raise
+                self.count("retried")
+                time.sleep(self.backoff(attempt))
+                continue
+            self.breaker.record_success()
+            return
+
+    async def astream(self, iterator_fn):
+        self.count("calls")
+        for attempt in range(self.max_retries + 1):
+            try:
+                self.breaker.before_call()
+            except CircuitOpenError:
+                self.count("rejected")
+                raise
+            started = False
+            attempt_chunks = self.astream_attempt(iterator_fn)
+            try:
+                async for chunk in attempt_chunks:
+                    started = True
+                    yield chunk
+            except (GeneratorExit, asyncio.CancelledError):
+                await attempt_chunks.aclose()
+                self.finish_stream(started)
+                raise
+            except Exception as e:
+                self.record_error(e)
+                if started or attempt == self.max_retries or not self.is_retryable(e):
+                    self.count("failed")
+                    raise
+                self.count("retried")
+                await asyncio.sleep(self.backoff(attempt))
+                continue
+            self.breaker.record_success()
+            return
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats, circuit=self.breaker.state)
+
+
+def run_scenarios(api_base):
+    # fake chat server 에 openai client 로 붙어서 coalescing / timeout / retry / circuit breaker 를 확인한다
+    import openai
+    from manifest import hash_text
+
+    def create(message):
+        return openai.ChatCompletion.create(
+            model="gpt-3.5-turbo", messages=[{"role": "user", "content": message}],
+            api_base=api_base, api_key="fake", request_timeout=30,
+        )["choices"][0]["message"]["content"]
+
+    def burst(client, message, n):
+        with ThreadPoolExecutor(max_workers=n) as pool:
+            futures = [pool.submit(client.call, hash_text(message), lambda: create(message)) for _ in range(n)]
+            return [future.exception() or future.result() for future in futures]
+
+    reports = {}
+    client = LLMClient(timeout=5.0)
+    burst(client, "latency=0.3 카카오싱크 공지 질문", 20)
+    reports["coalescing"] = client.get_stats()
+
+    client = LLMClient(timeout=0.5, max_retries=1, base_delay=0.05)
+    burst(client, "latency=2.0 느린 응답", 1)
+    reports["timeout"] = client.get_stats()
+
+    client = LLMClient(timeout=5.0, hedge_after=0.3, max_retries=0)
+    burst(client, "latency=1.0 hedge=first 첫 시도만 느림", 1)
+    reports["hedge"] = client.get_stats()
+
+    client = LLMClient(timeout=5.0, max_retries=3, base_delay=0.05)
+    burst(client, "fail=2 두 번 실패 후 성공", 1)
+    reports["retry"] = client.get_stats()
+
+    client = LLMClient(timeout=5.0, max_retries=0, breaker=CircuitBreaker(failure_threshold=3, reset_timeout=60))
+    for i in range(6):
+        burst(client, f"fail=100 계속 실패 {i}", 1)
+    reports["circuit_breaker"] = client.get_stats()
+    return reports
+
+
+if __name__ == "__main__":
+    import json
+    import uvicorn
+
+    from fake_chat_server import app
+
+    port = 8765
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    print(json.dumps(run_scenarios(f"http://127.0.0.1:{port}/v1"), indent=2))
+    server.should_exit = True
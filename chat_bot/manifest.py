@@ -0,0 +1,107 @@
+import os
+import json
+import fcntl
+import hashlib
+
+# chunk id 나 metadata 구성이 바뀌면 올린다. 버전이 다르면 기존 chunk 를 모두 지우고 다시 적재한다
+SCHEMA_VERSION = 2
+
+
+def hash_text(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def hash_file(file_path):
+    sha = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 16), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+
+class WriterLock():
+    # 여러 process (gunicorn worker, 적재 script) 중 하나만 적재 / index 교체를 하도록 하는 파일 lock
+    # flock 은 process 가 죽으면 자동으로 풀린다
+    def __init__(self, lock_path):
+        self.lock_path = lock_path
+        self.file = None
+
+    def acquire(self, blocking=True):
+        os.makedirs(os.path.dirname(self.lock_path) or ".", exist_ok=True)
+        self.file = open(self.lock_path, "a")
+        try:
+            fcntl.flock(self.file, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            self.file.close()
+            self.file = None
+            return False
+        return True
+
+    def release(self):
+        if self.file is not None:
+            fcntl.flock(self.file, fcntl.LOCK_UN)
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class IngestManifest():
+    # 파일별 / chunk별 content hash 를 기록해서 바뀐 chunk 만 다시 embedding 하기 위한 manifest
+    def __init__(self, manifest_path):
+        self.manifest_path = manifest_path
+        self.files = {}
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.manifest_path):
+            return
+        try:
+            with open(self.manifest_path, "r") as f:
+                manifest = json.load(f)
+            self.files = manifest.get("files", {})
+            if manifest.get("version") != SCHEMA_VERSION:
+                # chunk 목록은 삭제용으로 남겨두고 file hash 만 무효화한다
+                for entry in self.files.values():
+                    entry["hash"] = None
+        except (OSError, ValueError) as e:
+            print(f"manifest load failed, full re-ingest ({e})")
+            self.files = {}
+
+    def save(self):
+        manifest_dir = os.path.dirname(self.manifest_path)
+        if manifest_dir:
+            os.makedirs(manifest_dir, exist_ok=True)
+        tmp_path = f"{self.manifest_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"version": SCHEMA_VERSION, "files": self.files}, f, ensure_ascii=False)
+        os.replace(tmp_path, self.manifest_path)
+
+    def is_unchanged(self, file_key, file_hash):
+        entry = self.files.get(file_key)
+        return entry is not None and entry["hash"] == file_hash
+
+    def chunk_id(self, file_key, text):
+        return hash_text(f"{SCHEMA_VERSION}\0{file_key}\0{text}")
+
+    def diff(self, file_key, chunk_ids):
+        old_ids = set(self.files.get(file_key, {}).get("chunks", []))
+        new_ids = [chunk_id for chunk_id in chunk_ids if chunk_id not in old_ids]
+        removed_ids = list(old_ids.difference(chunk_ids))
+        return new_ids, removed_ids
+
+    def update(self, file_key, file_hash, chunk_ids):
+        self.files[file_key] = {"hash": file_hash, "chunks": list(chunk_ids)}
+
+    def remove(self, file_key):
+        entry = self.files.pop(file_key, None)
+        return entry["chunks"] if entry else []
+
+    def stale_files(self, present_keys):
+        return [key for key in self.files if key not in present_keys]
@@ -0,0 +1,38 @@
+import os
+from collections import defaultdict
+
+
+def get_manual_dict(lines):
+    # "#제목" 줄을 기준으로 매뉴얼을 {제목: 본문} 으로 나눈다
+    manual_dict = defaultdict(list)
+    manual_key = ""
+    for line in lines:
+        line = line.replace("\n", "")
+        if not line:
+            continue
+
+        if line[0] == "#":
+            manual_key = line.replace("#", "")
+        elif manual_key:
+            manual_dict[manual_key].append(line)
+        else:
+            continue
+
+    for key in manual_dict:
+        manual_dict[key] = "\n".join(manual_dict[key])
+
+    return manual_dict
+
+
+def read_manual(file_path):
+    with open(file_path, "r") as f:
+        return get_manual_dict(f.readlines())
+
+
+def find_text_files(data_dir):
+    file_paths = []
+    for root, dirs, files in os.walk(data_dir):
+        for file in files:
+            if file.endswith(".txt"):
+                file_paths.append(os.path.join(root, file))
+    return sorted(file_paths)
@@ -0,0 +1,202 @@
+import os
+import json
+import time
+import shutil
+import argparse
+
+import numpy as np
+
+from manifest import WriterLock
+
+DTYPES = {"float32": np.float32, "float16": np.float16, "int8": np.int8}
+# index_dir/current -> 지금 읽어야 하는 버전 디렉터리 (v<시각>)
+CURRENT_LINK = "current"
+
+
+def normalize_rows(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if vectors.ndim == 1:
+        vectors = vectors[None, :]
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def write_file(file_path, write):
+    tmp_path = f"{file_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        write(f)
+    os.replace(tmp_path, file_path)
+
+
+def build_index(index_dir, ids, texts, embeddings, dtype="float32", metadatas=None, keep_versions=2):
+    # 새 버전 디렉터리에 전부 쓴 뒤 current symlink 를 한 번에 바꾼다. 쓰는 쪽은 lock 으로 하나만 허용하고,
+    # 읽는 쪽은 lock 없이 옛 버전 / 새 버전 중 하나를 온전히 본다
+    os.makedirs(index_dir, exist_ok=True)
+    with WriterLock(os.path.join(index_dir, ".lock")):
+        version = f"v{time.time_ns()}"
+        meta = write_version(os.path.join(index_dir, version), ids, texts, embeddings, dtype, metadatas)
+        link_tmp = os.path.join(index_dir, f"{CURRENT_LINK}.{os.getpid()}.tmp")
+        os.symlink(version, link_tmp)
+        os.replace(link_tmp, os.path.join(index_dir, CURRENT_LINK))
+        remove_old_versions(index_dir, keep_versions)
+    return dict(meta, version=version)
+
+
+def remove_old_versions(index_dir, keep_versions):
+    # 옛 버전을 아직 memmap 으로 열고 있는 process 가 있어도 파일은 닫힐 때까지 남아 있다
+    current = os.readlink(os.path.join(index_dir, CURRENT_LINK))
+    versions = sorted(
+        name for name in os.listdir(index_dir)
+        if name.startswith("v") and os.path.isdir(os.path.join(index_dir, name))
+    )
+    for name in versions[:-keep_versions]:
+        if name != current:
+            shutil.rmtree(os.path.join(index_dir, name), ignore_errors=True)
+
+
+def write_version(index_dir, ids, texts, embeddings, dtype="float32", metadatas=None):
+    # embedding 을 하나의 연속된 행렬 파일로 저장하고, id / text 는 sidecar json 으로 저장한다
+    os.makedirs(index_dir, exist_ok=True)
+    matrix = normalize_rows(embeddings) if len(ids) else np.zeros((0, 0), dtype=np.float32)
+
+    scales = None
+    if dtype == "int8":
+        # row 마다 최대 절댓값이 127 이 되도록 scale 을 따로 저장한다
+        scales = np.abs(matrix).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        matrix = np.round(matrix / scales[:, None]).astype(np.int8)
+        scales = scales.astype(np.float32)
+    else:
+        matrix = matrix.astype(DTYPES[dtype])
+
+    write_file(os.path.join(index_dir, "vectors.bin"), lambda f: f.write(np.ascontiguousarray(matrix).tobytes()))
+    if scales is not None:
+        write_file(os.path.join(index_dir, "scales.bin"), lambda f: f.write(scales.tobytes()))
+    sidecar = {"ids": list(ids), "texts": list(texts), "metadatas": metadatas or [{} for _ in ids]}
+    write_file(os.path.join(index_dir, "docs.json"), lambda f: f.write(json.dumps(sidecar, ensure_ascii=False).encode("utf-8")))
+
+    # meta.json 을 마지막에 바꿔서, 읽는 쪽은 meta 가 가리키는 파일 크기만 믿는다
+    meta = {"count": len(ids), "dim": int(matrix.shape[1]) if len(ids) else 0, "dtype": dtype}
+    write_file(os.path.join(index_dir, "meta.json"), lambda f: f.write(json.dumps(meta).encode("utf-8")))
+    return meta
+
+
+def build_index_from_collection(index_dir, collection, dtype="float32"):
+    records = collection.get(include=["embeddings", "documents", "metadatas"])
+    return build_index(
+        index_dir,
+        records["ids"],
+        records["documents"],
+        records["embeddings"],
+        dtype=dtype,
+        metadatas=records["metadatas"],
+    )
+
+
+class NumpyVectorIndex():
+    # 메모리 맵으로 여는 read-only index. 여러 process 가 같은 파일을 열면 page cache 를 공유한다
+    def __init__(self, index_dir, embedding=None, k=4):
+        self.index_dir = index_dir
+        self.embedding = embedding
+        self.k = k
+        self.open()
+
+    def resolve(self):
+        # current symlink 가 있으면 그 버전을, 없으면 예전 방식 (index_dir 바로 아래 파일) 을 연다
+        link = os.path.join(self.index_dir, CURRENT_LINK)
+        if os.path.islink(link):
+            version = os.readlink(link)
+            return version, os.path.join(self.index_dir, version)
+        return None, self.index_dir
+
+    def is_stale(self):
+        return self.resolve()[0] != self.version
+
+    def open(self):
+        self.version, version_dir = self.resolve()
+        with open(os.path.join(version_dir, "meta.json"), "r") as f:
+            self.meta = json.load(f)
+        with open(os.path.join(version_dir, "docs.json"), "r") as f:
+            sidecar = json.load(f)
+        self.ids = sidecar["ids"]
+        self.texts = sidecar["texts"]
+        self.metadatas = sidecar["metadatas"]
+        self.partitions = {}
+        for i, metadata in enumerate(self.metadatas):
+            self.partitions.setdefault((metadata or {}).get("product"), []).append(i)
+        self.partitions = {product: np.asarray(rows, dtype=np.int64) for product, rows in self.partitions.items()}
+
+        count, dim = self.meta["count"], self.meta["dim"]
+        self.matrix = None
+        self.scales = None
+        if count:
+            self.matrix = np.memmap(
+                os.path.join(version_dir, "vectors.bin"),
+                dtype=DTYPES[self.meta["dtype"]], mode="r", shape=(count, dim),
+            )
+            if self.meta["dtype"] == "int8":
+                self.scales = np.memmap(os.path.join(version_dir, "scales.bin"), dtype=np.float32, mode="r", shape=(count,))
+
+    def __len__(self):
+        return self.meta["count"]
+
+    def score(self, query_vectors, rows=None):
+        # (n_docs, dim) @ (dim, n_queries) 한 번으로 batch 전체 점수를 계산한다
+        matrix = self.matrix if rows is None else self.matrix[rows]
+        scores = matrix @ normalize_rows(query_vectors).T
+        if self.scales is not None:
+            scores = scores * (self.scales if rows is None else self.scales[rows])[:, None]
+        return np.asarray(scores, dtype=np.float32).T
+
+    def search_vectors(self, query_vectors, k=None, product=None):
+        # product 가 주어지면 그 제품의 행만 골라서 점수를 계산한다
+        rows = self.partitions.get(product, np.zeros(0, dtype=np.int64)) if product else None
+        k = min(k or self.k, len(self) if rows is None else len(rows))
+        if not k:
+            return [[] for _ in range(len(normalize_rows(query_vectors)))]
+
+        scores = self.score(query_vectors, rows)
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        results = []
+        for row, candidates in enumerate(top):
+            order = candidates[np.argsort(-scores[row, candidates])]
+            results.append([
+                {"id": self.ids[i], "text": self.texts[i], "metadata": self.metadatas[i], "score": float(scores[row, j]), "row": int(i)}
+                for j, i in zip(order, order if rows is None else rows[order])
+            ])
+        return results
+
+    def search_batch(self, queries, k=None):
+        return self.search_vectors(self.embedding.embed_documents(queries), k)
+
+    def row_vector(self, i):
+        vector = np.asarray(self.matrix[i], dtype=np.float32)
+        return vector * self.scales[i] if self.scales is not None else vector
+
+    def search_candidates(self, query, k=None, product=None):
+        # rerank 용: 저장된 vector 도 같이 돌려줘서 후보 embedding 을 다시 계산하지 않게 한다
+        results = self.search_vectors(self.embedding.embed_query(query), k, product)[0]
+        return [dict(result, vector=self.row_vector(result["row"])) for result in results]
+
+    def search_documents(self, query, k=None, product=None):
+        return [result["text"] for result in self.search_vectors(self.embedding.embed_query(query), k, product)[0]]
+
+    def query_db(self, query):
+        return "\n".join(self.search_documents(query))
+
+
+if __name__ == "__main__":
+    from database import VectorDB
+
+    parser = argparse.ArgumentParser(description="VectorDB collection 을 numpy memmap index 로 내보낸다")
+    parser.add_argument("--index-dir", default="./data/upload/numpy-index")
+    parser.add_argument("--dtype", default="float32", choices=list(DTYPES))
+    parser.add_argument("--upload", action="store_true", help="내보내기 전에 바뀐 파일을 먼저 적재한다")
+    args = parser.parse_args()
+
+    # 서버가 떠 있는 동안 돌려도 된다: worker 들은 current 가 바뀐 것을 보고 새 버전을 연다
+    vectordb = VectorDB(upload=args.upload)
+    vectordb.numpy_index_dir = args.index_dir
+    meta = vectordb.export_numpy_index(dtype=args.dtype)
+    print(f"numpy index built: {meta}")
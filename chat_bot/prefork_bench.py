@@ -0,0 +1,110 @@
+import os
+import sys
+import json
+import time
+import glob
+import shutil
+import signal
+import argparse
+import tempfile
+import subprocess
+
+from tracing import process_memory
+
+
+def prepare_data_dir(source_dir, data_dir):
+    # 원본 매뉴얼을 복사하고 local embedding 으로 numpy index 를 만든다 (OpenAI key 없이 서버를 띄우기 위해)
+    from embeddings import get_embedding_backend
+    from ingest_pipeline import IngestPipeline, MemoryCollection
+    from manual import find_text_files
+    from numpy_index import build_index_from_collection
+
+    for file_path in find_text_files(source_dir):
+        target = os.path.join(data_dir, os.path.relpath(file_path, source_dir))
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.copyfile(file_path, target)
+    collection = MemoryCollection()
+    IngestPipeline(collection, embedding=get_embedding_backend("local"), data_dir=data_dir).run()
+    return build_index_from_collection(os.path.join(data_dir, "upload/numpy-index"), collection)
+
+
+def run_server(workers, prefork, data_dir, port, timeout=120):
+    # gunicorn 을 띄워서 worker 가 모두 startup 을 끝낼 때까지 기다리고, 그 시점의 process 별 memory 를 잰다
+    stats_dir = tempfile.mkdtemp(prefix="worker-stats-")
+    env = dict(
+        os.environ,
+        CHATBOT_WORKERS=str(workers),
+        CHATBOT_PREFORK="1" if prefork else "0",
+        CHATBOT_BIND=f"127.0.0.1:{port}",
+        CHATBOT_DATA_DIR=data_dir,
+        CHATBOT_RETRIEVER_BACKEND="numpy",
+        CHATBOT_EMBEDDING_BACKEND="local",
+        CHATBOT_WORKER_STATS_DIR=stats_dir,
+    )
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py"],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+    )
+    try:
+        while len(glob.glob(os.path.join(stats_dir, "*.json"))) < workers:
+            if process.poll() is not None:
+                raise RuntimeError(f"gunicorn exited: {process.stderr.read().decode()[-2000:]}")
+            if time.perf_counter() - start > timeout:
+                raise TimeoutError(f"{workers} workers not ready in {timeout}s")
+            time.sleep(0.05)
+        ready_seconds = time.perf_counter() - start
+        # 모든 worker 가 뜬 뒤에 재야 공유 page 가 pss 에 나눠서 잡힌다
+        time.sleep(1.0)
+
+        worker_stats = []
+        for file_path in glob.glob(os.path.join(stats_dir, "*.json")):
+            with open(file_path, "r") as f:
+                stats = json.load(f)
+            worker_stats.append(dict(stats, memory=process_memory(stats["pid"])))
+        master_memory = process_memory(process.pid)
+    finally:
+        process.send_signal(signal.SIGTERM)
+        process.wait(timeout=60)
+        shutil.rmtree(stats_dir, ignore_errors=True)
+
+    def mean(key, values):
+        return sum(value[key] for value in values) / len(values)
+
+    memories = [stats["memory"] for stats in worker_stats]
+    return {
+        "workers": workers,
+        "mode": "prefork" if prefork else "per-worker",
+        "ready_seconds": round(ready_seconds, 2),
+        "worker_startup_mean_seconds": round(mean("startup_seconds", worker_stats), 3),
+        "worker_startup_max_seconds": round(max(stats["startup_seconds"] for stats in worker_stats), 3),
+        "worker_rss_mean_kb": round(mean("rss", memories)),
+        "worker_pss_mean_kb": round(mean("pss", memories)),
+        "worker_private_mean_kb": round(mean("private", memories)),
+        "master_pss_kb": master_memory.get("pss", 0),
+        "total_pss_kb": sum(memory["pss"] for memory in memories) + master_memory.get("pss", 0),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="worker 수를 늘려가며 pre-fork 공유 / worker 별 적재의 memory 와 startup 시간 비교")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--data-dir", default=None, help="numpy index 가 있는 data dir (없으면 ./data 로 임시 생성)")
+    parser.add_argument("--port", type=int, default=8190)
+    parser.add_argument("--output", default=None)
+    args = parser.parse_args()
+
+    data_dir = args.data_dir
+    if data_dir is None:
+        data_dir = tempfile.mkdtemp(prefix="prefork-data-")
+        print(f"index built: {prepare_data_dir('./data', data_dir)}")
+
+    results = []
+    for workers in args.workers:
+        for prefork in (True, False):
+            result = run_server(workers, prefork, data_dir, args.port)
+            print(json.dumps(result))
+            results.append(result)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
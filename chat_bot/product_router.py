@@ -0,0 +1,67 @@
+import os
+import re
+import time
+from collections import defaultdict
+
+PRODUCT_PATTERNS = {
+    "카카오싱크": re.compile(r"(카카오\s*싱크|싱크|간편\s*가입|sync)", re.IGNORECASE),
+    "카카오소셜": re.compile(r"(카카오\s*소셜|소셜|친구\s*(목록|정보)|피커|social|picker)", re.IGNORECASE),
+    "카카오톡채널": re.compile(r"(톡\s*채널|채널|플러스\s*친구|channel)", re.IGNORECASE),
+}
+FILE_PATTERN = re.compile(r"project_data_(.+)\.txt$")
+
+
+def product_from_file(file_key):
+    file_name = os.path.basename(file_key)
+    match = FILE_PATTERN.match(file_name)
+    return match.group(1) if match else os.path.splitext(file_name)[0]
+
+
+class ProductRouter():
+    # 질문에 나온 제품 키워드로 검색할 partition 을 고른다. 애매하면 None (전체 검색)
+    def __init__(self, patterns=PRODUCT_PATTERNS):
+        self.patterns = patterns
+
+    def detect(self, query):
+        counts = {product: len(pattern.findall(query)) for product, pattern in self.patterns.items()}
+        ranked = sorted(counts.items(), key=lambda item: item[1], reverse=True)
+        if not ranked or ranked[0][1] == 0:
+            return None
+        if len(ranked) > 1 and ranked[0][1] == ranked[1][1]:
+            return None
+        return ranked[0][0]
+
+
+class PartitionStats():
+    def __init__(self):
+        self.sizes = {}
+        self.queries = defaultdict(int)
+        self.seconds = defaultdict(float)
+        self.fallbacks = 0
+
+    def set_size(self, partition, size):
+        self.sizes[partition] = size
+
+    def record(self, partition, seconds):
+        self.queries[partition] += 1
+        self.seconds[partition] += seconds
+
+    def timed(self, partition, search):
+        start = time.perf_counter()
+        result = search()
+        self.record(partition, time.perf_counter() - start)
+        return result
+
+    def report(self):
+        partitions = set(self.sizes) | set(self.queries)
+        return {
+            "fallbacks": self.fallbacks,
+            "partitions": {
+                partition: {
+                    "size": self.sizes.get(partition),
+                    "queries": self.queries[partition],
+                    "avg_ms": self.seconds[partition] / self.queries[partition] * 1000 if self.queries[partition] else 0.0,
+                }
+                for partition in sorted(partitions)
+            },
+        }
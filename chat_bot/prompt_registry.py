@@ -0,0 +1,61 @@
+import os
+import string
+from types import MappingProxyType
+
+PROMPT_DIR = "./prompt_template"
+# 각 template 이 반드시 가져야 하는 placeholder (chain 을 만들기 전에 startup 에서 확인한다)
+REQUIRED_VARIABLES = {
+    "intent_list": set(),
+    "parse_intent": {"intent_list", "user_message"},
+    "default_response": {"user_message"},
+    "question_response": {"related_documents", "chat_history", "user_message"},
+    "query_result_check": {"user_message", "query_results"},
+    "query_result_compression": {"user_message", "query_results"},
+    "function_use_check": {"chat_history", "user_message"},
+    "summarize_history": {"summary", "new_messages"},
+}
+
+_registries = {}
+
+
+def template_variables(template):
+    return {field for _, field, _, _ in string.Formatter().parse(template) if field}
+
+
+class PromptRegistry():
+    # prompt_template/ 의 파일을 한 번만 읽어서 바꿀 수 없는 dict 로 들고 있는다
+    def __init__(self, prompt_dir=PROMPT_DIR, required_variables=REQUIRED_VARIABLES):
+        templates = {}
+        for file_name in sorted(os.listdir(prompt_dir)):
+            if file_name.endswith(".txt"):
+                with open(os.path.join(prompt_dir, file_name), "r") as f:
+                    templates[file_name[:-len(".txt")]] = f.read()
+        self.prompt_dir = prompt_dir
+        self.templates = MappingProxyType(templates)
+        self.variables = MappingProxyType({name: frozenset(template_variables(text)) for name, text in templates.items()})
+        self.validate(required_variables)
+
+    def validate(self, required_variables):
+        errors = []
+        for name, required in required_variables.items():
+            if name not in self.templates:
+                errors.append(f"{name}: missing template")
+            elif not required <= self.variables[name]:
+                errors.append(f"{name}: missing placeholders {sorted(required - self.variables[name])}")
+        if errors:
+            raise ValueError(f"invalid prompt templates in {self.prompt_dir}: " + "; ".join(errors))
+
+    def __getitem__(self, name):
+        return self.templates[name]
+
+    def __contains__(self, name):
+        return name in self.templates
+
+
+def get_prompt_registry(prompt_dir=PROMPT_DIR):
+    # process 안에서 같은 디렉터리는 하나의 registry 를 공유한다
+    prompt_dir = os.path.abspath(prompt_dir)
+    registry = _registries.get(prompt_dir)
+    if registry is None:
+        registry = _registries.setdefault(prompt_dir, PromptRegistry(prompt_dir))
+    return registry
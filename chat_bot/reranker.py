@@ -0,0 +1,212 @@
+import json
+import argparse
+
+import numpy as np
+
+from lexical_index import tokenize
+from numpy_index import normalize_rows
+from token_counter import count_tokens
+
+
+def vector_scores(query_vector, vectors):
+    # (질문과의 cosine, 후보끼리의 cosine 행렬)
+    vectors = normalize_rows(vectors)
+    return vectors @ normalize_rows(query_vector)[0], vectors @ vectors.T
+
+
+def lexical_scores(candidates):
+    # BM25 결과만 있을 때: 관련도는 정규화된 BM25 점수, 후보끼리 유사도는 n-gram 집합의 jaccard
+    terms = [set(tokenize(candidate["text"])) for candidate in candidates]
+    similarity = np.eye(len(candidates), dtype=np.float32)
+    for i in range(len(terms)):
+        for j in range(i + 1, len(terms)):
+            union = len(terms[i] | terms[j])
+            similarity[i, j] = similarity[j, i] = len(terms[i] & terms[j]) / union if union else 0.0
+    relevance = np.asarray([candidate["normalized_score"] for candidate in candidates], dtype=np.float32)
+    return relevance, similarity
+
+
+def mmr_select(relevance, similarity, k, lambda_mult=0.5, duplicate_threshold=0.95):
+    # maximal marginal relevance: 질문과 가깝고 이미 고른 것과는 먼 후보를 하나씩 고른다
+    # 이미 고른 것과 duplicate_threshold 이상 비슷한 후보는 중복으로 보고 아예 뺀다
+    max_similarity = np.full(len(relevance), -np.inf, dtype=np.float32)
+    available = np.ones(len(relevance), dtype=bool)
+    selected, duplicates = [], 0
+
+    while len(selected) < k and available.any():
+        redundancy = np.where(np.isinf(max_similarity), 0.0, max_similarity)
+        scores = np.where(available, lambda_mult * relevance - (1 - lambda_mult) * redundancy, -np.inf)
+        best = int(np.argmax(scores))
+        selected.append(best)
+        available[best] = False
+        max_similarity = np.maximum(max_similarity, similarity[best])
+        near_duplicates = available & (similarity[best] >= duplicate_threshold)
+        duplicates += int(near_duplicates.sum())
+        available &= ~near_duplicates
+    return selected, duplicates
+
+
+def overlap_length(left, right, max_overlap=200, min_overlap=8):
+    # left 의 끝과 right 의 앞이 겹치는 길이 (chunk_overlap 으로 생긴 중복). 몇 글자 우연히 같은 것은 무시한다
+    for size in range(min(len(left), len(right), max_overlap), min_overlap - 1, -1):
+        if left.endswith(right[:size]):
+            return size
+    return 0
+
+
+def merge_adjacent(candidates):
+    # 같은 파일 / section 에서 chunk_index 가 이어지는 chunk 는 하나로 합친다
+    merged = []
+    groups = {}
+    for candidate in candidates:
+        metadata = candidate.get("metadata") or {}
+        index = metadata.get("chunk_index")
+        key = (metadata.get("source"), metadata.get("section"))
+        previous = groups.get(key)
+        if index is not None and key[1] is not None and previous is not None and index - previous["last_index"] == 1:
+            body = candidate["text"]
+            heading = previous["text"].split("\n", 1)[0]
+            if heading.startswith("[") and body.startswith(heading + "\n"):
+                body = body[len(heading) + 1:]
+            overlap = overlap_length(previous["text"], body)
+            # 겹치면 이어진 문장이므로 그대로 붙이고, 안 겹치면 줄을 바꿔 붙인다
+            previous["text"] += body[overlap:] if overlap else "\n" + body
+            previous["last_index"] = index
+            previous["merged"] += 1
+            previous["rank"] = min(previous.get("rank", 0), candidate.get("rank", 0))
+            continue
+        entry = dict(candidate, last_index=index, merged=0)
+        merged.append(entry)
+        if index is not None:
+            groups[key] = entry
+    return merged
+
+
+class MMRReranker():
+    # 후보를 넉넉히 가져와서 MMR 로 다양하게 고르고, 이웃 chunk 는 합치고, token 예산에서 멈춘다
+    def __init__(self, embedding, k=4, fetch_k=20, lambda_mult=0.5, duplicate_threshold=0.95, max_tokens=800):
+        self.embedding = embedding
+        self.k = k
+        self.fetch_k = fetch_k
+        self.lambda_mult = lambda_mult
+        self.duplicate_threshold = duplicate_threshold
+        self.max_tokens = max_tokens
+        self.stats = {"queries": 0, "lexical_queries": 0, "baseline_tokens": 0, "output_tokens": 0, "duplicates": 0, "merged": 0}
+
+    def scores(self, query, candidates):
+        if all(candidate.get("vector") is not None for candidate in candidates):
+            return vector_scores(self.embedding.embed_query(query), [candidate["vector"] for candidate in candidates])
+        if all("normalized_score" in candidate for candidate in candidates):
+            # BM25 만으로 충분했던 검색 (HybridRetriever 의 lexical 경로) 은 여기서도 embedding 을 부르지 않는다
+            self.stats["lexical_queries"] += 1
+            return lexical_scores(candidates)
+        # vector 가 없는 후보만 embedding 한다 (chunk embedding 은 ingestion 때 embedding cache 에 들어가 있어 대부분 cache hit)
+        missing = [i for i, candidate in enumerate(candidates) if candidate.get("vector") is None]
+        embedded = dict(zip(missing, self.embedding.embed_documents([candidates[i]["text"] for i in missing])))
+        vectors = [embedded[i] if i in embedded else candidate["vector"] for i, candidate in enumerate(candidates)]
+        return vector_scores(self.embedding.embed_query(query), vectors)
+
+    def rerank(self, query, candidates):
+        if not candidates:
+            return []
+        relevance, similarity = self.scores(query, candidates)
+        indexes, duplicates = mmr_select(relevance, similarity, self.k, self.lambda_mult, self.duplicate_threshold)
+        selected = merge_adjacent(sorted(
+            (dict(candidates[i], rank=rank) for rank, i in enumerate(indexes)),
+            key=lambda candidate: (candidate.get("metadata") or {}).get("chunk_index") or 0,
+        ))
+        # 합친 결과는 다시 MMR 순서(관련도 순)로 돌려놓는다
+        selected.sort(key=lambda entry: entry["rank"])
+
+        results = []
+        budget = self.max_tokens
+        for entry in selected:
+            tokens = count_tokens(entry["text"])
+            if results and tokens > budget:
+                break
+            results.append(entry)
+            budget -= tokens
+
+        self.stats["queries"] += 1
+        self.stats["baseline_tokens"] += sum(count_tokens(candidate["text"]) for candidate in candidates[:self.k])
+        self.stats["output_tokens"] += sum(count_tokens(entry["text"]) for entry in results)
+        self.stats["duplicates"] += duplicates
+        self.stats["merged"] += sum(entry["merged"] for entry in results)
+        return results
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        queries = stats["queries"] or 1
+        stats["baseline_tokens_per_query"] = stats["baseline_tokens"] / queries
+        stats["output_tokens_per_query"] = stats["output_tokens"] / queries
+        stats["token_reduction"] = 1 - stats["output_tokens"] / stats["baseline_tokens"] if stats["baseline_tokens"] else 0.0
+        return stats
+
+
+class MMRRetriever():
+    # search_candidates(query, k) 를 가진 retriever (VectorDB, NumpyVectorIndex, HybridRetriever) 앞에 붙인다
+    def __init__(self, retriever, reranker):
+        self.retriever = retriever
+        self.reranker = reranker
+
+    @property
+    def embedding(self):
+        return getattr(self.retriever, "embedding", None)
+
+    def search(self, query):
+        candidates = self.retriever.search_candidates(query, self.reranker.fetch_k)
+        return [entry["text"] for entry in self.reranker.rerank(query, candidates)]
+
+    def query_db(self, query):
+        return "\n".join(self.search(query))
+
+
+def compare(retriever, reranker, questions, k=4):
+    # top-k 를 그대로 쓸 때와 MMR 을 거칠 때의 prompt token 수 / section 적중률 비교
+    report = {"plain": {"tokens": 0, "hits": 0}, "mmr": {"tokens": 0, "hits": 0}}
+
+    def record(name, question, results):
+        report[name]["tokens"] += count_tokens("\n".join(result["text"] for result in results))
+        report[name]["hits"] += any(
+            (result.get("metadata") or {}).get("source") == question["source"]
+            and (result.get("metadata") or {}).get("section") == question["section"]
+            for result in results
+        )
+
+    for question in questions:
+        candidates = retriever.search_candidates(question["question"], reranker.fetch_k)
+        record("plain", question, candidates[:k])
+        record("mmr", question, reranker.rerank(question["question"], candidates))
+
+    for name in ("plain", "mmr"):
+        report[name]["tokens_per_question"] = report[name]["tokens"] / len(questions)
+        report[name]["hit_rate"] = report[name]["hits"] / len(questions)
+    report["token_reduction"] = 1 - report["mmr"]["tokens"] / report["plain"]["tokens"] if report["plain"]["tokens"] else 0.0
+    return report
+
+
+if __name__ == "__main__":
+    from chunker import get_text_splitter
+    from embeddings import get_embedding_backend
+    from ingest_pipeline import IngestPipeline, MemoryCollection
+    from numpy_index import NumpyVectorIndex, build_index_from_collection
+
+    parser = argparse.ArgumentParser(description="top-k 검색과 MMR rerank 의 prompt token / 적중률 비교")
+    parser.add_argument("--data-dir", default="./data")
+    parser.add_argument("--questions", default="./eval/retrieval_questions.jsonl")
+    parser.add_argument("--index-dir", default="./data/upload/mmr-eval-index")
+    parser.add_argument("--splitter", default="section", choices=["section", "character"])
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--fetch-k", type=int, default=20)
+    parser.add_argument("--max-tokens", type=int, default=800)
+    args = parser.parse_args()
+
+    with open(args.questions, "r") as f:
+        questions = [json.loads(line) for line in f if line.strip()]
+    embedding = get_embedding_backend("local")
+    collection = MemoryCollection()
+    IngestPipeline(collection, embedding=embedding, data_dir=args.data_dir, text_splitter=get_text_splitter(args.splitter)).run()
+    build_index_from_collection(args.index_dir, collection)
+    index = NumpyVectorIndex(args.index_dir, embedding=embedding)
+    reranker = MMRReranker(embedding, k=args.k, fetch_k=args.fetch_k, max_tokens=args.max_tokens)
+    print(json.dumps(compare(index, reranker, questions, k=args.k), indent=2, ensure_ascii=False))
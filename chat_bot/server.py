@@ -0,0 +1,324 @@
+import os
+import json
+import time
+import uuid
+import asyncio
+from typing import Optional
+
+import aiohttp
+import openai
+import requests
+from fastapi import FastAPI, HTTPException
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from starlette.background import BackgroundTask
+from pydantic import BaseModel, Field
+from requests.adapters import HTTPAdapter
+
+from answer_cache import AnswerCache
+from context_compressor import ExtractiveCompressor
+from database import VectorDB
+from intent_router import IntentRouter
+from lexical_index import HybridRetriever
+from llm_client import CircuitOpenError, LLMClient, LLMTimeoutError
+from reranker import MMRReranker, MMRRetriever
+from session_store import SessionManager, SQLiteHistoryStore
+from langchain_openai import LangChain
+from prompt_registry import get_prompt_registry
+from tracing import process_memory, tracer
+
+MAX_INFLIGHT = int(os.environ.get("CHATBOT_MAX_INFLIGHT", "256"))
+MAX_SESSIONS = int(os.environ.get("CHATBOT_MAX_SESSIONS", "10000"))
+HTTP_POOL_SIZE = int(os.environ.get("CHATBOT_HTTP_POOL_SIZE", "100"))
+HISTORY_DIR = os.environ.get("CHATBOT_HISTORY_DIR", "./chat_histories")
+# "sqlite": 모든 대화를 SQLite 하나에 batch 로 기록, "journal": 대화별 JSONL 파일
+HISTORY_BACKEND = os.environ.get("CHATBOT_HISTORY_BACKEND", "sqlite")
+SESSION_IDLE_SECONDS = float(os.environ.get("CHATBOT_SESSION_IDLE_SECONDS", "1800"))
+DATA_DIR = os.environ.get("CHATBOT_DATA_DIR", "./data")
+RETRIEVER_BACKEND = os.environ.get("CHATBOT_RETRIEVER_BACKEND", "chroma")
+EMBEDDING_BACKEND = os.environ.get("CHATBOT_EMBEDDING_BACKEND", "openai")
+COMPRESSION_MODE = os.environ.get("CHATBOT_COMPRESSION_MODE", "local")
+USE_MMR = os.environ.get("CHATBOT_MMR", "1") == "1"
+LLM_TIMEOUT = float(os.environ.get("CHATBOT_LLM_TIMEOUT", "30"))
+LLM_MAX_RETRIES = int(os.environ.get("CHATBOT_LLM_MAX_RETRIES", "3"))
+# 0 이면 hedge 하지 않는다
+LLM_HEDGE_AFTER = float(os.environ.get("CHATBOT_LLM_HEDGE_AFTER", "0")) or None
+# gunicorn.conf.py 가 preload_app 과 같이 켠다: master 에서 index 를 한 번 열고 worker 들이 공유한다
+PREFORK = os.environ.get("CHATBOT_PREFORK") == "1"
+INDEX_REFRESH_SECONDS = float(os.environ.get("CHATBOT_INDEX_REFRESH_SECONDS", "30"))
+WORKER_STATS_DIR = os.environ.get("CHATBOT_WORKER_STATS_DIR")
+
+
+class ChatRequest(BaseModel):
+    message: str
+    # history 파일 / store key 로 그대로 쓰므로 경로 문자가 들어간 id 는 422 로 거절한다
+    conversation_id: Optional[str] = Field(default=None, pattern=r"^[A-Za-z0-9_-]{1,64}$")
+
+
+class ChatResponse(BaseModel):
+    conversation_id: str
+    answer: str
+
+
+def load_chat_history(conversation_id):
+    # session 이 메모리에 없을 때만 불린다 (처음 온 대화이거나 LRU 에서 내보낸 대화)
+    with tracer.span("history_load"):
+        return app.state.langchain.create_chat_history(conversation_id, history_dir=HISTORY_DIR)
+
+
+class InflightLimiter():
+    # 동시에 처리 중인 요청 수를 제한하고, 넘치면 기다리지 않고 바로 429 를 돌려준다
+    def __init__(self, limit=MAX_INFLIGHT):
+        self.limit = limit
+        self.inflight = 0
+
+    def acquire(self):
+        if self.inflight >= self.limit:
+            raise HTTPException(status_code=429, detail="too many requests in flight", headers={"Retry-After": "1"})
+        self.inflight += 1
+
+    def release(self):
+        self.inflight -= 1
+
+    def slot(self):
+        self.acquire()
+        return InflightSlot(self)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class InflightSlot():
+    # 자리를 돌려주는 곳이 여러 군데여도 한 번만 반납한다
+    def __init__(self, limiter):
+        self.limiter = limiter
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.limiter.release()
+
+
+app = FastAPI(title="chat_bot")
+
+
+def create_requests_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def use_pooled_session():
+    # openai.aiosession 은 ContextVar 라서 요청 context 마다 공유 session 을 지정해야 한다
+    openai.aiosession.set(app.state.aiohttp_session)
+
+
+def create_shared_state():
+    # 읽기 전용이라 worker 끼리 같이 쓸 수 있는 것들: 검색 index, lexical index, intent centroid, prompt template
+    vectordb = VectorDB(data_dir=DATA_DIR, upload=False, backend=RETRIEVER_BACKEND, embedding_backend=EMBEDDING_BACKEND)
+    intent_router = IntentRouter(
+        embedding=vectordb.embedding,
+        centroid_cache_path=os.path.join(vectordb.data_dir, "upload/intent_centroids.json"),
+    )
+    get_prompt_registry()
+    return {"vectordb": vectordb, "intent_router": intent_router}
+
+
+def create_prefork_state():
+    # gunicorn preload_app 으로 master 에서 import 될 때 한 번 만들고, fork 된 worker 들은 copy-on-write 로 공유한다
+    # chroma client 는 fork 너머로 쓸 수 없으므로 memmap 으로 여는 numpy backend 만 허용한다
+    if RETRIEVER_BACKEND != "numpy":
+        raise ValueError("CHATBOT_PREFORK=1 requires CHATBOT_RETRIEVER_BACKEND=numpy")
+    shared = create_shared_state()
+    # sqlite 연결도 fork 너머로 가져가면 안 되므로 닫아 두고 worker 에서 다시 연다 (memory LRU 는 그대로 공유된다)
+    embedding = shared["vectordb"].embedding
+    if hasattr(embedding, "close"):
+        embedding.close()
+    return shared
+
+
+SHARED_STATE = create_prefork_state() if PREFORK else None
+
+
+async def refresh_index_loop(vectordb, answer_cache):
+    # 적재 script 가 numpy index 를 교체하면 worker 마다 다음 주기에 새 버전으로 바꾸고, 옛 data 의 답도 바로 비운다
+    while True:
+        await asyncio.sleep(INDEX_REFRESH_SECONDS)
+        try:
+            if await asyncio.to_thread(vectordb.refresh_index):
+                await asyncio.to_thread(answer_cache.refresh_scope)
+        except Exception as e:
+            print(f"numpy index refresh failed ({e})")
+
+
+def record_worker_stats():
+    # gunicorn.conf.py 의 post_fork 가 남긴 시각부터 재면 fork 후 import / index 열기까지 포함된다
+    forked_at = float(os.environ.get("CHATBOT_WORKER_FORKED_AT", "0"))
+    if forked_at:
+        app.state.startup_seconds = time.time() - forked_at
+    if WORKER_STATS_DIR:
+        os.makedirs(WORKER_STATS_DIR, exist_ok=True)
+        stats = {"pid": os.getpid(), "prefork": PREFORK, "startup_seconds": app.state.startup_seconds}
+        with open(os.path.join(WORKER_STATS_DIR, f"{os.getpid()}.json"), "w") as f:
+            json.dump(stats, f)
+
+
+@app.on_event("startup")
+async def startup():
+    start = time.perf_counter()
+    openai.requestssession = create_requests_session()
+    app.state.aiohttp_session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=HTTP_POOL_SIZE, keepalive_timeout=30),
+    )
+
+    shared = SHARED_STATE or create_shared_state()
+    vectordb = shared["vectordb"]
+    if SHARED_STATE and hasattr(vectordb.embedding, "initialize"):
+        vectordb.embedding.initialize()
+    app.state.vectordb = vectordb
+    app.state.embedding = vectordb.embedding
+    answer_cache = AnswerCache(
+        embedding=vectordb.embedding,
+        corpus=vectordb.chroma_collection_name,
+        data_dir=vectordb.data_dir,
+        persist_path=os.path.join(vectordb.data_dir, "upload/answer_cache.sqlite"),
+    )
+    retriever = HybridRetriever(vectordb, vectordb.lexical_index)
+    app.state.reranker = None
+    if USE_MMR:
+        app.state.reranker = MMRReranker(vectordb.embedding)
+        retriever = MMRRetriever(retriever, app.state.reranker)
+    app.state.history_store = None
+    if HISTORY_BACKEND == "sqlite":
+        app.state.history_store = SQLiteHistoryStore(os.path.join(HISTORY_DIR, "sessions.sqlite"))
+    app.state.langchain = LangChain(
+        db=retriever,
+        answer_cache=answer_cache,
+        intent_router=shared["intent_router"],
+        compression_mode=COMPRESSION_MODE,
+        compressor=ExtractiveCompressor(embedding=vectordb.embedding),
+        llm_client=LLMClient(timeout=LLM_TIMEOUT, max_retries=LLM_MAX_RETRIES, hedge_after=LLM_HEDGE_AFTER),
+        history_store=app.state.history_store,
+    )
+    app.state.sessions = SessionManager(load_chat_history, max_sessions=MAX_SESSIONS, idle_seconds=SESSION_IDLE_SECONDS)
+    app.state.limiter = InflightLimiter()
+    app.state.index_refresh = None
+    if vectordb.index is not None and INDEX_REFRESH_SECONDS > 0:
+        app.state.index_refresh = asyncio.create_task(refresh_index_loop(vectordb, answer_cache))
+    app.state.startup_seconds = time.perf_counter() - start
+    record_worker_stats()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    if app.state.index_refresh:
+        app.state.index_refresh.cancel()
+    await app.state.aiohttp_session.close()
+    openai.requestssession.close()
+    if app.state.history_store:
+        app.state.history_store.close()
+
+
+@app.post("/chat", response_model=ChatResponse)
+async def chat(request: ChatRequest):
+    with app.state.limiter:
+        use_pooled_session()
+        conversation_id = request.conversation_id or uuid.uuid4().hex
+        session = await run_in_threadpool(app.state.sessions.get, conversation_id)
+        async with session.lock:
+            try:
+                answer = await app.state.langchain.generate_answer_async(
+                    request.message,
+                    chat_history=session.chat_history,
+                )
+            except CircuitOpenError:
+                raise HTTPException(status_code=503, detail="llm unavailable")
+            except LLMTimeoutError:
+                raise HTTPException(status_code=504, detail="llm timeout")
+    return ChatResponse(conversation_id=conversation_id, answer=answer)
+
+
+@app.post("/chat/stream")
+async def chat_stream(request: ChatRequest):
+    # Server-Sent Events: token 마다 data 이벤트, 마지막에 latency 정보를 담은 done 이벤트 (llm 실패 시 error 이벤트)
+    # 429 는 응답을 시작하기 전에 돌려줘야 하므로 자리는 여기서 잡는다
+    slot = app.state.limiter.slot()
+    try:
+        conversation_id = request.conversation_id or uuid.uuid4().hex
+        session = await run_in_threadpool(app.state.sessions.get, conversation_id)
+    except BaseException:
+        slot.release()
+        raise
+
+    async def events():
+        # 응답이 이미 200 으로 시작됐으므로 llm 오류는 status 를 담은 error 이벤트로 알린다
+        try:
+            use_pooled_session()
+            timings = {}
+            try:
+                async with session.lock:
+                    async for token in app.state.langchain.astream_answer(
+                        request.message,
+                        chat_history=session.chat_history,
+                        timings=timings,
+                    ):
+                        yield f"data: {json.dumps({'token': token}, ensure_ascii=False)}\n\n"
+            except CircuitOpenError:
+                error = {"conversation_id": conversation_id, "status": 503, "detail": "llm unavailable"}
+                yield f"event: error\ndata: {json.dumps(error)}\n\n"
+                return
+            except LLMTimeoutError:
+                error = {"conversation_id": conversation_id, "status": 504, "detail": "llm timeout"}
+                yield f"event: error\ndata: {json.dumps(error)}\n\n"
+                return
+            done = {"conversation_id": conversation_id, "timings": timings}
+            yield f"event: done\ndata: {json.dumps(done)}\n\n"
+        finally:
+            slot.release()
+
+    # generator 가 한 번도 돌지 않고 끝나도 (보내기 전에 연결이 끊긴 경우 등) background task 가 자리를 돌려준다
+    return StreamingResponse(events(), media_type="text/event-stream", background=BackgroundTask(slot.release))
+
+
+@app.get("/health")
+async def health():
+    return {
+        "status": "ok",
+        "pid": os.getpid(),
+        "prefork": PREFORK,
+        "startup_seconds": round(app.state.startup_seconds, 3),
+        "index_version": app.state.vectordb.index.version if app.state.vectordb.index is not None else None,
+        "partitions": app.state.vectordb.partition_stats.report(),
+        "memory": process_memory(),
+        "inflight": app.state.limiter.inflight,
+        "max_inflight": app.state.limiter.limit,
+        "sessions": app.state.sessions.get_stats(),
+        "history_store": app.state.history_store.get_stats() if app.state.history_store else None,
+        "embedding_cache": app.state.embedding.get_stats() if hasattr(app.state.embedding, "get_stats") else None,
+        "reranker": app.state.reranker.get_stats() if app.state.reranker else None,
+        "llm": app.state.langchain.llm_client.get_stats(),
+    }
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    lines = [
+        "# TYPE chatbot_inflight gauge",
+        f"chatbot_inflight {app.state.limiter.inflight}",
+        "# TYPE chatbot_sessions gauge",
+        f"chatbot_sessions {len(app.state.sessions)}",
+    ]
+    return "\n".join(lines) + "\n" + tracer.metrics.render()
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(app, host="0.0.0.0", port=int(os.environ.get("PORT", "8000")))
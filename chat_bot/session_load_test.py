@@ -0,0 +1,103 @@
+import os
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+
+from benchmark import summarize
+from chat_history import ChatHistory
+from session_store import SessionManager, SQLiteHistoryStore
+from tracing import process_memory
+
+QUESTION = "카카오싱크 간편가입 설정 방법 알려줘"
+ANSWER = "내 애플리케이션 > 카카오 로그인 > 간편가입에서 설정할 수 있습니다. " * 3
+
+
+def run(backend, sessions, max_sessions, turns=2, samples=2000, seed=0):
+    # sessions 개의 대화에 turns 번씩 기록하고, 메모리에 남은 대화 / 내보낸 대화를 다시 찾는 latency 를 잰다
+    history_dir = tempfile.mkdtemp(prefix="session-load-")
+    store = SQLiteHistoryStore(os.path.join(history_dir, "sessions.sqlite")) if backend == "sqlite" else None
+    manager = SessionManager(
+        lambda conversation_id: ChatHistory(history_dir=history_dir, conversation_id=conversation_id, store=store),
+        max_sessions=max_sessions,
+        idle_seconds=0,
+    )
+    rng = random.Random(seed)
+    load_latencies, write_latencies = [], []
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    for i in range(sessions):
+        conversation_id = f"user-{i}"
+        started = time.perf_counter()
+        session = manager.get(conversation_id)
+        load_latencies.append(time.perf_counter() - started)
+        for _ in range(turns):
+            started = time.perf_counter()
+            session.chat_history.update_history(role="Human", content=QUESTION)
+            session.chat_history.update_history(role="ai", content=ANSWER)
+            write_latencies.append(time.perf_counter() - started)
+    seconds = time.perf_counter() - start
+    traced_memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    # 최근 대화 (메모리 hit) 와 오래된 대화 (LRU 에서 내보냈으면 store 에서 다시 읽음) 를 섞어서 찾는다
+    hot_ids = [f"user-{i}" for i in range(max(0, sessions - min(max_sessions, sessions)), sessions)]
+    cold_ids = [f"user-{i}" for i in range(0, max(0, sessions - max_sessions))] or hot_ids
+    hot_latencies, cold_latencies = [], []
+    for latencies, ids in ((hot_latencies, hot_ids), (cold_latencies, cold_ids)):
+        for _ in range(min(samples, len(ids))):
+            conversation_id = rng.choice(ids)
+            started = time.perf_counter()
+            session = manager.get(conversation_id)
+            session.chat_history.get_prompt_history()
+            latencies.append(time.perf_counter() - started)
+
+    if store:
+        store.flush()
+    disk_bytes = sum(
+        os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(history_dir) for name in names
+    )
+    report = {
+        "backend": backend,
+        "sessions": sessions,
+        "max_sessions": max_sessions,
+        "sessions_per_sec": round(sessions / seconds, 1),
+        "first_load": summarize(load_latencies),
+        "turn_write": summarize(write_latencies),
+        "hot_lookup": summarize(hot_latencies),
+        "cold_lookup": summarize(cold_latencies),
+        "traced_memory_mb": round(traced_memory / (1024 * 1024), 2),
+        "memory_per_session_kb": round(traced_memory / 1024 / max(1, min(sessions, max_sessions)), 2),
+        "rss_kb": process_memory().get("rss"),
+        "disk_mb": round(disk_bytes / (1024 * 1024), 2),
+        "manager": manager.get_stats(),
+    }
+    if store:
+        report["store"] = store.get_stats()
+        store.close()
+    shutil.rmtree(history_dir, ignore_errors=True)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="대화 수를 늘려가며 session manager 의 memory / latency 측정")
+    parser.add_argument("--sessions", type=int, nargs="+", default=[1000, 10000, 50000])
+    parser.add_argument("--max-sessions", type=int, default=10000)
+    parser.add_argument("--turns", type=int, default=2)
+    parser.add_argument("--backend", nargs="+", default=["sqlite", "journal"], choices=["sqlite", "journal"])
+    parser.add_argument("--output", default=None)
+    args = parser.parse_args()
+
+    results = []
+    for backend in args.backend:
+        for sessions in args.sessions:
+            result = run(backend, sessions, args.max_sessions, turns=args.turns)
+            print(json.dumps(result, ensure_ascii=False))
+            results.append(result)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
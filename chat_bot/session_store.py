@@ -0,0 +1,210 @@
+import os
+import time
+import atexit
+import sqlite3
+import asyncio
+import threading
+from collections import OrderedDict
+
+
+class SQLiteHistoryStore():
+    # 모든 대화를 SQLite (WAL) 하나에 저장한다. append 는 메모리 queue 에 넣고,
+    # background thread 가 batch_size 개 또는 flush_interval 초마다 한 transaction 으로 묶어서 쓴다
+    def __init__(self, db_path, batch_size=256, flush_interval=0.2):
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.pending = []
+        self.pending_ids = set()
+        self.condition = threading.Condition()
+        # connection 은 writer thread 와 요청 thread 가 같이 쓰므로 lock 으로 순서를 맞춘다
+        self.lock = threading.Lock()
+        self.closed = False
+        self.stats = {"appended": 0, "flushes": 0, "flushed_rows": 0}
+
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            "id INTEGER PRIMARY KEY, conversation_id TEXT NOT NULL, role TEXT, content TEXT, created REAL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS messages_conversation ON messages (conversation_id, id)")
+        self.conn.commit()
+
+        self.writer = threading.Thread(target=self.write_loop, daemon=True, name="history-writer")
+        self.writer.start()
+        atexit.register(self.close)
+
+    def append(self, conversation_id, record):
+        with self.condition:
+            self.pending.append((conversation_id, record["role"], record["content"], time.time()))
+            self.pending_ids.add(conversation_id)
+            self.stats["appended"] += 1
+            if len(self.pending) >= self.batch_size:
+                self.condition.notify()
+
+    def write_loop(self):
+        while not self.closed:
+            with self.condition:
+                if len(self.pending) < self.batch_size:
+                    self.condition.wait(self.flush_interval)
+            self.flush()
+
+    def flush(self):
+        # batch 를 꺼내는 것과 쓰는 것을 같은 lock 안에서 해야, flush 가 끝난 뒤 읽으면 항상 보인다
+        with self.lock:
+            with self.condition:
+                batch, self.pending = self.pending, []
+                self.pending_ids.clear()
+            if not batch:
+                return
+            self.conn.executemany(
+                "INSERT INTO messages (conversation_id, role, content, created) VALUES (?, ?, ?, ?)", batch,
+            )
+            self.conn.commit()
+            self.stats["flushes"] += 1
+            self.stats["flushed_rows"] += len(batch)
+
+    def has_pending(self, conversation_id):
+        with self.condition:
+            return conversation_id in self.pending_ids
+
+    def exists(self, conversation_id):
+        if self.has_pending(conversation_id):
+            return True
+        with self.lock:
+            row = self.conn.execute("SELECT 1 FROM messages WHERE conversation_id = ? LIMIT 1", (conversation_id,)).fetchone()
+        return row is not None
+
+    def read_tail(self, conversation_id, n):
+        if not n:
+            return []
+        # 아직 쓰이지 않은 기록이 있으면 먼저 써서 방금 append 한 것도 읽히게 한다
+        if self.has_pending(conversation_id):
+            self.flush()
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT role, content FROM messages WHERE conversation_id = ? ORDER BY id DESC LIMIT ?",
+                (conversation_id, n),
+            ).fetchall()
+        return [{"role": role, "content": content} for role, content in reversed(rows)]
+
+    def journal(self, conversation_id):
+        return StoreJournal(self, conversation_id)
+
+    def get_stats(self):
+        with self.condition:
+            return dict(self.stats, pending=len(self.pending))
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        with self.condition:
+            self.condition.notify()
+        self.flush()
+        with self.lock:
+            self.conn.close()
+
+
+class StoreJournal():
+    # ChatHistory 가 쓰는 ConversationJournal 과 같은 interface 로 store 의 대화 하나를 가리킨다
+    def __init__(self, store, conversation_id):
+        self.store = store
+        self.conversation_id = conversation_id
+
+    def exists(self):
+        return self.store.exists(self.conversation_id)
+
+    def append(self, record):
+        self.store.append(self.conversation_id, record)
+
+    def append_many(self, records):
+        for record in records:
+            self.append(record)
+
+    def read_tail(self, n):
+        return self.store.read_tail(self.conversation_id, n)
+
+
+class Session():
+    def __init__(self, conversation_id, chat_history):
+        self.conversation_id = conversation_id
+        self.chat_history = chat_history
+        # 같은 대화의 요청은 순서대로 처리해야 history 가 꼬이지 않는다
+        self.lock = asyncio.Lock()
+        self.last_used = time.monotonic()
+
+
+class SessionManager():
+    # 자주 쓰는 대화만 메모리에 두는 LRU. 개수가 max_sessions 를 넘거나 idle_seconds 동안 안 쓰이면 내보내고,
+    # 다시 들어오면 그때 store 에서 history 를 읽는다 (기록은 store 에 있으므로 내보내도 잃지 않는다)
+    # server 는 history 를 읽는 I/O 가 event loop 를 막지 않도록 get 을 threadpool 에서 부른다
+    def __init__(self, create_history, max_sessions=10000, idle_seconds=1800.0):
+        self.create_history = create_history
+        self.max_sessions = max_sessions
+        self.idle_seconds = idle_seconds
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+        # 같은 대화를 여러 thread 가 동시에 읽지 않도록 대화별 loading lock 을 둔다
+        self.loading = {}
+        self.stats = {"hits": 0, "loads": 0, "evicted_size": 0, "evicted_idle": 0}
+
+    def get(self, conversation_id):
+        with self.lock:
+            session = self.touch(conversation_id)
+            if session is not None:
+                return session
+            load_lock = self.loading.setdefault(conversation_id, threading.Lock())
+
+        with load_lock:
+            with self.lock:
+                session = self.touch(conversation_id)
+                if session is not None:
+                    return session
+            # store / 파일 I/O 는 manager lock 밖에서 해서 다른 대화의 요청을 막지 않는다
+            chat_history = self.create_history(conversation_id)
+            with self.lock:
+                self.loading.pop(conversation_id, None)
+                self.stats["loads"] += 1
+                session = self.sessions[conversation_id] = Session(conversation_id, chat_history)
+                self.evict(session.last_used, keep=conversation_id)
+                return session
+
+    def touch(self, conversation_id):
+        # 메모리에 있으면 LRU 순서를 갱신해서 돌려준다 (self.lock 안에서 부른다)
+        session = self.sessions.get(conversation_id)
+        if session is None:
+            return None
+        now = time.monotonic()
+        self.stats["hits"] += 1
+        self.sessions.move_to_end(conversation_id)
+        session.last_used = now
+        self.evict(now, keep=conversation_id)
+        return session
+
+    def evict(self, now, keep=None):
+        # 가장 오래 안 쓴 것이 맨 앞에 있으므로 앞에서부터만 보면 된다
+        # 처리 중인 대화와 지금 돌려줄 대화(keep)는 뒤로 돌리고 다음 것을 본다. 모두 그래도 끝나도록 한 바퀴까지만 돈다
+        for _ in range(len(self.sessions)):
+            conversation_id, session = next(iter(self.sessions.items()))
+            if len(self.sessions) > self.max_sessions:
+                reason = "evicted_size"
+            elif self.idle_seconds and now - session.last_used > self.idle_seconds:
+                reason = "evicted_idle"
+            else:
+                return
+            if session.lock.locked() or conversation_id == keep:
+                self.sessions.move_to_end(conversation_id)
+                continue
+            del self.sessions[conversation_id]
+            self.stats[reason] += 1
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats, sessions=len(self.sessions))
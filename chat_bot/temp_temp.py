@@ -3,6 +3,10 @@ import json
 import openai
 
 from database import VectorDB
+from llm_client import LLMClient
+from manifest import hash_text
+from prompt_registry import get_prompt_registry
+from tool_executor import ToolExecutor, ToolRegistry, run_tool_loop
 
 from langchain.chains import LLMChain
 from langchain.chains import SequentialChain
@@ -11,47 +15,39 @@ from langchain.prompts.chat import HumanMessagePromptTemplate
 from langchain.schema import SystemMessage
 from langchain.chat_models import ChatOpenAI
 
-INTENT_PROMPT_TEMPLATE = os.path.join("./prompt_template", "parse_intent.txt")
-DEFAULT_RESPONSE_PROMPT_TEMPLATE = os.path.join("./prompt_template", "default_response.txt")
-QUESTION_RESPONSE_PROMPT_TEMPLATE = os.path.join("./prompt_template", "question_response.txt")
-
-def read_prompt_template(file_path: str) -> str:
-        with open(file_path, "r") as f:
-            prompt_template = f.read()
-
-        return prompt_template
-    
-def create_chain(llm, template_path, output_key):
+def create_chain(llm, template, output_key):
     return LLMChain(
         llm=llm,
         prompt=ChatPromptTemplate.from_template(
-            template=read_prompt_template(template_path)
+            template=template
         ),
         output_key=output_key,
         verbose=True,
     )
 
 class LangChain():
-    def __init__(self, db=None, api_key = os.environ["OPENAI_API_KEY"]):
+    def __init__(self, db=None, api_key=None):
         self.db = db
         self.openai = openai
-        self.openai.api_key = api_key
+        self.openai.api_key = api_key or os.environ.get("OPENAI_API_KEY")
+        self.llm_client = LLMClient()
         self.llm = ChatOpenAI(temperature=0.1, model="gpt-3.5-turbo")
         self.chain = None
+        self.prompts = get_prompt_registry()
 
         self.parse_intent_chain = create_chain(
             llm=self.llm,
-            template_path=INTENT_PROMPT_TEMPLATE,
+            template=self.prompts["parse_intent"],
             output_key="intent",
         )
         self.default_chain = create_chain(
             llm=self.llm,
-            template_path=DEFAULT_RESPONSE_PROMPT_TEMPLATE,
+            template=self.prompts["default_response"],
             output_key="output",
         )
         self.question_chain = create_chain(
             llm=self.llm,
-            template_path=QUESTION_RESPONSE_PROMPT_TEMPLATE,
+            template=self.prompts["question_response"],
             output_key="output",
         )
 
@@ -59,7 +55,7 @@ class LangChain():
     def generate_answer(self, user_message):
         context = dict(user_message=user_message)
         context["input"] = context["user_message"]
-        context["intent_list"] = read_prompt_template(INTENT_PROMPT_TEMPLATE)
+        context["intent_list"] = self.prompts["intent_list"]
         context["chat_history"] = ""
         intent = self.parse_intent_chain.run(context)
 
@@ -67,7 +63,7 @@ class LangChain():
             context["message"] = user_message
             answer = self.default_chain.run(context)
         else:
-            context["related_documents"] = self.db.get_data_from_db(user_message)
+            context["related_documents"] = self.db.query_db(user_message)
             context["compressed_web_search_results"] = ""
 
 
@@ -88,66 +84,50 @@ class LangChain():
 
     def funccall(self):
         self.system_message = "너는 고객의 질문에 대답을 하는 상담사야. 내용은 질문에 대한 대답은 function 을 통해서 찾도록 해."
-        self.message_log = []
-        self.functions = [
+        self.message_log = [{"role": "system", "content": self.system_message}]
+        self.tool_registry = ToolRegistry()
+        self.tool_registry.register(
+            "query_db",
+            self.db.query_db,
+            "db에 저장된 데이터로부터 응답 도출",
             {
-                "name": "get_data_from_db",
-                "description": "db에 저장된 데이터로부터 응답 도출",
-                "parameters": {
-                    "type": "object",
-                    "properties": {
-                        "query": {
-                            "type": "string",
-                            "description": "query",
-                        },
+                "type": "object",
+                "properties": {
+                    "query": {
+                        "type": "string",
+                        "description": "query",
                     },
-                    "required": ["query"],
                 },
-            }
-        ]
+                "required": ["query"],
+            },
+            ttl=300,
+        )
+        self.tool_executor = ToolExecutor(self.tool_registry)
+        self.last_tool_stats = None
 
 
     def add_message_log(self, msg):
         self.message_log.append(msg)
 
-    def send_message(self, gpt_model="gpt-3.5-turbo", temperature=0.1):
-        response = self.openai.ChatCompletion.create(
+    def create_completion(self, **kwargs):
+        # 같은 요청이 동시에 들어오면 한 번만 보내고, timeout / 재시도 / circuit breaker 는 llm_client 가 맡는다
+        key = hash_text(json.dumps(kwargs, sort_keys=True, ensure_ascii=False, default=str))
+        return self.llm_client.call(key, lambda: self.openai.ChatCompletion.create(request_timeout=self.llm_client.timeout, **kwargs))
+
+    def send_message(self, gpt_model="gpt-3.5-turbo", temperature=0.1, max_context_tokens=3000):
+        # 모델이 요청한 tool 들은 동시에 실행하고 (같은 인자의 결과는 TTL 동안 재사용),
+        # 매 completion 에는 message log 를 max_context_tokens 안으로 잘라서 보낸다
+        answer, stats = run_tool_loop(
+            self.create_completion,
+            self.message_log,
+            self.tool_executor,
+            max_tokens=max_context_tokens,
             model=gpt_model,
-            messages=self.message_log,
             temperature=temperature,
-            functions=self.functions,
-            function_call='auto',
         )
-
-        response_message = response["choices"][0]["message"]
-
-        if response_message.get("function_call"):
-            available_functions = {
-                "get_data_from_db": self.db.get_data_from_db,
-            }
-            function_name = response_message["function_call"]["name"]
-            fuction_to_call = available_functions[function_name]
-            function_args = json.loads(response_message["function_call"]["arguments"])
-            # 사용하는 함수에 따라 사용하는 인자의 개수와 내용이 달라질 수 있으므로
-            # **function_args로 처리하기
-            function_response = fuction_to_call(**function_args)
-
-            # 함수를 실행한 결과를 GPT에게 보내 답을 받아오기 위한 부분
-            self.add_message_log(response_message)  # GPT의 지난 답변을 message_logs에 추가하기
-            self.add_message_log(
-                {
-                    "role": "function",
-                    "name": function_name,
-                    "content": function_response,
-                }
-            )  # 함수 실행 결과도 GPT messages에 추가하기
-            response = self.openai.ChatCompletion.create(
-                model=gpt_model,
-                messages=self.message_log,
-                temperature=temperature,
-                # max_tokens=4096
-            )  # 함수 실행 결과를 GPT에 보내 새로운 답변 받아오기
-        return response.choices[0].message.content
+        # round trip / tool 호출 수 / tool 실행 시간은 run_tool_loop 가 log (CHATBOT_VERBOSE=1) 와 metrics 로 남긴다
+        self.last_tool_stats = stats
+        return answer
 
     def get_system_message_prompt(self):
         return SystemMessage(content=self.system_message)
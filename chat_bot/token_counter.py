@@ -0,0 +1,31 @@
+# tiktoken 은 import 와 encoding 적재가 느려서 처음 count_tokens 를 부를 때 불러온다
+# 설치되지 않았거나 BPE 파일을 받지 못하면 (오프라인 등) 한 번만 시도하고 estimate_tokens 로 계속 센다
+_encoding = None
+_encoding_loaded = False
+
+
+def get_encoding(model="gpt-3.5-turbo"):
+    global _encoding, _encoding_loaded
+    if not _encoding_loaded:
+        try:
+            import tiktoken
+            _encoding = tiktoken.encoding_for_model(model)
+        except Exception:
+            _encoding = None
+        _encoding_loaded = True
+    return _encoding
+
+
+def estimate_tokens(text):
+    # tiktoken 이 없을 때의 근사치: 영문은 4글자당 1 token, 한글 등 비 ascii 문자는 글자당 1 token
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return (ascii_chars + 3) // 4 + (len(text) - ascii_chars)
+
+
+def count_tokens(text):
+    if not text:
+        return 0
+    encoding = get_encoding()
+    if encoding is None:
+        return estimate_tokens(text)
+    return len(encoding.encode(text))
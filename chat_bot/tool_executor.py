@@ -0,0 +1,311 @@
+import json
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from token_counter import count_tokens
+from tracing import log, tracer
+
+# message 하나에 붙는 role / 구분자 token 근사치
+MESSAGE_OVERHEAD_TOKENS = 4
+# 예산이 모자라도 tool 결과마다 이만큼은 남긴다
+MIN_TOOL_RESULT_TOKENS = 32
+TRUNCATED_SUFFIX = "\n...(truncated)"
+
+
+class ToolRegistry():
+    # 이름 -> (함수, OpenAI tool schema, 결과 cache TTL). ttl=0 이면 memoize 하지 않는다
+    def __init__(self):
+        self.tools = {}
+
+    def register(self, name, fn, description, parameters, ttl=300.0):
+        self.tools[name] = {"fn": fn, "ttl": ttl, "schema": {"name": name, "description": description, "parameters": parameters}}
+
+    def get(self, name):
+        return self.tools.get(name)
+
+    def schemas(self):
+        return [{"type": "function", "function": tool["schema"]} for tool in self.tools.values()]
+
+
+class ToolExecutor():
+    # 한 번의 completion 이 요청한 tool call 들을 동시에 실행하고, (tool, args) 결과를 TTL 동안 재사용한다
+    # 결과 cache 는 max_cache_size 개까지만 두는 LRU
+    def __init__(self, registry, max_workers=4, timeout=30.0, max_cache_size=1024):
+        self.registry = registry
+        self.timeout = timeout
+        self.max_cache_size = max_cache_size
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tool")
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {"calls": 0, "cache_hits": 0, "executed": 0, "errors": 0, "seconds": {}}
+
+    def cache_key(self, name, arguments):
+        return name, json.dumps(arguments, sort_keys=True, ensure_ascii=False)
+
+    def lookup(self, key):
+        with self.lock:
+            entry = self.cache.get(key)
+            if entry is None:
+                return None
+            if time.monotonic() > entry[0]:
+                del self.cache[key]
+                return None
+            self.cache.move_to_end(key)
+            return entry[1]
+
+    def store(self, key, result, ttl):
+        with self.lock:
+            self.cache[key] = (time.monotonic() + ttl, result)
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.max_cache_size:
+                self.cache.popitem(last=False)
+
+    def count(self, **increments):
+        # execute 는 여러 thread 에서 동시에 불릴 수 있으므로 stats 는 lock 안에서 올린다
+        with self.lock:
+            for name, value in increments.items():
+                self.stats[name] += value
+
+    def run(self, name, arguments):
+        with tracer.span("tool", stage=f"tool:{name}") as span:
+            start = time.perf_counter()
+            try:
+                result = self.registry.get(name)["fn"](**arguments)
+            finally:
+                seconds = time.perf_counter() - start
+                with self.lock:
+                    self.stats["executed"] += 1
+                    self.stats["seconds"][name] = self.stats["seconds"].get(name, 0.0) + seconds
+            result = result if isinstance(result, str) else json.dumps(result, ensure_ascii=False)
+            span.set(result_chars=len(result))
+            return result
+
+    def execute(self, tool_calls):
+        # tool_calls: [{"id", "name", "arguments"(json str)}] -> 같은 순서의 결과 문자열 목록
+        # 오류는 예외 대신 결과 문자열로 돌려줘서 모델이 다음 답변에서 처리하게 한다
+        results = [None] * len(tool_calls)
+        pending = {}
+        for i, call in enumerate(tool_calls):
+            tool = self.registry.get(call["name"])
+            try:
+                arguments = json.loads(call["arguments"] or "{}")
+            except ValueError as e:
+                arguments = None
+                results[i] = json.dumps({"error": f"invalid arguments: {e}"})
+            if tool is None:
+                results[i] = json.dumps({"error": f"unknown tool: {call['name']}"})
+            if results[i] is not None:
+                self.count(calls=1, errors=1)
+                continue
+
+            key = self.cache_key(call["name"], arguments)
+            cached = self.lookup(key) if tool["ttl"] else None
+            if cached is not None:
+                self.count(calls=1, cache_hits=1)
+                results[i] = cached
+            elif key in pending:
+                # 같은 turn 에 같은 호출이 여러 번 있으면 한 번만 실행한다
+                self.count(calls=1, cache_hits=1)
+                pending[key][1].append(i)
+            else:
+                self.count(calls=1)
+                pending[key] = (self.executor.submit(self.run, call["name"], arguments), [i])
+
+        done, _ = wait([future for future, _ in pending.values()], timeout=self.timeout)
+        for key, (future, indexes) in pending.items():
+            name = key[0]
+            if future not in done:
+                result = json.dumps({"error": f"{name} timed out after {self.timeout}s"})
+                self.count(errors=1)
+            elif future.exception() is not None:
+                result = json.dumps({"error": f"{type(future.exception()).__name__}: {future.exception()}"})
+                self.count(errors=1)
+            else:
+                result = future.result()
+                ttl = self.registry.get(name)["ttl"]
+                if ttl:
+                    self.store(key, result, ttl)
+            for i in indexes:
+                results[i] = result
+        return results
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats, seconds=dict(self.stats["seconds"]), cache_size=len(self.cache))
+
+
+def message_tokens(message):
+    tokens = MESSAGE_OVERHEAD_TOKENS + count_tokens(message.get("content") or "")
+    if message.get("function_call"):
+        tokens += count_tokens(json.dumps(message["function_call"], ensure_ascii=False))
+    for call in message.get("tool_calls") or []:
+        tokens += count_tokens(json.dumps(call, ensure_ascii=False))
+    return tokens
+
+
+def group_turns(messages):
+    # user message 하나와 그 뒤의 assistant / tool message 들을 한 turn 으로 묶는다
+    # (tool_calls 를 가진 assistant message 와 tool 결과는 같이 남기거나 같이 버려야 API 가 받아준다)
+    turns = []
+    for message in messages:
+        if message.get("role") == "user" or not turns:
+            turns.append([message])
+        else:
+            turns[-1].append(message)
+    return turns
+
+
+def clip_content(content, max_tokens):
+    # 앞부분만 남긴다 (글자 수 비율로 자르고, 넘으면 조금씩 더 줄인다)
+    tokens = count_tokens(content)
+    if tokens <= max_tokens:
+        return content
+    max_tokens = max(max_tokens - count_tokens(TRUNCATED_SUFFIX), 0)
+    keep = int(len(content) * max_tokens / tokens)
+    while keep > 0 and count_tokens(content[:keep]) > max_tokens:
+        keep = int(keep * 0.9)
+    return content[:keep] + TRUNCATED_SUFFIX
+
+
+def clip_tool_results(turn, budget):
+    # 지금 turn 이 budget 을 넘으면 tool 결과들을 잘라서 맞춘다. 작은 결과는 그대로 두고 큰 것들이 남은 예산을 똑같이 나눈다
+    # 반환값: (turn, 자른 tool 결과 수)
+    tool_indexes = [i for i, message in enumerate(turn) if message.get("role") in ("tool", "function")]
+    sizes = {i: message_tokens(turn[i]) for i in tool_indexes}
+    available = budget - sum(message_tokens(message) for i, message in enumerate(turn) if i not in sizes)
+    if not tool_indexes or sum(sizes.values()) <= available:
+        return turn, 0
+
+    turn = list(turn)
+    clipped = 0
+    remaining = max(available, 0)
+    ordered = sorted(tool_indexes, key=sizes.get)
+    for n, i in enumerate(ordered):
+        share = remaining // (len(ordered) - n)
+        if sizes[i] <= share:
+            remaining -= sizes[i]
+            continue
+        limit = max(share, MIN_TOOL_RESULT_TOKENS + MESSAGE_OVERHEAD_TOKENS)
+        turn[i] = dict(turn[i], content=clip_content(turn[i].get("content") or "", limit - MESSAGE_OVERHEAD_TOKENS))
+        remaining -= min(limit, remaining)
+        clipped += 1
+    return turn, clipped
+
+
+def trim_messages(messages, max_tokens):
+    # system message 와 지금 turn 은 항상 보내고, 이전 turn 들은 최근 것부터 max_tokens 안에 들어가는 만큼만 보낸다
+    # 지금 turn 만으로 넘치면 그 turn 의 tool 결과를 잘라서 맞춘다 (message_log 의 원본은 그대로 둔다)
+    # 반환값: (보낼 messages, 버린 message 수, 자른 tool 결과 수)
+    system = [message for message in messages if message.get("role") == "system"]
+    rest = [message for message in messages if message.get("role") != "system"]
+    turns = group_turns(rest)
+    system_tokens = sum(message_tokens(message) for message in system)
+    kept, clipped = clip_tool_results(turns.pop(), max_tokens - system_tokens) if turns else ([], 0)
+    budget = max_tokens - system_tokens - sum(message_tokens(message) for message in kept)
+    for turn in reversed(turns):
+        tokens = sum(message_tokens(message) for message in turn)
+        if tokens > budget:
+            break
+        kept = turn + kept
+        budget -= tokens
+    return system + kept, len(rest) - len(kept), clipped
+
+
+def parse_tool_calls(message):
+    # tools API 의 tool_calls 와 예전 API 의 function_call 을 같은 모양으로 바꾼다
+    if message.get("tool_calls"):
+        return [
+            {"id": call["id"], "name": call["function"]["name"], "arguments": call["function"]["arguments"]}
+            for call in message["tool_calls"]
+        ]
+    if message.get("function_call"):
+        return [{"id": None, "name": message["function_call"]["name"], "arguments": message["function_call"]["arguments"]}]
+    return []
+
+
+def tool_result_message(call, result):
+    if call["id"] is None:
+        return {"role": "function", "name": call["name"], "content": result}
+    return {"role": "tool", "tool_call_id": call["id"], "content": result}
+
+
+def run_tool_loop(create_completion, message_log, executor, max_tokens=3000, max_rounds=4, **completion_kwargs):
+    # completion -> 요청된 tool 동시 실행 -> 결과를 붙여 다시 completion 을 tool 요청이 없을 때까지 반복한다
+    # message_log 에는 전체 기록을 남기고, 매 completion 에는 token 예산으로 자른 것만 보낸다
+    stats = {"round_trips": 0, "tool_calls": 0, "trimmed_messages": 0, "clipped_tool_results": 0, "prompt_tokens": 0,
+             "tool_seconds": 0.0}
+    tools = executor.registry.schemas()
+    answer = ""
+    for round_index in range(max_rounds):
+        messages, trimmed, clipped = trim_messages(message_log, max_tokens)
+        stats["trimmed_messages"] = max(stats["trimmed_messages"], trimmed)
+        stats["clipped_tool_results"] = max(stats["clipped_tool_results"], clipped)
+        stats["prompt_tokens"] += sum(message_tokens(message) for message in messages)
+        kwargs = dict(completion_kwargs)
+        if round_index < max_rounds - 1:
+            # 마지막 round 에서는 tool 없이 답하게 한다
+            kwargs.update(tools=tools, tool_choice="auto")
+        response = create_completion(messages=messages, **kwargs)
+        stats["round_trips"] += 1
+
+        message = response["choices"][0]["message"]
+        tool_calls = parse_tool_calls(message)
+        if not tool_calls:
+            answer = message.get("content") or ""
+            message_log.append({"role": "assistant", "content": answer})
+            break
+
+        message_log.append(message)
+        start = time.perf_counter()
+        results = executor.execute(tool_calls)
+        stats["tool_seconds"] += time.perf_counter() - start
+        stats["tool_calls"] += len(tool_calls)
+        message_log.extend(tool_result_message(call, result) for call, result in zip(tool_calls, results))
+
+    # 답변 하나당 평균 round trip = round_trips_total / answers_total
+    tracer.metrics.inc("chatbot_tool_loop_answers_total")
+    tracer.metrics.inc("chatbot_tool_loop_round_trips_total", stats["round_trips"])
+    tracer.metrics.inc("chatbot_tool_calls_total", stats["tool_calls"])
+    log(f"tool loop: {stats}")
+    return answer, stats
+
+
+if __name__ == "__main__":
+    import uvicorn
+    import openai
+
+    from fake_chat_server import app
+    from lexical_index import HybridRetriever, build_manual_index
+    from manual import find_text_files
+
+    # fake chat server 는 user message 를 "|" 로 나눠서 조각마다 tool call 을 하나씩 요청한다
+    retriever = HybridRetriever(None, build_manual_index(find_text_files("./data")), mode="lexical")
+    registry = ToolRegistry()
+    registry.register(
+        "get_data_from_db", lambda query: (time.sleep(0.2), retriever.query_db(query))[1],
+        "db에 저장된 데이터로부터 응답 도출",
+        {"type": "object", "properties": {"query": {"type": "string", "description": "query"}}, "required": ["query"]},
+    )
+    executor = ToolExecutor(registry)
+
+    port = 8766
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+
+    def create_completion(**kwargs):
+        return openai.ChatCompletion.create(model="gpt-3.5-turbo", api_base=f"http://127.0.0.1:{port}/v1", api_key="fake", **kwargs)
+
+    message_log = [{"role": "system", "content": "너는 고객의 질문에 대답을 하는 상담사야."}]
+    for question in ("latency=0 카카오싱크 간편가입 | 카카오톡 채널 메시지 | 카카오 로그인 동의항목",
+                     "latency=0 카카오싱크 간편가입 | 카카오톡 채널 메시지",
+                     "latency=0 카카오소셜 친구 목록"):
+        message_log.append({"role": "user", "content": question})
+        start = time.perf_counter()
+        answer, stats = run_tool_loop(create_completion, message_log, executor, max_tokens=1500)
+        print(json.dumps(dict(stats, seconds=round(time.perf_counter() - start, 3), tool_seconds=round(stats["tool_seconds"], 3)), ensure_ascii=False))
+    print(json.dumps(executor.get_stats(), ensure_ascii=False))
+    server.should_exit = True
@@ -0,0 +1,214 @@
+import os
+import json
+import time
+import uuid
+import queue
+import atexit
+import random
+import threading
+import contextvars
+from bisect import bisect_left
+from contextlib import contextmanager
+
+VERBOSE = os.environ.get("CHATBOT_VERBOSE", "0") == "1"
+TRACE_PATH = os.environ.get("CHATBOT_TRACE_PATH")
+TRACE_SAMPLE_RATE = float(os.environ.get("CHATBOT_TRACE_SAMPLE_RATE", "0.05"))
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+
+def log(*args):
+    # 요청마다 찍던 디버그 출력. 운영에서는 CHATBOT_VERBOSE=1 일 때만 나온다
+    if VERBOSE:
+        print(*args)
+
+
+def process_memory(pid="self"):
+    # rss 는 공유 page 까지, pss 는 공유 page 를 나눠 가진 만큼, private 는 이 process 만 쓰는 양 (kB, linux 전용)
+    memory = {}
+    try:
+        with open(f"/proc/{pid}/smaps_rollup", "r") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if key in ("Rss", "Pss", "Private_Clean", "Private_Dirty"):
+                    memory[key.lower()] = int(value.split()[0])
+    except OSError:
+        return memory
+    memory["private"] = memory.pop("private_clean", 0) + memory.pop("private_dirty", 0)
+    return memory
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+class Metrics():
+    # counter 와 latency histogram 을 모아서 Prometheus text format 으로 내보낸다
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {"buckets": [0] * len(self.buckets), "count": 0, "sum": 0.0}
+            index = bisect_left(self.buckets, seconds)
+            if index < len(self.buckets):
+                histogram["buckets"][index] += 1
+            histogram["count"] += 1
+            histogram["sum"] += seconds
+
+    def render(self):
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, dict(value, buckets=list(value["buckets"]))) for key, value in self.histograms.items())
+
+        lines = []
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                lines.append(f"# TYPE {name} counter")
+                typed.add(name)
+            lines.append(f"{name}{format_labels(labels)} {value}")
+        for (name, labels), histogram in histograms:
+            if name not in typed:
+                lines.append(f"# TYPE {name} histogram")
+                typed.add(name)
+            cumulative = 0
+            for bound, count in zip(self.buckets, histogram["buckets"]):
+                cumulative += count
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {histogram['count']}")
+            lines.append(f"{name}_sum{format_labels(labels)} {histogram['sum']:.6f}")
+            lines.append(f"{name}_count{format_labels(labels)} {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+
+class Span():
+    def __init__(self, name, attributes):
+        self.name = name
+        self.attributes = attributes
+        self.start = time.perf_counter()
+        self.seconds = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def to_dict(self, trace_start):
+        return dict(
+            self.attributes,
+            name=self.name,
+            offset_ms=round((self.start - trace_start) * 1000, 3),
+            duration_ms=round(self.seconds * 1000, 3),
+        )
+
+
+class Trace():
+    def __init__(self, name, sampled):
+        self.trace_id = uuid.uuid4().hex
+        self.name = name
+        self.sampled = sampled
+        self.start = time.perf_counter()
+        self.started_at = time.time()
+        self.spans = []
+
+
+class Tracer():
+    # span 마다 metric 은 항상 남기고, JSONL trace 는 sample_rate 비율의 요청만 background thread 로 쓴다
+    def __init__(self, trace_path=TRACE_PATH, sample_rate=TRACE_SAMPLE_RATE, metrics=None):
+        self.trace_path = trace_path
+        self.sample_rate = sample_rate
+        self.metrics = metrics or Metrics()
+        self.queue = queue.Queue(maxsize=1024)
+        self.writer = None
+        self.lock = threading.Lock()
+
+    def start_trace(self, name):
+        sampled = bool(self.trace_path) and random.random() < self.sample_rate
+        trace = Trace(name, sampled)
+        current_trace.set(trace)
+        return trace
+
+    def finish_trace(self, trace, **attributes):
+        seconds = time.perf_counter() - trace.start
+        self.metrics.observe("chatbot_request_seconds", seconds, request=trace.name)
+        self.metrics.inc("chatbot_requests_total", request=trace.name)
+        if not trace.sampled:
+            return
+        record = dict(
+            attributes,
+            trace_id=trace.trace_id,
+            name=trace.name,
+            started_at=trace.started_at,
+            duration_ms=round(seconds * 1000, 3),
+            spans=[span.to_dict(trace.start) for span in trace.spans],
+        )
+        self.start_writer()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            # 디스크가 밀리면 trace 는 버린다 (요청을 막지 않는다)
+            self.metrics.inc("chatbot_trace_dropped_total")
+
+    @contextmanager
+    def span(self, name, **attributes):
+        span = Span(name, attributes)
+        try:
+            yield span
+        except BaseException as e:
+            span.set(error=type(e).__name__)
+            raise
+        finally:
+            span.seconds = time.perf_counter() - span.start
+            stage = span.attributes.get("stage", name)
+            self.metrics.observe("chatbot_stage_seconds", span.seconds, stage=stage)
+            if "error" in span.attributes:
+                self.metrics.inc("chatbot_stage_errors_total", stage=stage)
+            for key in ("prompt_tokens", "completion_tokens"):
+                if span.attributes.get(key):
+                    self.metrics.inc(f"chatbot_{key}_total", span.attributes[key], stage=stage)
+            if "cache" in span.attributes:
+                self.metrics.inc("chatbot_cache_total", stage=stage, status=span.attributes["cache"])
+            trace = current_trace.get()
+            if trace is not None and trace.sampled:
+                trace.spans.append(span)
+
+    def start_writer(self):
+        with self.lock:
+            if self.writer is None:
+                self.writer = threading.Thread(target=self.write_loop, daemon=True, name="trace-writer")
+                self.writer.start()
+                atexit.register(self.flush)
+
+    def write_loop(self):
+        directory = os.path.dirname(self.trace_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.trace_path, "a", encoding="utf-8") as f:
+            while True:
+                records = [self.queue.get()]
+                while not self.queue.empty():
+                    records.append(self.queue.get_nowait())
+                f.write("".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records))
+                f.flush()
+                for _ in records:
+                    self.queue.task_done()
+
+    def flush(self):
+        if self.writer is not None:
+            self.queue.join()
+
+
+tracer = Tracer()